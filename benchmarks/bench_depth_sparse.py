@@ -0,0 +1,111 @@
+"""
+Sparse DepthPro mode (depth kept at model resolution, sampled only at object mask
+pixels) vs the full-resolution path: error of object positions and of depth at mask
+pixels, latency of depth + positions and size of the kept depth representation.
+Objects are found by Grounding DINO and segmented by SAM.
+
+    python -m benchmarks.bench_depth_sparse --images image1.jpg --objects person car \
+        --resolutions 0 768 384
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import load_images, print_row, timeit
+from src.vision_module.depthpro_model import DepthProModelWrapper
+from src.vision_module.grounding_dino_model import GroundingDINOModelWrapper
+from src.vision_module.positions import estimate_positions
+from src.vision_module.sam_model import SAMModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Sparse DepthPro mode benchmark.")
+    parser.add_argument("--images", nargs="+", default=["image1.jpg"])
+    parser.add_argument("--objects", nargs="+", default=["person"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--resolutions",
+        nargs="+",
+        type=int,
+        default=[0, 768, 384],
+        help="Longer side of the kept depth map, 0 is the model output resolution.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def detect_and_segment(images, objects, device):
+    dino = GroundingDINOModelWrapper(device=device)
+    dino.load()
+    detections = [dino.detect(img, objects) for img in images]
+    dino.unload()
+    sam = SAMModelWrapper(device=device)
+    sam.load()
+    masks = [sam.get_masks(img, boxes) for img, (boxes, _) in zip(images, detections)]
+    sam.unload()
+    return [boxes for boxes, _ in detections], masks
+
+
+def positions(depthpro, images, boxes, masks):
+    """Depth (representation, focal) and positions of every image."""
+    out = []
+    for img, b, m in zip(images, boxes, masks):
+        depth_map, focal_length = depthpro._run_model(img)
+        depth_map = depthpro._as_depth(depth_map, img)
+        pos = estimate_positions(m, b, depth_map, focal_length, img_size=img.size)
+        out.append((depth_map, focal_length, pos))
+    return out
+
+
+def mask_depth(depth_map, mask: torch.Tensor) -> np.ndarray:
+    ys, xs = torch.nonzero(mask.bool(), as_tuple=True)
+    if hasattr(depth_map, "sample"):
+        return depth_map.sample(xs.float(), ys.float()).numpy()
+    return np.asarray(depth_map, dtype=np.float32)[ys.numpy(), xs.numpy()]
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    images = load_images(args.images)
+    boxes, masks = detect_and_segment(images, args.objects, args.device)
+    n_objects = sum(len(b) for b in boxes)
+    print(f"{len(images)} images, {n_objects} objects")
+
+    depthpro = DepthProModelWrapper(device=args.device)
+    depthpro.load()
+    run = lambda: positions(depthpro, images, boxes, masks)
+    dense = run()
+    print_row("dense (full resolution)", timeit(run, repeat=args.repeat), len(images))
+    print(f"{'':<28} depth size {np.mean([d.nbytes for d, _, _ in dense]) / 2**20:.1f} MiB/img")
+
+    for resolution in args.resolutions:
+        depthpro.sparse = True
+        depthpro.sparse_resolution = resolution or None
+        sparse = run()
+        name = f"sparse ({resolution or 'model'})"
+        print_row(name, timeit(run, repeat=args.repeat), len(images))
+        print(f"{'':<28} depth size {np.mean([d.nbytes for d, _, _ in sparse]) / 2**20:.1f} MiB/img")
+
+        focal = [abs(fs - fd) / fd for (_, fd, _), (_, fs, _) in zip(dense, sparse)]
+        depth_rel, pos_abs, z_rel = [], [], []
+        for (dd, _, pd), (ds, _, ps), img_masks in zip(dense, sparse, masks):
+            for mask in img_masks:
+                if mask.any():
+                    ref, est = mask_depth(dd, mask), mask_depth(ds, mask)
+                    depth_rel.append(np.mean(np.abs(est - ref) / np.maximum(ref, 1e-6)))
+            if len(pd):
+                pd, ps = np.asarray(pd), np.asarray(ps)
+                pos_abs.append(np.linalg.norm(ps - pd, axis=1))
+                z_rel.append(np.abs(ps[:, 2] - pd[:, 2]) / np.maximum(np.abs(pd[:, 2]), 1e-6))
+        pos_abs = np.concatenate(pos_abs) if pos_abs else np.array([np.nan])
+        z_rel = np.concatenate(z_rel) if z_rel else np.array([np.nan])
+        print(
+            f"{'':<28} focal rel error={np.mean(focal):.2e}, "
+            f"mask depth rel error={np.mean(depth_rel) if depth_rel else float('nan'):.4f}"
+        )
+        print(
+            f"{'':<28} position error mean={pos_abs.mean():.4f} max={pos_abs.max():.4f}, "
+            f"z rel error mean={z_rel.mean():.4f}"
+        )
+    depthpro.unload()
@@ -0,0 +1,53 @@
+"""
+Throughput of per-image `detect` vs batched `detect_batch` of GroundingDINOModelWrapper,
+plus a check that both paths return the same boxes and labels (within tolerance).
+
+    python -m benchmarks.bench_grounding_dino --images image1.jpg assets/demo.png --objects car person
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import load_images, print_row, timeit
+from src.vision_module.grounding_dino_model import GroundingDINOModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Grounding DINO batching benchmark.")
+    parser.add_argument("--images", nargs="+", default=["image1.jpg"])
+    parser.add_argument("--objects", nargs="+", default=["person", "car", "chair"])
+    parser.add_argument("--copies", type=int, default=4, help="Repeat image list to build a batch.")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=2.0, help="Box tolerance in pixels.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    images = load_images(args.images) * args.copies
+    objects = [args.objects] * len(images)
+
+    dino = GroundingDINOModelWrapper(device=device, max_batch_size=args.batch_size)
+    dino.load()
+
+    single = [dino.detect(img, objs) for img, objs in zip(images, objects)]
+    batched = dino.detect_batch(images, objects)
+    mismatches = 0
+    for (boxes_a, labels_a), (boxes_b, labels_b) in zip(single, batched):
+        same = labels_a == labels_b and np.allclose(
+            np.asarray(boxes_a), np.asarray(boxes_b), atol=args.atol
+        )
+        mismatches += int(not same)
+    print(f"images with different detections: {mismatches}/{len(images)}")
+
+    t_single = timeit(
+        lambda: [dino.detect(img, objs) for img, objs in zip(images, objects)],
+        repeat=args.repeat,
+    )
+    t_batch = timeit(lambda: dino.detect_batch(images, objects), repeat=args.repeat)
+    print_row("detect (per image)", t_single, len(images))
+    print_row(f"detect_batch (bs={args.batch_size})", t_batch, len(images))
+    print(f"speedup: {t_single / t_batch:.2f}x")
@@ -0,0 +1,107 @@
+"""
+Steady-state per-image latency of the vision models in eager mode vs optimized mode
+(`InferenceConfig(optimized=True)`: inference_mode, channels_last, torch.compile with
+shape buckets). Warm-up (and compilation) time is reported separately, together with
+dynamo counters (compiled frames, unique graphs, graph breaks). The optimized wrapper
+is then unloaded to a host cache and loaded again `--reloads` times, which should not
+compile anything. CPU by default.
+
+    python -m benchmarks.bench_inference_mode --images image1.jpg --objects person
+"""
+import argparse
+import time
+
+from torch._dynamo.utils import counters
+
+from benchmarks.common import load_images, print_row, timeit
+from src.utils.model_manager import HostWeightCache
+from src.vision_module.depthpro_model import DepthProModelWrapper
+from src.vision_module.grounding_dino_model import GroundingDINOModelWrapper
+from src.vision_module.inference_config import InferenceConfig
+from src.vision_module.orient_anything_model import OrientAnythingModelWrapper
+from src.vision_module.sam_model import SAMModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Eager vs optimized inference benchmark.")
+    parser.add_argument("--images", nargs="+", default=["image1.jpg"])
+    parser.add_argument("--objects", nargs="+", default=["person"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--models", nargs="+", default=["dino", "sam", "depthpro", "orient"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--reloads", type=int, default=2)
+    return parser.parse_args()
+
+
+def dynamo_counters() -> dict:
+    return {
+        "frames": counters["frames"]["ok"],
+        "graphs": counters["stats"]["unique_graphs"],
+        "graph_breaks": sum(counters["graph_break"].values()),
+    }
+
+
+def counters_since(before: dict) -> str:
+    now = dynamo_counters()
+    return ", ".join(f"{key} {now[key] - before[key]}" for key in now)
+
+
+def run_mode(name, cls, run, images, args, optimized: bool, **kwargs):
+    wrapper = cls(
+        device=args.device,
+        inference_config=InferenceConfig(optimized=optimized),
+        # reloads get the same module back, with its compiled functions
+        host_cache=HostWeightCache(max_gb=64),
+        **kwargs,
+    )
+    wrapper.load()
+    before = dynamo_counters()
+    start = time.perf_counter()
+    wrapper.warmup()
+    warmup = time.perf_counter() - start
+    seconds = timeit(lambda: [run(wrapper, i) for i in range(len(images))], repeat=args.repeat)
+    mode = "optimized" if optimized else "eager"
+    print_row(f"{name} {mode}", seconds, len(images))
+    print(f"{'':<28} warm-up {warmup:.1f}s")
+    if optimized:
+        print(f"{'':<28} warm-up and runs: {counters_since(before)}")
+        before = dynamo_counters()
+        for _ in range(args.reloads):
+            wrapper.unload()
+            wrapper.load()
+            for i in range(len(images)):
+                run(wrapper, i)
+        print(f"{'':<28} after {args.reloads} reloads: {counters_since(before)}")
+    wrapper.unload()
+    return seconds
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    images = load_images(args.images)
+    boxes = [[(0, 0, img.width // 2, img.height // 2), (0, 0, *img.size)] for img in images]
+
+    models = {
+        "dino": (
+            GroundingDINOModelWrapper,
+            lambda w, i: w.detect(images[i], args.objects),
+            {},
+        ),
+        "sam": (
+            SAMModelWrapper,
+            lambda w, i: w.get_masks(images[i], boxes[i]),
+            # embeddings cache would hide the encoder after the first repeat
+            {"embedding_cache_bytes": 0},
+        ),
+        "depthpro": (DepthProModelWrapper, lambda w, i: w._run_model(images[i]), {}),
+        "orient": (
+            OrientAnythingModelWrapper,
+            lambda w, i: w.estimate_orientation(images[i], boxes[i]),
+            {},
+        ),
+    }
+    for name in args.models:
+        cls, run, kwargs = models[name]
+        eager = run_mode(name, cls, run, images, args, optimized=False, **kwargs)
+        optimized = run_mode(name, cls, run, images, args, optimized=True, **kwargs)
+        print(f"{name} speedup: {eager / optimized:.2f}x")
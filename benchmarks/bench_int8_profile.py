@@ -0,0 +1,135 @@
+"""
+CPU INT8 profile vs fp32: accuracy drift of boxes (Grounding DINO), masks (SAM),
+depth (DepthPro) and angles (Orient-Anything), and per-model latency. Boxes found by
+the fp32 detector are used as prompts of both SAM and Orient-Anything variants.
+
+    python -m benchmarks.bench_int8_profile --images image1.jpg --objects person car \
+        --quantized_cache_dir .int8_cache
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.common import load_images, print_row, timeit
+from src.utils.quantization import QuantizedModelCache
+from src.vision_module.depthpro_model import DepthProModelWrapper
+from src.vision_module.grounding_dino_model import GroundingDINOModelWrapper
+from src.vision_module.orient_anything_model import OrientAnythingModelWrapper
+from src.vision_module.sam_model import SAMModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="INT8 CPU profile benchmark.")
+    parser.add_argument("--images", nargs="+", default=["image1.jpg"])
+    parser.add_argument("--objects", nargs="+", default=["person"])
+    parser.add_argument("--quantized_cache_dir", type=str, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def box_iou(a, b) -> float:
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def matched_box_ious(ref, other) -> list:
+    """Best IoU of every reference box among boxes of the same label."""
+    ious = []
+    for box, label in zip(*ref):
+        same = [b for b, l in zip(*other) if l == label]
+        ious.append(max((box_iou(box, b) for b in same), default=0.0))
+    return ious
+
+
+def with_profile(cls, profile, cache, **kwargs):
+    wrapper = cls(device="cpu", profile=profile, quantized_cache=cache, **kwargs)
+    start = time.perf_counter()
+    wrapper.load()
+    print(f"{cls.__name__} [{profile}] load: {time.perf_counter() - start:.2f}s")
+    return wrapper
+
+
+def compare(cls, run, args, cache, images, **kwargs):
+    """Outputs and latency of `run(wrapper, i)` (i-th image) for fp32 and int8 variants of `cls`."""
+    outputs = {}
+    for profile in ("fp32", "int8"):
+        wrapper = with_profile(cls, profile, cache if profile == "int8" else None, **kwargs)
+        outputs[profile] = [run(wrapper, i) for i in range(len(images))]
+        seconds = timeit(
+            lambda: [run(wrapper, i) for i in range(len(images))], repeat=args.repeat
+        )
+        print_row(f"{cls.__name__[:-12]} {profile}", seconds, len(images))
+        wrapper.unload()
+    return outputs["fp32"], outputs["int8"]
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    torch.manual_seed(0)
+    images = load_images(args.images)
+    cache = QuantizedModelCache(args.quantized_cache_dir) if args.quantized_cache_dir else None
+
+    det32, det8 = compare(
+        GroundingDINOModelWrapper,
+        lambda w, i: w.detect(images[i], args.objects),
+        args,
+        cache,
+        images,
+    )
+    ious = sum((matched_box_ious(r, o) for r, o in zip(det32, det8)), [])
+    print(
+        f"boxes: fp32={sum(len(d[0]) for d in det32)} int8={sum(len(d[0]) for d in det8)} "
+        f"mean IoU={np.mean(ious) if ious else float('nan'):.4f}"
+    )
+    boxes = [d[0] for d in det32]
+
+    masks32, masks8 = compare(
+        SAMModelWrapper,
+        lambda w, i: w.get_masks(images[i], boxes[i]),
+        args,
+        cache,
+        images,
+        embedding_cache_bytes=0,
+    )
+    mask_ious = [
+        ((a & b).sum() / (a | b).sum().clamp(min=1)).item()
+        for m32, m8 in zip(masks32, masks8)
+        for a, b in zip(m32.bool(), m8.bool())
+    ]
+    print(f"masks: mean IoU={np.mean(mask_ious) if mask_ious else float('nan'):.4f}")
+
+    depth32, depth8 = compare(
+        DepthProModelWrapper, lambda w, i: w._run_model(images[i]), args, cache, images
+    )
+    rel = [
+        np.mean(np.abs(d8 - d32) / np.maximum(d32, 1e-6))
+        for (d32, _), (d8, _) in zip(depth32, depth8)
+    ]
+    focal = [abs(f8 - f32) / f32 for (_, f32), (_, f8) in zip(depth32, depth8)]
+    print(f"depth: mean abs rel error={np.mean(rel):.4f}, focal rel error={np.mean(focal):.4f}")
+
+    angles32, angles8 = compare(
+        OrientAnythingModelWrapper,
+        lambda w, i: w.estimate_orientation(images[i], boxes[i]),
+        args,
+        cache,
+        images,
+    )
+    a32 = np.concatenate(angles32)
+    a8 = np.concatenate(angles8)
+    if len(a32):
+        azimuth = np.abs(a32[:, 0] - a8[:, 0]) % 360
+        azimuth = np.minimum(azimuth, 360 - azimuth)
+        print(
+            f"angles: mean abs diff azimuth={azimuth.mean():.2f}, "
+            f"polar={np.abs(a32[:, 1] - a8[:, 1]).mean():.2f}, "
+            f"rotation={np.abs(a32[:, 2] - a8[:, 2]).mean():.2f}, "
+            f"confidence={np.abs(a32[:, 3] - a8[:, 3]).mean():.4f}"
+        )
+    if cache is not None:
+        print(f"int8 weight cache: {cache.stats()}")
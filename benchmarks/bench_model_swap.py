@@ -0,0 +1,76 @@
+"""
+Swap-in latency of vision models: cold load (`from_pretrained`), warm load (weights
+restored from pinned host memory by HostWeightCache) and steady-state inference.
+
+    python -m benchmarks.bench_model_swap --image image1.jpg --objects person car
+"""
+import argparse
+import time
+
+import torch
+
+from benchmarks.common import load_images
+from src.utils.model_manager import HostWeightCache
+from src.vision_module.depthpro_model import DepthProModelWrapper
+from src.vision_module.grounding_dino_model import GroundingDINOModelWrapper
+from src.vision_module.orient_anything_model import OrientAnythingModelWrapper
+from src.vision_module.sam_model import SAMModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Model swap-in benchmark.")
+    parser.add_argument("--image", type=str, default="image1.jpg")
+    parser.add_argument("--objects", nargs="+", default=["person"])
+    parser.add_argument("--host_cache_gb", type=float, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def timed(fn) -> float:
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    img = load_images([args.image])[0]
+    host_cache = HostWeightCache(max_gb=args.host_cache_gb)
+    box = [[0, 0, img.width, img.height]]
+
+    wrappers = {
+        "dino": (
+            GroundingDINOModelWrapper(device=device, host_cache=host_cache),
+            lambda w: w.detect(img, args.objects),
+        ),
+        "sam": (
+            # embedding cache off, so every call runs the image encoder
+            SAMModelWrapper(device=device, host_cache=host_cache, embedding_cache_bytes=0),
+            lambda w: w.get_masks(img, box),
+        ),
+        "depthpro": (
+            DepthProModelWrapper(device=device, host_cache=host_cache),
+            lambda w: w.estimate_depth(img),
+        ),
+        "orient": (
+            OrientAnythingModelWrapper(device=device, host_cache=host_cache),
+            lambda w: w.estimate_orientation(img, box),
+        ),
+    }
+
+    print(f"{'model':<10} {'cold load':>10} {'warm load':>10} {'inference':>10}")
+    for name, (wrapper, infer) in wrappers.items():
+        cold = timed(wrapper.load)
+        infer(wrapper)  # warm-up
+        inference = min(timed(lambda: infer(wrapper)) for _ in range(args.repeat))
+        warm = []
+        for _ in range(args.repeat):
+            wrapper.unload()
+            warm.append(timed(wrapper.load))
+        wrapper.unload()
+        print(f"{name:<10} {cold:9.2f}s {min(warm):9.3f}s {inference:9.3f}s")
@@ -0,0 +1,202 @@
+"""
+Numerical parity and latency of the ONNX Runtime backend against eager PyTorch for
+Grounding DINO, SAM (encoder and decoder), DepthPro and Orient-Anything. Grounding DINO
+is checked for every prompt on every image resized to several aspect ratios. Exits with
+status 1 if any output differs by more than the tolerance.
+
+    python -m src.vision_module.onnx_export --output_dir onnx/
+    python -m benchmarks.bench_onnx_parity --onnx_dir onnx/ --images image1.jpg \
+        --prompts person "person,car" "red car,dog,traffic light"
+"""
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from benchmarks.common import load_images, print_row, timeit
+from src.vision_module.depthpro_model import DepthProModelWrapper
+from src.vision_module.grounding_dino_model import GroundingDINOModelWrapper
+from src.vision_module.orient_anything.inference import predict_from_pixels
+from src.vision_module.orient_anything_model import OrientAnythingModelWrapper
+from src.vision_module.sam_model import SAMModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="ONNX Runtime parity benchmark.")
+    parser.add_argument("--onnx_dir", type=str, required=True)
+    parser.add_argument("--images", nargs="+", default=["image1.jpg"])
+    parser.add_argument(
+        "--prompts",
+        nargs="+",
+        default=["person", "object,person", "red car,dog,traffic light"],
+        help="Comma-separated object lists, every one is checked on every image.",
+    )
+    parser.add_argument(
+        "--aspect_ratios",
+        nargs="+",
+        type=float,
+        default=[4 / 3, 3 / 4, 1.0, 2.5, 0.4],
+        help="Width / height ratios images are resized to (same pixel count).",
+    )
+    parser.add_argument("--onnx_threads", type=int, default=None)
+    parser.add_argument("--atol", type=float, default=1e-3)
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def both(cls, args, **kwargs):
+    """Loaded (torch, onnx) variants of a wrapper on cpu."""
+    eager = cls(device="cpu", **kwargs)
+    onnx = cls(
+        device="cpu",
+        backend="onnx",
+        onnx_dir=args.onnx_dir,
+        onnx_threads=args.onnx_threads,
+        **kwargs,
+    )
+    eager.load()
+    onnx.load()
+    return eager, onnx
+
+
+def check(name: str, expected: torch.Tensor, actual: torch.Tensor, args) -> bool:
+    expected, actual = expected.float().cpu(), actual.float().cpu()
+    diff = (expected - actual).abs().max().item() if expected.numel() else 0.0
+    ok = expected.shape == actual.shape and torch.allclose(
+        expected, actual, atol=args.atol, rtol=args.rtol
+    )
+    print(f"{name:<28} max abs diff={diff:.2e} {'OK' if ok else 'MISMATCH'}")
+    return ok
+
+
+def resized(img, aspect_ratio: float):
+    area = img.width * img.height
+    width = round((area * aspect_ratio) ** 0.5)
+    return img.resize((width, round(area / width)))
+
+
+def latency(name: str, eager_fn, onnx_fn, n: int, args):
+    t_eager = timeit(eager_fn, repeat=args.repeat)
+    t_onnx = timeit(onnx_fn, repeat=args.repeat)
+    print_row(f"{name} torch", t_eager, n)
+    print_row(f"{name} onnx", t_onnx, n)
+    print(f"{name} onnx speedup: {t_eager / t_onnx:.2f}x")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    images = load_images(args.images)
+    ok = True
+
+    eager, onnx = both(GroundingDINOModelWrapper, args)
+    prompts = [prompt.split(",") for prompt in args.prompts]
+    for i, img in enumerate(images):
+        for ratio in args.aspect_ratios:
+            variant = resized(img, ratio)
+            for objects in prompts:
+                name = f"dino[{i}] {ratio:.2f} {len(objects)} obj"
+                inputs = eager.preprocess(variant, objects)
+                # same padded canvas and text as the graph gets
+                graph_inputs = onnx.model.graph_inputs(inputs)
+                with torch.no_grad():
+                    expected = eager.model(
+                        **{
+                            key: graph_inputs[key]
+                            for key in (
+                                "pixel_values",
+                                "pixel_mask",
+                                "input_ids",
+                                "attention_mask",
+                                "token_type_ids",
+                            )
+                        }
+                    )
+                actual = onnx.model(**inputs)
+                ok &= check(f"{name} logits", expected.logits, actual.logits, args)
+                ok &= check(f"{name} boxes", expected.pred_boxes, actual.pred_boxes, args)
+                # end to end, against the unpadded torch input
+                if eager.detect(variant, objects)[1] != onnx.detect(variant, objects)[1]:
+                    print(f"{name} detected labels differ")
+    objects = prompts[0]
+    boxes = [eager.detect(img, objects)[0] for img in images]
+    latency(
+        "dino",
+        lambda: [eager.detect(img, objects) for img in images],
+        lambda: [onnx.detect(img, objects) for img in images],
+        len(images),
+        args,
+    )
+    eager.unload()
+    onnx.unload()
+
+    eager, onnx = both(SAMModelWrapper, args, embedding_cache_bytes=0)
+    for i, img in enumerate(images):
+        pixel_values = eager.preprocess(img).pixel_values
+        with torch.no_grad():
+            expected = eager.model.get_image_embeddings(pixel_values)
+        actual = onnx.model.get_image_embeddings(pixel_values)
+        ok &= check(f"sam[{i}] image_embeddings", expected, actual, args)
+        if len(boxes[i]):
+            # binarized masks may flip at object borders, compare fraction of pixels
+            differ = (eager.get_masks(img, boxes[i]) != onnx.get_masks(img, boxes[i]))
+            fraction = differ.float().mean().item()
+            print(f"sam[{i}] masks differing pixels={fraction:.2e}")
+            ok &= fraction <= args.atol
+    latency(
+        "sam",
+        lambda: [eager.get_masks(img, b) for img, b in zip(images, boxes)],
+        lambda: [onnx.get_masks(img, b) for img, b in zip(images, boxes)],
+        len(images),
+        args,
+    )
+    eager.unload()
+    onnx.unload()
+
+    eager, onnx = both(DepthProModelWrapper, args)
+    for i, img in enumerate(images):
+        depth_e, focal_e = eager._run_model(img)
+        depth_o, focal_o = onnx._run_model(img)
+        ok &= check(
+            f"depth[{i}] depth", torch.from_numpy(depth_e), torch.from_numpy(depth_o), args
+        )
+        ok &= check(f"depth[{i}] focal", torch.tensor(focal_e), torch.tensor(focal_o), args)
+    latency(
+        "depth",
+        lambda: [eager._run_model(img) for img in images],
+        lambda: [onnx._run_model(img) for img in images],
+        len(images),
+        args,
+    )
+    eager.unload()
+    onnx.unload()
+
+    eager, onnx = both(OrientAnythingModelWrapper, args)
+    pixel_values = eager.preprocess(images, boxes)
+    if len(pixel_values):
+        expected = predict_from_pixels(pixel_values, eager.dino_mlp, "cpu")
+        actual = predict_from_pixels(pixel_values, onnx.dino_mlp, "cpu")
+        ok &= check("orient logits", expected, actual, args)
+        same = np.mean(
+            [
+                np.array_equal(a, b)
+                for a, b in zip(
+                    eager.estimate_orientation_batch(images, boxes),
+                    onnx.estimate_orientation_batch(images, boxes),
+                )
+            ]
+        )
+        print(f"orient images with identical angles: {same:.2%}")
+    latency(
+        "orient",
+        lambda: eager.estimate_orientation_batch(images, boxes),
+        lambda: onnx.estimate_orientation_batch(images, boxes),
+        len(images),
+        args,
+    )
+    eager.unload()
+    onnx.unload()
+
+    print("parity OK" if ok else "parity FAILED")
+    sys.exit(0 if ok else 1)
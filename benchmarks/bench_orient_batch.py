@@ -0,0 +1,60 @@
+"""
+Crops per second of Orient-Anything: per-crop `get_3angle` loop vs one batched call
+(`get_3angle_batch`). Runs on CPU by default.
+
+    python -m benchmarks.bench_orient_batch --image image1.jpg --crops 16
+"""
+import argparse
+import random
+
+import torch
+
+from benchmarks.common import load_images, print_row, timeit
+from src.vision_module.orient_anything.inference import get_3angle, get_3angle_batch
+from src.vision_module.orient_anything_model import OrientAnythingModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Orient-Anything batching benchmark.")
+    parser.add_argument("--image", type=str, default="image1.jpg")
+    parser.add_argument("--crops", type=int, default=16)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def random_boxes(img, n, seed=0):
+    rng = random.Random(seed)
+    w, h = img.size
+    boxes = []
+    for _ in range(n):
+        x0, y0 = rng.randint(0, w // 2), rng.randint(0, h // 2)
+        boxes.append((x0, y0, rng.randint(x0 + 32, w), rng.randint(y0 + 32, h)))
+    return boxes
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    img = load_images([args.image])[0]
+    crops = [img.crop(box) for box in random_boxes(img, args.crops)]
+
+    orient = OrientAnythingModelWrapper(device=args.device, max_batch_size=args.max_batch_size)
+    orient.load()
+    model, processor = orient.dino_mlp, orient.processor
+
+    loop = torch.stack([get_3angle(c, model, processor, args.device) for c in crops])
+    batch = get_3angle_batch(crops, model, processor, args.device, args.max_batch_size)
+    print(f"max abs difference of angles: {(loop - batch).abs().max().item():.4f}")
+
+    t_loop = timeit(
+        lambda: [get_3angle(c, model, processor, args.device) for c in crops],
+        repeat=args.repeat,
+    )
+    t_batch = timeit(
+        lambda: get_3angle_batch(crops, model, processor, args.device, args.max_batch_size),
+        repeat=args.repeat,
+    )
+    print_row("get_3angle loop", t_loop, len(crops), unit="crop")
+    print_row(f"get_3angle_batch (mb={args.max_batch_size})", t_batch, len(crops), unit="crop")
+    print(f"speedup: {t_loop / t_batch:.2f}x")
@@ -0,0 +1,74 @@
+"""
+Startup time and peak host memory of Orient-Anything loading: previous path (pretrained
+DINOv2 backbone, then overwritten by `load_state_dict`) vs current
+`OrientAnythingModelWrapper.load` (backbone from config, memory-mapped checkpoint).
+Every mode runs in a fresh subprocess so peak RSS is measured independently.
+
+    python -m benchmarks.bench_orient_load
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Orient-Anything load benchmark.")
+    parser.add_argument("--mode", choices=["legacy", "current"], default=None)
+    parser.add_argument("--device", type=str, default="cpu")
+    return parser.parse_args()
+
+
+def load_legacy(device):
+    from huggingface_hub import hf_hub_download
+    from transformers import AutoImageProcessor
+
+    from src.vision_module.orient_anything.vision_tower import DINOv2_MLP
+
+    weight_path = hf_hub_download(
+        repo_id="Viglong/Orient-Anything",
+        filename="croplargeEX2/dino_weight.pt",
+        cache_dir=os.getcwd(),
+        repo_type="model",
+    )
+    model = DINOv2_MLP(
+        dino_mode="large",
+        in_dim=1024,
+        out_dim=360 + 180 + 180 + 2,
+        evaluate=True,
+        mask_dino=False,
+        frozen_back=False,
+    )
+    model.load_state_dict(torch.load(weight_path, map_location="cpu"))
+    model.to(device).eval()
+    AutoImageProcessor.from_pretrained("facebook/dinov2-large", cache_dir=os.getcwd())
+
+
+def load_current(device):
+    from src.vision_module.orient_anything_model import OrientAnythingModelWrapper
+
+    OrientAnythingModelWrapper(device=device).load()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.mode is None:
+        # downloads happen here once, so that timings below do not include them
+        load_current("cpu")
+        for mode in ["legacy", "current"]:
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_orient_load", "--mode", mode,
+                 "--device", args.device],
+                check=True,
+            )
+        sys.exit(0)
+
+    start = time.perf_counter()
+    (load_legacy if args.mode == "legacy" else load_current)(args.device)
+    seconds = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{args.mode:<8} load time {seconds:6.2f}s  peak RSS {peak_mb:8.0f} MB")
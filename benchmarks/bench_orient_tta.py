@@ -0,0 +1,73 @@
+"""
+Orient-Anything test-time augmentation: per-object `get_3angle_infer_aug` (PIL crops,
+1-D outlier rejection per angle) vs wrapper TTA mode (tensor crops of all objects,
+one batched forward, batched outlier rejection). Also checks that batched reducers
+match the 1-D ones.
+
+    python -m benchmarks.bench_orient_tta --image image1.jpg --objects 8 --tta_crops 6
+"""
+import argparse
+
+import torch
+
+from benchmarks.bench_orient_batch import random_boxes
+from benchmarks.common import load_images, print_row, timeit
+from src.vision_module.orient_anything.inference import get_3angle_infer_aug
+from src.vision_module.orient_anything.utils import (
+    remove_outliers_and_average,
+    remove_outliers_and_average_batch,
+    remove_outliers_and_average_circular,
+    remove_outliers_and_average_circular_batch,
+)
+from src.vision_module.orient_anything_model import OrientAnythingModelWrapper
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Orient-Anything TTA benchmark.")
+    parser.add_argument("--image", type=str, default="image1.jpg")
+    parser.add_argument("--objects", type=int, default=8)
+    parser.add_argument("--tta_crops", type=int, default=6)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def check_reducers(rows=1000, crops=6, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    values = torch.randint(0, 360, (rows, crops), generator=g).float()
+    linear = torch.tensor([remove_outliers_and_average(v) for v in values])
+    circular = torch.stack([remove_outliers_and_average_circular(v) for v in values])
+    circular_diff = (circular - remove_outliers_and_average_circular_batch(values)).abs()
+    print(
+        "max abs difference of reducers: "
+        f"linear={(linear - remove_outliers_and_average_batch(values)).abs().max().item():.2e}, "
+        f"circular={torch.minimum(circular_diff, 360 - circular_diff).max().item():.2e}"
+    )
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    check_reducers(crops=args.tta_crops)
+
+    img = load_images([args.image])[0]
+    boxes = random_boxes(img, args.objects)
+    crops = [img.crop(box) for box in boxes]
+
+    orient = OrientAnythingModelWrapper(device=args.device, tta_crops=args.tta_crops, tta_seed=0)
+    orient.load()
+    model, processor = orient.dino_mlp, orient.processor
+
+    # legacy TTA takes `num=3` crops of the image and of its background-free version
+    t_loop = timeit(
+        lambda: [get_3angle_infer_aug(c, c, model, processor, args.device) for c in crops],
+        repeat=args.repeat,
+    )
+    t_batch = timeit(lambda: orient.estimate_orientation(img, boxes), repeat=args.repeat)
+    orient.tta_crops = 0
+    t_plain = timeit(lambda: orient.estimate_orientation(img, boxes), repeat=args.repeat)
+    orient.tta_crops = args.tta_crops
+    print_row("get_3angle_infer_aug loop (6 crops)", t_loop, len(crops), unit="object")
+    print_row(f"wrapper TTA ({args.tta_crops} crops)", t_batch, len(crops), unit="object")
+    print_row("wrapper without TTA", t_plain, len(crops), unit="object")
+    print(f"TTA speedup over loop: {t_loop / t_batch:.2f}x")
+
@@ -0,0 +1,72 @@
+"""
+Box-limited `estimate_positions` vs the previous full-frame NumPy loop
+on synthetic masks. Prints timings and max difference of resulting positions.
+
+    python -m benchmarks.bench_positions --height 3000 --width 4000 --objects 12
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.common import print_row, timeit
+from src.vision_module.positions import estimate_positions, image_to_camera_coords
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="3D position estimation benchmark.")
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--objects", type=int, default=12)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def synthetic_scene(h, w, n, seed=0):
+    """Elliptic masks inside random boxes and a smooth depth map."""
+    rng = np.random.default_rng(seed)
+    masks = torch.zeros((n, h, w), dtype=torch.bool)
+    boxes = []
+    yy, xx = np.mgrid[0:h, 0:w]
+    for i in range(n):
+        bw, bh = rng.integers(w // 20, w // 3), rng.integers(h // 20, h // 3)
+        x0, y0 = rng.uniform(0, w - bw), rng.uniform(0, h - bh)
+        cx, cy = x0 + bw / 2, y0 + bh / 2
+        ellipse = ((xx - cx) / (bw / 2)) ** 2 + ((yy - cy) / (bh / 2)) ** 2 <= 1
+        masks[i] = torch.from_numpy(ellipse)
+        boxes.append([x0, y0, x0 + bw, y0 + bh])
+    depth_map = (1 + xx / w + yy / h + rng.normal(0, 0.01, (h, w))).astype(np.float32)
+    return masks, boxes, depth_map
+
+
+def positions_full_frame(masks, depth_map, focal_length, img_size):
+    """Previous implementation from ExternalVisionModule.abstract_scene."""
+    positions = []
+    w, h = img_size
+    for m in masks.cpu().numpy():
+        ys, xs = np.nonzero(m)
+        x_pixel, y_pixel = np.median(xs), np.median(ys)
+        z_depth = np.median(depth_map[m.astype(bool)])
+        X_cam, Y_cam = image_to_camera_coords(x_pixel, y_pixel, z_depth, focal_length, w, h)
+        positions.append((float(Y_cam), float(X_cam), float(-z_depth)))
+    return np.asarray(positions)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    masks, boxes, depth_map = synthetic_scene(args.height, args.width, args.objects)
+    img_size, focal_length = (args.width, args.height), 1000.0
+
+    old = positions_full_frame(masks, depth_map, focal_length, img_size)
+    new = estimate_positions(masks, boxes, depth_map, focal_length, img_size, device=args.device)
+    print(f"max abs difference: {np.abs(old - new).max():.2e}")
+
+    t_old = timeit(lambda: positions_full_frame(masks, depth_map, focal_length, img_size), args.repeat)
+    t_new = timeit(
+        lambda: estimate_positions(masks, boxes, depth_map, focal_length, img_size, device=args.device),
+        args.repeat,
+    )
+    print_row("full-frame loop", t_old, args.objects, unit="obj")
+    print_row(f"estimate_positions ({args.device})", t_new, args.objects, unit="obj")
+    print(f"speedup: {t_old / t_new:.2f}x")
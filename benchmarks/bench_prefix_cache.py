@@ -0,0 +1,67 @@
+"""
+Time to first token of the text-only Qwen prompts with and without prefix KV-cache
+reuse (static instruction block of every template prefilled once), and fraction of
+identical full answers.
+
+    python -m benchmarks.bench_prefix_cache --num_questions 20
+"""
+import argparse
+
+import torch
+
+from benchmarks.bench_qwen_batch import timed
+from benchmarks.bench_query_planning import dataset_questions
+from src.qwen_wrapper import QwenWrapper
+from src.utils.constants import QWEN_MODEL
+from src.utils.prompts import (
+    EGOCENTRIC_REPHRASING_TEMPLATE,
+    EXTRACT_OBJECTS_TEMPLATE,
+    PERSPECTIVE_CHANGE_TEMPLATE,
+    QUERY_PLAN_TEMPLATE,
+    static_prefix,
+)
+
+TEMPLATES = {
+    "extract_objects": EXTRACT_OBJECTS_TEMPLATE,
+    "perspective_change": PERSPECTIVE_CHANGE_TEMPLATE,
+    "egocentric_rephrasing": EGOCENTRIC_REPHRASING_TEMPLATE,
+    "query_plan": QUERY_PLAN_TEMPLATE,
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Prefix KV-cache reuse benchmark.")
+    parser.add_argument("--num_questions", type=int, default=20)
+    parser.add_argument("--log_file", type=str, default="bench_prefix_cache.log")
+    return parser.parse_args()
+
+
+def conversation(text: str) -> list:
+    return [{"role": "user", "content": [{"type": "text", "text": text}]}]
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    qwen = QwenWrapper(QWEN_MODEL, log_file=args.log_file, device=device, max_batch_size=1)
+    qwen.load()
+    questions = dataset_questions(args.num_questions)
+
+    for name, template in TEMPLATES.items():
+        prefix = static_prefix(template)
+        prompts = [
+            conversation(template.format(question=q, options=["camera"])) for q in questions
+        ]
+        results = {}
+        for reuse in (False, True):
+            qwen.prefix_cache = reuse
+            # warm-up; with reuse it also fills the prefix cache once
+            qwen.generate_batch(prompts[:1], prefix=prefix, max_new_tokens=1)
+            ttft = sum(
+                timed(lambda: qwen.generate_batch([p], prefix=prefix, max_new_tokens=1))[1]
+                for p in prompts
+            )
+            results[reuse] = qwen.generate_batch(prompts, prefix=prefix)
+            print(f"{name:<24} reuse={reuse!s:<5} TTFT {ttft / len(prompts) * 1000:8.1f} ms")
+        same = sum(a == b for a, b in zip(results[False], results[True])) / len(prompts)
+        print(f"{name:<24} identical answers: {same:.2%}")
@@ -0,0 +1,89 @@
+"""
+Fused single-call query planning vs the three separate Qwen calls (objects,
+egocentric rephrasing, perspective): latency per question, parse failures of the
+fused JSON and agreement of its fields with the three-call results.
+
+    python -m benchmarks.bench_query_planning --num_questions 50
+    python -m benchmarks.bench_query_planning --questions "from the dog's perspective, is the car on the left?"
+"""
+import argparse
+import time
+
+import torch
+
+from src.qwen_extended import QwenExtended
+from src.utils.constants import QWEN_MODEL
+from src.vision_module.external_vision_model import ExternalVisionModule
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Query planning benchmark.")
+    parser.add_argument("--questions", nargs="+", default=None)
+    parser.add_argument(
+        "--num_questions",
+        type=int,
+        default=50,
+        help="Questions taken from Isle-Brick-V1 when --questions is not given.",
+    )
+    parser.add_argument("--output_folder", type=str, default="output/bench_query_planning")
+    return parser.parse_args()
+
+
+def dataset_questions(n: int) -> list:
+    from datasets import load_dataset
+
+    ds = load_dataset("Gracjan/Isle", "Isle-Brick-V1")
+    return [record["prompt"].lower() for record in ds["test"].select(range(n))]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def three_calls(vlm: QwenExtended, question: str) -> dict:
+    objects = vlm.extract_objects_from_question(question)
+    return {
+        "objects": objects,
+        "egocentric_question": vlm.rephrase_to_egocentric(question),
+        "perspective": vlm.find_perspective(question=question, options=objects),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    questions = args.questions or dataset_questions(args.num_questions)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    vlm = QwenExtended(
+        vlm_path=QWEN_MODEL,
+        external_vision_module=ExternalVisionModule(device="cpu"),
+        renderer_module=None,
+        output_folder=args.output_folder,
+        device=device,
+    )
+    # first generation pays for kernel selection / allocation
+    vlm.plan_question(questions[0])
+
+    t_three, t_fused, failures = 0.0, 0.0, 0
+    same = {"objects": 0, "perspective": 0, "egocentric_question": 0}
+    for question in questions:
+        reference, seconds = timed(lambda: three_calls(vlm, question))
+        t_three += seconds
+        plan, seconds = timed(lambda: vlm.plan_question(question))
+        t_fused += seconds
+        if plan is None:
+            failures += 1
+            continue
+        same["objects"] += sorted(plan["objects"]) == sorted(reference["objects"])
+        for key in ("perspective", "egocentric_question"):
+            same[key] += plan[key].strip().lower() == reference[key].strip().lower()
+
+    n = len(questions)
+    print(f"{n} questions")
+    print(f"three calls: {t_three / n * 1000:8.1f} ms/question")
+    print(f"fused:       {t_fused / n * 1000:8.1f} ms/question ({t_three / t_fused:.2f}x)")
+    print(f"fused parse failures (fall back to three calls): {failures}/{n}")
+    parsed = max(n - failures, 1)
+    for key, count in same.items():
+        print(f"agreement {key:<20} {count / parsed:.2%}")
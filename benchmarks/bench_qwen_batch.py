@@ -0,0 +1,63 @@
+"""
+Sequential `QwenWrapper.generate` vs batched `generate_batch` on the object-extraction
+prompts of dataset questions: throughput and fraction of identical answers (greedy
+decoding of padded batches can differ in rare near-ties).
+
+    python -m benchmarks.bench_qwen_batch --num_questions 32 --batch_sizes 1 4 8 16
+"""
+import argparse
+import time
+
+import torch
+
+from benchmarks.bench_query_planning import dataset_questions
+from benchmarks.common import print_row
+from src.qwen_wrapper import QwenWrapper
+from src.utils.constants import QWEN_MODEL
+from src.utils.prompts import EXTRACT_OBJECTS_TEMPLATE
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Batched Qwen generation benchmark.")
+    parser.add_argument("--num_questions", type=int, default=32)
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[4, 8, 16])
+    parser.add_argument("--log_file", type=str, default="bench_qwen_batch.log")
+    return parser.parse_args()
+
+
+def timed(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    qwen = QwenWrapper(QWEN_MODEL, log_file=args.log_file, device=device)
+    qwen.load()
+    conversations = [
+        [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": EXTRACT_OBJECTS_TEMPLATE.format(question=q)}
+                ],
+            }
+        ]
+        for q in dataset_questions(args.num_questions)
+    ]
+    qwen.generate(conversations[0])
+
+    sequential, seconds = timed(lambda: [qwen.generate(c)[0] for c in conversations])
+    print_row("sequential", seconds, len(conversations), unit="prompt")
+    for batch_size in args.batch_sizes:
+        qwen.max_batch_size = batch_size
+        batched, seconds = timed(lambda: qwen.generate_batch(conversations))
+        same = sum(a == b for a, b in zip(sequential, batched)) / len(conversations)
+        print_row(f"batch {batch_size}", seconds, len(conversations), unit="prompt")
+        print(f"{'':<28} identical answers: {same:.2%}")
@@ -0,0 +1,72 @@
+"""
+Image questions answered by Qwen with and without the visual-embedding cache (vision
+encoder once per unique image): time per question, hit rate and fraction of
+identical answers. Several questions are asked about every image, as in the datasets.
+
+    python -m benchmarks.bench_qwen_vision_cache --images image1.jpg --questions_per_image 4
+"""
+import argparse
+
+import torch
+
+from benchmarks.bench_qwen_batch import timed
+from benchmarks.common import load_images, print_row
+from src.qwen_wrapper import QwenWrapper
+from src.utils.constants import QWEN_MODEL
+
+QUESTIONS = [
+    "How many people are in the image?",
+    "What is on the left side of the image?",
+    "Which object is closest to the camera?",
+    "Describe the scene in one sentence.",
+    "What color is the largest object?",
+    "Is there anything behind the main object?",
+]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Qwen visual-embedding cache benchmark.")
+    parser.add_argument("--images", nargs="+", default=["image1.jpg"])
+    parser.add_argument("--questions_per_image", type=int, default=4)
+    parser.add_argument("--log_file", type=str, default="bench_qwen_vision_cache.log")
+    return parser.parse_args()
+
+
+def conversation(img, question: str) -> list:
+    return [
+        {
+            "role": "user",
+            "content": [{"type": "image", "image": img}, {"type": "text", "text": question}],
+        }
+    ]
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    images = load_images(args.images)
+    conversations = [
+        conversation(img, QUESTIONS[i % len(QUESTIONS)])
+        for img in images
+        for i in range(args.questions_per_image)
+    ]
+
+    results = {}
+    for cached in (False, True):
+        qwen = QwenWrapper(
+            QWEN_MODEL,
+            log_file=args.log_file,
+            device=device,
+            max_batch_size=1,
+            vision_cache_bytes=0 if not cached else 2 * 1024**3,
+        )
+        qwen.load()
+        # warm-up on a text-only prompt, so the vision cache stays empty
+        qwen.generate([{"role": "user", "content": [{"type": "text", "text": "Hi"}]}])
+        results[cached], seconds = timed(lambda: [qwen.generate(c)[0] for c in conversations])
+        print_row(f"vision cache={cached}", seconds, len(conversations), unit="question")
+        if cached:
+            print(f"{'':<28} {qwen.cache_stats()}")
+        qwen.unload()
+    same = sum(a == b for a, b in zip(results[False], results[True])) / len(conversations)
+    print(f"identical answers: {same:.2%}")
@@ -0,0 +1,53 @@
+"""
+Memory of `SceneAbstraction` vs the previous dict results (full (N, H, W) masks,
+float64 arrays) on synthetic masks, size of the `.npz` file and encode / decode time.
+Checks that masks survive the round trip unchanged.
+
+    python -m benchmarks.bench_scene_abstraction --height 3000 --width 4000 --objects 12
+"""
+import argparse
+import io
+
+import numpy as np
+import torch
+
+from benchmarks.bench_positions import synthetic_scene
+from benchmarks.common import print_row, timeit
+from src.vision_module.positions import estimate_positions
+from src.vision_module.scene_abstraction import SceneAbstraction
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Scene abstraction size benchmark.")
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--objects", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    masks, boxes, depth_map = synthetic_scene(args.height, args.width, args.objects)
+    img_size = (args.width, args.height)
+    positions = estimate_positions(masks, boxes, depth_map, 1000.0, img_size)
+    orientations = np.random.default_rng(0).uniform(0, 360, (args.objects, 4))
+    labels = [f"object {i}" for i in range(args.objects)]
+
+    old_bytes = masks.numel() * masks.element_size() + positions.nbytes + orientations.nbytes
+    build = lambda: SceneAbstraction.from_results(
+        labels, boxes, positions, orientations, masks, img_size
+    )
+    scene = build()
+    buffer = io.BytesIO()
+    scene.save(buffer)
+    print(f"dict results:     {old_bytes / 2**20:10.2f} MiB")
+    print(f"SceneAbstraction: {scene.nbytes / 2**20:10.2f} MiB ({old_bytes / scene.nbytes:.0f}x smaller)")
+    print(f"npz file:         {buffer.tell() / 2**20:10.2f} MiB")
+
+    buffer.seek(0)
+    loaded = SceneAbstraction.load(buffer)
+    print(f"masks identical after save / load: {torch.equal(loaded.masks, masks)}")
+
+    print_row("encode", timeit(build, args.repeat), args.objects, unit="obj")
+    print_row("decode all masks", timeit(lambda: scene.masks, args.repeat), args.objects, unit="obj")
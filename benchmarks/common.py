@@ -0,0 +1,28 @@
+"""
+Small helpers shared by benchmark scripts. Run benchmarks from repository root, e.g.
+`python -m benchmarks.bench_grounding_dino --images image1.jpg`.
+"""
+import time
+from typing import Callable, List
+
+from PIL import Image
+
+
+def load_images(paths: List[str]) -> List[Image.Image]:
+    return [Image.open(p).convert("RGB") for p in paths]
+
+
+def timeit(fn: Callable, repeat: int = 3, warmup: int = 1) -> float:
+    """Return best wall time (seconds) of `fn()` over `repeat` runs."""
+    for _ in range(warmup):
+        fn()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def print_row(name: str, seconds: float, n_items: int, unit: str = "img"):
+    print(f"{name:<28} {seconds * 1000:10.1f} ms  {n_items / seconds:8.2f} {unit}/s")
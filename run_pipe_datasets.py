@@ -4,6 +4,9 @@ from src.utils.constants import PERSPECTIVE_TYPE
 from src.qwen_extended import QwenExtended
 from src.utils.constants import QWEN_MODEL
 from src.vision_module.external_vision_model import ExternalVisionModule
+from src.vision_module.inference_config import InferenceConfig
+from src.utils.model_manager import ModelManager
+from src.vision_module.orient_anything.utils import configure_rembg_pool
 from huggingface_hub import login
 from huggingface_hub.file_download import build_hf_headers
 from datasets import load_dataset
@@ -17,7 +20,201 @@ def parse_arguments():
     parser.add_argument(
         "--output_folder", type=str, default="output/", help="Path to save the output."
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--model_memory_budget_gb",
+        type=float,
+        default=None,
+        help="Keep models resident while they fit in this budget (GB), evicting LRU ones. "
+        "If not set, vision models are unloaded after every stage and Qwen stays loaded.",
+    )
+    parser.add_argument(
+        "--depth_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of persistent DepthPro cache (can be shared by workers). Disabled if not set.",
+    )
+    parser.add_argument(
+        "--scene_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of persistent scene-abstraction cache, so repeated questions "
+        "about an image skip the vision models. Disabled if not set.",
+    )
+    parser.add_argument(
+        "--scene_cache_gb",
+        type=float,
+        default=1,
+        help="Size of the scene cache (GB) above which least recently used scenes are removed.",
+    )
+    parser.add_argument(
+        "--incremental_detection",
+        action="store_true",
+        help="Keep objects found per image and run vision models only for objects "
+        "not asked about before; questions get the subset they mention.",
+    )
+    parser.add_argument(
+        "--image_record_gb",
+        type=float,
+        default=2,
+        help="Memory (GB) for per-image records of --incremental_detection.",
+    )
+    parser.add_argument(
+        "--vlm_batch_size",
+        type=int,
+        default=8,
+        help="Conversations per batched Qwen generation (length-sorted micro-batches).",
+    )
+    parser.add_argument(
+        "--prefix_cache",
+        action="store_true",
+        help="Reuse Qwen KV cache of the static instruction blocks of text-only prompts.",
+    )
+    parser.add_argument(
+        "--vlm_vision_cache_gb",
+        type=float,
+        default=0,
+        help="Memory (GB) for Qwen visual-token embeddings of seen images, 0 (default) "
+        "disables.",
+    )
+    parser.add_argument(
+        "--parse_cache",
+        type=str,
+        default=None,
+        help="SQLite file memoizing parsed text-only Qwen outputs across runs "
+        "(invalidate with `python -m src.utils.parse_cache`). Disabled if not set.",
+    )
+    parser.add_argument(
+        "--fused_planning",
+        action="store_true",
+        help="One JSON generation for objects, perspective and egocentric question "
+        "(falls back to three calls if the JSON cannot be parsed).",
+    )
+    parser.add_argument(
+        "--host_cache_gb",
+        type=float,
+        default=0,
+        help="Host RAM (GB) for weights of unloaded vision models, for fast swap-in. 0 disables it.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1,
+        help="Number of records processed together; vision models run stage-major over a chunk.",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Overlap CPU pre/post-processing with model inference inside a chunk.",
+    )
+    parser.add_argument(
+        "--pipeline_workers",
+        type=int,
+        default=2,
+        help="Threads per CPU stage in pipelined mode.",
+    )
+    parser.add_argument(
+        "--orient_tta_crops",
+        type=int,
+        default=0,
+        help="Augmented crops per object for Orient-Anything test-time augmentation (0 disables).",
+    )
+    parser.add_argument(
+        "--orient_remove_background",
+        action="store_true",
+        help="Remove background of object crops (rembg) before orientation estimation.",
+    )
+    parser.add_argument(
+        "--rembg_sessions",
+        type=int,
+        default=1,
+        help="Size of the shared rembg session pool.",
+    )
+    parser.add_argument(
+        "--vision_profile",
+        choices=["fp32", "int8"],
+        default="fp32",
+        help="Inference profile of vision models; int8 (dynamic quantization) is CPU only.",
+    )
+    parser.add_argument(
+        "--quantized_cache_dir",
+        type=str,
+        default=None,
+        help="Directory caching int8 weights of vision models.",
+    )
+    parser.add_argument(
+        "--vision_backend",
+        choices=["torch", "onnx"],
+        default="torch",
+        help="Run vision models in eager PyTorch or through ONNX Runtime.",
+    )
+    parser.add_argument(
+        "--onnx_dir",
+        type=str,
+        default=None,
+        help="Graphs written by `python -m src.vision_module.onnx_export`.",
+    )
+    parser.add_argument(
+        "--onnx_threads",
+        type=int,
+        default=None,
+        help="ONNX Runtime intra-op threads per session (runtime default if unset).",
+    )
+    parser.add_argument(
+        "--optimized_inference",
+        action="store_true",
+        help="inference_mode, channels_last and torch.compile for vision models "
+        "(needs --model_memory_budget_gb or --host_cache_gb to reuse compiled models).",
+    )
+    parser.add_argument(
+        "--depth_sparse",
+        action="store_true",
+        help="Keep DepthPro depth at model resolution and sample it only at object pixels.",
+    )
+    parser.add_argument(
+        "--depth_sparse_resolution",
+        type=int,
+        default=None,
+        help="Longer side of the kept depth map with --depth_sparse (model resolution if unset).",
+    )
+    args = parser.parse_args()
+    if (
+        args.optimized_inference
+        and args.model_memory_budget_gb is None
+        and args.host_cache_gb == 0
+    ):
+        # vision models would be reloaded, and compiled again, after every stage
+        parser.error(
+            "--optimized_inference needs --model_memory_budget_gb or --host_cache_gb "
+            "so that compiled models are reused"
+        )
+    return args
+
+
+def iter_chunks(iterable, size: int):
+    """Yield lists of at most `size` consecutive elements."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def answer_to_label(a: str):
+    a = a.lower()
+    if a == "yes":
+        return 1
+    elif a == "no":
+        return 0
+    return a
+
+
+def log_error(output_folder: str, idx: int, e: Exception):
+    error_message = f"Error processing record {idx}: {str(e)}"
+    with open(f"{output_folder}/errors.log", "a") as error_file:
+        error_file.write(error_message + "\n")
 
 
 if __name__ == "__main__":
@@ -31,41 +228,98 @@ if __name__ == "__main__":
 
     output_folder = args.output_folder
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    external_vision_m = ExternalVisionModule(device=device)
+    model_manager = (
+        ModelManager(memory_budget_gb=args.model_memory_budget_gb)
+        if args.model_memory_budget_gb is not None
+        else None
+    )
+    if args.orient_remove_background:
+        configure_rembg_pool(size=args.rembg_sessions)
+    # int8 profile runs vision models on CPU, Qwen keeps the accelerator
+    vision_device = torch.device("cpu") if args.vision_profile == "int8" else device
+    external_vision_m = ExternalVisionModule(
+        device=vision_device,
+        model_manager=model_manager,
+        depth_cache_dir=args.depth_cache_dir,
+        scene_cache_dir=args.scene_cache_dir,
+        scene_cache_max_bytes=int(args.scene_cache_gb * 1024**3),
+        incremental_detection=args.incremental_detection,
+        image_record_bytes=int(args.image_record_gb * 1024**3),
+        host_cache_gb=args.host_cache_gb,
+        pipelined=args.pipelined,
+        pipeline_workers=args.pipeline_workers,
+        orient_tta_crops=args.orient_tta_crops,
+        orient_remove_background=args.orient_remove_background,
+        profile=args.vision_profile,
+        quantized_cache_dir=args.quantized_cache_dir,
+        backend=args.vision_backend,
+        onnx_dir=args.onnx_dir,
+        onnx_threads=args.onnx_threads,
+        inference_config=InferenceConfig(optimized=args.optimized_inference),
+        depth_sparse=args.depth_sparse,
+        depth_sparse_resolution=args.depth_sparse_resolution,
+    )
+    if args.optimized_inference:
+        external_vision_m.warmup()
     vlm_extended = QwenExtended(
         vlm_path=QWEN_MODEL,
         external_vision_module=external_vision_m,
         renderer_module=None,
         output_folder=output_folder,
         device=device,
+        model_manager=model_manager,
+        fused_planning=args.fused_planning,
+        vlm_batch_size=args.vlm_batch_size,
+        prefix_cache=args.prefix_cache,
+        parse_cache_path=args.parse_cache,
+        vision_cache_bytes=int(args.vlm_vision_cache_gb * 1024**3),
     )
 
     results = {}
-    for idx, record in enumerate(ds["test"]):
-        try:
+    for chunk in iter_chunks(enumerate(ds["test"]), args.chunk_size):
+        indices, images, prompts, labels = [], [], [], []
+        for idx, record in chunk:
             image, prompt, label = record["image"], record["prompt"], record["label"]
             if image.mode != "RGB":
                 image = image.convert("RGB")
-            prompt = prompt.lower()
-            a = vlm_extended.ask_question_with_perspective(
-                prompt,
-                image,
+            indices.append(idx)
+            images.append(image)
+            prompts.append(prompt.lower())
+            labels.append(label)
+
+        try:
+            answers = vlm_extended.ask_questions_with_perspective(
+                prompts,
+                images,
                 perspective_type=PERSPECTIVE_TYPE.NUMERICAL,
-                save_intermediate_name=f"{idx}_{prompt}",
+                save_intermediate_names=[
+                    f"{idx}_{prompt}" for idx, prompt in zip(indices, prompts)
+                ],
             )
-
-            a = a.lower()
-            if a == "yes":
-                a = 1
-            elif a == "no":
-                a = 0
-
-            results[idx] = {"prompt": prompt, "label": label, "answer": a}
-
         except Exception as e:
-            error_message = f"Error processing record {idx}: {str(e)}"
-            with open(f"{output_folder}/errors.log", "a") as error_file:
-                error_file.write(error_message + "\n")
+            if len(indices) == 1:
+                log_error(output_folder, indices[0], e)
+                continue
+            # one bad record should not drop the whole chunk - retry one by one
+            answers = []
+            for idx, image, prompt in zip(indices, images, prompts):
+                try:
+                    answers.append(
+                        vlm_extended.ask_question_with_perspective(
+                            prompt,
+                            image,
+                            perspective_type=PERSPECTIVE_TYPE.NUMERICAL,
+                            save_intermediate_name=f"{idx}_{prompt}",
+                        )
+                    )
+                except Exception as e:
+                    log_error(output_folder, idx, e)
+                    answers.append(None)
+
+        for idx, prompt, label, a in zip(indices, prompts, labels, answers):
+            if a is None:
+                continue
+            results[idx] = {"prompt": prompt, "label": label, "answer": answer_to_label(a)}
 
     ## 2. count stats here
     correct_count = sum(1 for res in results.values() if res["answer"] == res["label"])
@@ -77,6 +331,21 @@ if __name__ == "__main__":
         stats_file.write(f"Correct count: {correct_count}\n")
         stats_file.write(f"Total count: {total_count}\n")
         stats_file.write(f"Accuracy: {accuracy}\n")
+        stats_file.write("Model loads:\n")
+        stats_file.write(external_vision_m.model_manager.summary() + "\n")
+        stats_file.write("Caches:\n")
+        for name, cache_stats in external_vision_m.cache_stats().items():
+            stats_file.write(f"{name}: {cache_stats}\n")
+        vlm_cache_stats = vlm_extended.vlm_model.cache_stats()
+        if vlm_cache_stats is not None:
+            stats_file.write(f"qwen_vision: {vlm_cache_stats}\n")
+        if vlm_extended.parse_cache is not None:
+            stats_file.write(f"parses: {vlm_extended.parse_cache.stats()}\n")
+        pipeline_stats = external_vision_m.pipeline_stats()
+        if pipeline_stats is not None:
+            stats_file.write("Pipeline stages:\n")
+            for name, stage_stats in pipeline_stats.items():
+                stats_file.write(f"{name}: {stage_stats}\n")
 
     output_path = f"{output_folder}/results.json"
     with open(output_path, "w") as f:
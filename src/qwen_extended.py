@@ -4,23 +4,30 @@ and renderer for advanced spatial reasoning tasks.
 It's main task is to answer spatial reasoning and vpt questions.
 """
 import os
-from typing import Optional
+import numpy as np
+from typing import Callable, List, Optional
 from PIL import Image
 from src.utils.prompts import (
     EXTRACT_OBJECTS_TEMPLATE,
     PERSPECTIVE_CHANGE_TEMPLATE,
     EGOCENTRIC_REPHRASING_TEMPLATE,
     PERSPECTIVE_PROMPT_TEMPLATE,
+    QUERY_PLAN_TEMPLATE,
+    static_prefix,
 )
-from src.qwen_wrapper import QwenWrapper
+from src.qwen_wrapper import VISION_CACHE_BYTES, QwenWrapper
 from src.vision_module.external_vision_model import ExternalVisionModule
+from src.vision_module.scene_abstraction import SceneAbstraction
 from src.render_module.renderer_module import Renderer
 from src.vlm_extended import VLMExtended
 
 from src.utils.constants import PERSPECTIVE_TYPE
 from src.utils.logger import setup_logger
+from src.utils.model_manager import ModelManager
+from src.utils.parse_cache import ParseCache
 from src.utils.utils import (
     llm_output_to_list,
+    parse_query_plan,
     get_labels_positions_without_central,
     change_points_basis,
 )
@@ -38,13 +45,33 @@ class QwenExtended(VLMExtended):
         renderer_module: Renderer,
         device: str,
         output_folder: str,
+        model_manager: Optional[ModelManager] = None,
+        fused_planning: bool = False,
+        vlm_batch_size: int = 8,
+        prefix_cache: bool = False,
+        parse_cache_path: Optional[str] = None,
+        vision_cache_bytes: int = VISION_CACHE_BYTES,
     ):
         """
         Args:
             vlm_model: The base visual language model instance.
             external_vision_model (ExternalVisionModel, optional): An external vision model instance.
+            model_manager (ModelManager, optional): if given, Qwen is loaded lazily and
+                shares memory budget with vision models. Otherwise it is loaded once here.
+            fused_planning (bool): get objects, perspective and egocentric question
+                from one JSON generation instead of three separate calls. Questions
+                whose JSON cannot be parsed fall back to the three calls.
+            vlm_batch_size (int): conversations in one batched Qwen generation
+            prefix_cache (bool): reuse KV cache of the static instruction blocks of
+                text-only templates, so only question-specific tokens are prefilled
+            parse_cache_path (str, optional): SQLite database memoizing parsed outputs
+                of text-only calls across runs and processes, None disables it
+            vision_cache_bytes (int): memory for Qwen visual-token embeddings of seen
+                images (vision encoder runs once per image), 0 (default) disables it
         """
         self.device = device
+        self.fused_planning = fused_planning
+        self.parse_cache = ParseCache(parse_cache_path) if parse_cache_path else None
         
         self.output_folder = output_folder
         if not os.path.exists(output_folder):
@@ -54,8 +81,17 @@ class QwenExtended(VLMExtended):
         self.logger = setup_logger(__name__, log_file)
 
         self.vlm_path = vlm_path
-        self.vlm_model = QwenWrapper(vlm_path, device=self.device, log_file=log_file)
-        self.vlm_model.load()
+        self.vlm_model = QwenWrapper(
+            vlm_path,
+            device=self.device,
+            log_file=log_file,
+            model_manager=model_manager,
+            max_batch_size=vlm_batch_size,
+            prefix_cache=prefix_cache,
+            vision_cache_bytes=vision_cache_bytes,
+        )
+        if model_manager is None:
+            self.vlm_model.load()
 
         # hold external modules
         self.external_vision_model = external_vision_module or ExternalVisionModule()
@@ -77,24 +113,102 @@ class QwenExtended(VLMExtended):
         Returns:
             str: vlm answer.
         """
-        # 1. get objects in interest
-        self.logger.info("------------------------------------------")
-        self.logger.info(f"Processing question: {question}")
-        objects = self.extract_objects_from_question(question)
-        self.logger.info(f"Objects extracted from question: {objects}")
+        return self.ask_questions_with_perspective(
+            questions=[question],
+            imgs=[img],
+            perspective_type=perspective_type,
+            save_intermediate_names=[save_intermediate_name],
+        )[0]
+
+    def ask_questions_with_perspective(
+        self,
+        questions: List[str],
+        imgs: List[Image.Image],
+        perspective_type: PERSPECTIVE_TYPE,
+        save_intermediate_names: Optional[List[Optional[str]]] = None,
+    ) -> List[str]:
+        """
+        Batched version of `ask_question_with_perspective`. Scene abstraction runs
+        stage-major over the whole batch, so every vision model is loaded once per batch,
+        and text-only Qwen calls of all questions run as batched generations.
+        Args:
+            questions (List[str]): input questions
+            imgs (List[PIL.Image]): input image for every question
+            perspective_type: NUMERICAL / VISUAL
+            save_intermediate_names (List[Optional[str]], optional): names of annotated images
+        Returns:
+            List[str]: vlm answers, in input order.
+        """
+        save_intermediate_names = save_intermediate_names or [None] * len(questions)
+        for question in questions:
+            self.logger.info("------------------------------------------")
+            self.logger.info(f"Processing question: {question}")
+        # 1. get objects in interest (one batched generation for all questions)
+        plans = (
+            self.plan_questions(questions)
+            if self.fused_planning
+            else [None] * len(questions)
+        )
+        unplanned = [i for i, plan in enumerate(plans) if plan is None]
+        extracted = dict(
+            zip(
+                unplanned,
+                self.extract_objects_from_questions([questions[i] for i in unplanned]),
+            )
+        )
+        objects_per_question = [
+            plan["objects"] if plan is not None else extracted[i]
+            for i, plan in enumerate(plans)
+        ]
+        for question, objects in zip(questions, objects_per_question):
+            self.logger.info(f"Objects extracted from question {question!r}: {objects}")
+
         # 2. process with external module
-        intermediate_save_path = os.path.join(self.output_folder, f"{save_intermediate_name}.png") if save_intermediate_name else None
-        scene = self.external_vision_model.abstract_scene(img=img, objects=objects, save_img_path=intermediate_save_path)
+        intermediate_save_paths = [
+            os.path.join(self.output_folder, f"{name}.png") if name else None
+            for name in save_intermediate_names
+        ]
+        scenes = self.external_vision_model.abstract_scenes(
+            images=imgs,
+            objects_per_image=objects_per_question,
+            save_img_paths=intermediate_save_paths,
+        )
 
+        # 3. convert questions to egocentric and 4. extract central perspectives
+        egocentric_questions = [plan["egocentric_question"] if plan else None for plan in plans]
+        central_perspectives = [plan["perspective"] if plan else None for plan in plans]
+        if unplanned:
+            rephrased = self.rephrase_to_egocentric_batch([questions[i] for i in unplanned])
+            perspectives = self.find_perspectives(
+                [questions[i] for i in unplanned],
+                [objects_per_question[i] for i in unplanned],
+            )
+            for i, egocentric, perspective in zip(unplanned, rephrased, perspectives):
+                egocentric_questions[i] = egocentric
+                central_perspectives[i] = perspective
+
+        return [
+            self._answer_with_scene(
+                question, img, scene, perspective_type, egocentric, perspective
+            )
+            for question, img, scene, egocentric, perspective in zip(
+                questions, imgs, scenes, egocentric_questions, central_perspectives
+            )
+        ]
+
+    def _answer_with_scene(
+        self,
+        question: str,
+        img: Image.Image,
+        scene: SceneAbstraction,
+        perspective_type: PERSPECTIVE_TYPE,
+        egocentric_question: str,
+        central_perspective: str,
+    ) -> str:
+        self.logger.info(f"Processing question: {question}")
         self.logger.info("Labels dino: %s", scene["labels"])
         self.logger.info(f"Scene abstraction finished")
-
-        # 3. convert question to egocentric
-        egocentric_question = self.rephrase_to_egocentric(question)
         self.logger.info(f"Egocentric question: {egocentric_question}")
-
-        # 4. extract central perspective
-        central_perspective = self.find_perspective(question=question, options=objects)
         self.logger.info(f"Central perspective detected: {central_perspective}")
         
         
@@ -108,31 +222,92 @@ class QwenExtended(VLMExtended):
         self.logger.info(f"Perspective prompt generated: {perspective_prompt}")
 
         # 5. ask final question with auxilary perspective prompt
-        tmp_img_path = os.path.join(self.output_folder, "_tmp.png")
-        img.save(tmp_img_path)
-        self.logger.info(f"Input image saved to temporary path: {tmp_img_path}")
-        message = {
+        message = self.answer_message(img, perspective_prompt)
+        # prompt = question + perspective_prompt
+        # 6. get answer
+        answer = self.vlm_model.generate(messages=[message])[0]
+        self.logger.info(f"Answer from VLM: {answer}")
+        return answer
+
+    @staticmethod
+    def answer_message(img: Image.Image, perspective_prompt: str) -> dict:
+        """
+        Final question message. The PIL image is handed to `process_vision_info`
+        directly, nothing is written to disk (safe for workers sharing output folder).
+        """
+        return {
             "role": "user",
             "content": [
                 {
                     "type": "image",
-                    "image": tmp_img_path,
+                    "image": img,
                 },
                 {
-                    
                     "type": "text",
                     "text": perspective_prompt,
                 },
             ],
         }
-        # Remove the temporary image file after saving the path
-        if os.path.exists(tmp_img_path):
-            os.remove(tmp_img_path)
-        # prompt = question + perspective_prompt
-        # 6. get answer
-        answer = self.vlm_model.generate(messages=[message])[0]
-        self.logger.info(f"Answer from VLM: {answer}")
-        return answer
+
+    def _generate_parsed(
+        self,
+        template: str,
+        arguments: List[dict],
+        parse: Optional[Callable[[str], object]] = None,
+    ) -> list:
+        """
+        Parsed answers of text-only prompts `template.format(**args)`. Prompts missing
+        from the parse cache run in one batched generation; parsed values other than
+        None are stored in the cache.
+        """
+        parse = parse or (lambda answer: answer)
+        results = [
+            self.parse_cache.get(self.vlm_path, template, args)
+            if self.parse_cache is not None
+            else None
+            for args in arguments
+        ]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        conversations = [
+            [
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": template.format(**arguments[i])}],
+                }
+            ]
+            for i in missing
+        ]
+        answers = self.vlm_model.generate_batch(conversations, prefix=static_prefix(template))
+        for i, answer in zip(missing, answers):
+            results[i] = parse(answer)
+            if self.parse_cache is not None and results[i] is not None:
+                self.parse_cache.put(self.vlm_path, template, arguments[i], results[i])
+        return results
+
+    def plan_question(self, question: str) -> Optional[dict]:
+        """
+        Objects, perspective and egocentric question in a single generation.
+        Args:
+            question (str): The input question.
+        Returns:
+            dict: "objects", "perspective" and "egocentric_question", or None if
+                  the answer is not valid JSON of that form.
+        """
+        return self.plan_questions([question])[0]
+
+    def plan_questions(self, questions: List[str]) -> List[Optional[dict]]:
+        """Batched `plan_question`."""
+        def parse(answer: str) -> Optional[dict]:
+            plan = parse_query_plan(answer)
+            if plan is None:
+                self.logger.warning(f"Fused planning output not parsed, using separate calls: {answer}")
+            return plan
+
+        return self._generate_parsed(
+            QUERY_PLAN_TEMPLATE, [{"question": question} for question in questions], parse
+        )
 
     def extract_objects_from_question(self, question):
         """
@@ -142,21 +317,19 @@ class QwenExtended(VLMExtended):
         Returns:
             list: List of extracted objects.
         """
-        message = {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": EXTRACT_OBJECTS_TEMPLATE.format(question=question),
-                },
-            ],
-        }
-        answer = self.vlm_model.generate(messages=[message])[0]
-        objects = llm_output_to_list(answer)
-        if objects is None:
+        return self.extract_objects_from_questions([question])[0]
+
+    def extract_objects_from_questions(self, questions: List[str]) -> List[list]:
+        """Batched `extract_objects_from_question`."""
+        objects_per_question = self._generate_parsed(
+            EXTRACT_OBJECTS_TEMPLATE,
+            [{"question": question} for question in questions],
+            llm_output_to_list,
+        )
+        if any(objects is None for objects in objects_per_question):
             self.logger.error("Failed to extract objects from question.")
             raise ValueError()
-        return objects
+        return objects_per_question
 
     def find_perspective(self, question: str, options: list) -> str:
         """
@@ -167,19 +340,17 @@ class QwenExtended(VLMExtended):
         Returns:
             str: The detected perspective.
         """
-        message = {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": PERSPECTIVE_CHANGE_TEMPLATE.format(
-                        question=question, options=options
-                    ),
-                },
+        return self.find_perspectives([question], [options])[0]
+
+    def find_perspectives(self, questions: List[str], options: List[list]) -> List[str]:
+        """Batched `find_perspective`."""
+        return self._generate_parsed(
+            PERSPECTIVE_CHANGE_TEMPLATE,
+            [
+                {"question": question, "options": opts}
+                for question, opts in zip(questions, options)
             ],
-        }
-        answer = self.vlm_model.generate(messages=[message])[0]
-        return answer
+        )
 
     def rephrase_to_egocentric(self, question) -> str:
         """
@@ -187,22 +358,19 @@ class QwenExtended(VLMExtended):
         Args:
             question (str): The input question.
         """
-        message = {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": EGOCENTRIC_REPHRASING_TEMPLATE.format(question=question),
-                },
-            ],
-        }
-        egocentric_question = self.vlm_model.generate(messages=[message])[0]
-        return egocentric_question
+        return self.rephrase_to_egocentric_batch([question])[0]
+
+    def rephrase_to_egocentric_batch(self, questions: List[str]) -> List[str]:
+        """Batched `rephrase_to_egocentric`."""
+        return self._generate_parsed(
+            EGOCENTRIC_REPHRASING_TEMPLATE,
+            [{"question": question} for question in questions],
+        )
 
     def generate_perspective_prompt(
         self,
         egocentric_question: str,
-        scene_abstraction: dict,
+        scene_abstraction: SceneAbstraction,
         central_perspective: str,
         perspective_type: PERSPECTIVE_TYPE,
     ):
@@ -216,20 +384,19 @@ class QwenExtended(VLMExtended):
         """
         # get labels and positions WITHOUT central_perspective object
         if central_perspective == "camera":
-            labels_remaining = scene_abstraction["labels"]
-            positions_egocentric_base = scene_abstraction["positions"]
+            labels_remaining = scene_abstraction.labels
+            # scenes store float32, round in float64 so the prompt gets short numbers
+            positions_egocentric_base = scene_abstraction.positions.astype(np.float64)
         else:
             labels_remaining, positions_remaining = get_labels_positions_without_central(
                 results=scene_abstraction, central_perspective=central_perspective
             )
             # extract index for central perspective object
-            index_central_perspective = scene_abstraction["labels"].index(
-                central_perspective
-            )
+            index_central_perspective = scene_abstraction.index(central_perspective)
         
             translation, euler_angles = (
-                scene_abstraction["positions"][index_central_perspective],
-                scene_abstraction["orientations"][index_central_perspective, :3],
+                scene_abstraction.positions[index_central_perspective],
+                scene_abstraction.orientations[index_central_perspective, :3],
             )
 
             # change basis of remaining points using central perspective as base
@@ -1,16 +1,67 @@
-import gc
+import copy
+import threading
 import torch
-from typing import Optional
+from contextlib import contextmanager, nullcontext
+from typing import List, Optional
 
 from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
 from qwen_vl_utils import process_vision_info
+from src.utils.cache import LRUByteCache, image_hash
 from src.utils.logger import setup_logger
+from src.utils.model_manager import ModelManager, module_nbytes, release_device_memory
+
+
+DEFAULT_GEN_KWARGS = {"max_new_tokens": 128}
+# visual tokens per image patch area after 2x2 merging (14 px patches)
+IMAGE_TOKEN_PIXELS = 28 * 28
+# visual-token embedding cache is opt-in, see `_cached_visual`
+VISION_CACHE_BYTES = 0
+# greedy tokens compared between prefix-cached and plain generation before the prefix
+# cache is used with a loaded model
+PREFIX_CHECK_TOKENS = 16
 
 
 class QwenWrapper:
-    def __init__(self, model_name: str, log_file: str, device: str = "cuda"):
+    def __init__(
+        self,
+        model_name: str,
+        log_file: str,
+        device: str = "cuda",
+        model_manager: Optional[ModelManager] = None,
+        max_batch_size: int = 8,
+        prefix_cache: bool = False,
+        vision_cache_bytes: int = VISION_CACHE_BYTES,
+    ):
+        """
+        Args:
+            model_name (str): Qwen2.5-VL checkpoint
+            log_file (str): log file path
+            device (str): device to run the model on
+            model_manager (ModelManager, optional): loads the model lazily under its budget
+            max_batch_size (int): conversations in one `model.generate` call of
+                `generate_batch`
+            prefix_cache (bool): keep KV cache of static prompt prefixes passed as
+                `prefix` to `generate_batch` (once per loaded model), so that only the
+                rest of text-only prompts is prefilled
+            vision_cache_bytes (int): size cap of the LRU cache of visual-token
+                embeddings (kept on CPU, survive unloading), so the vision encoder runs
+                once per unique image; 0 (default) disables it
+        """
         self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        # chat-formatted prefix -> (token ids, KV cache)
+        self._prefix_caches = {}
+        # result of the prefix cache check for the loaded model, None until checked
+        self._prefix_verified: Optional[bool] = None
+        # (image hash, processor resolution settings) -> (visual embeddings, grid_thw)
+        self.vision_cache = (
+            LRUByteCache(max_bytes=vision_cache_bytes) if vision_cache_bytes > 0 else None
+        )
+        # generation running the vision tower waits while it serves cached embeddings
+        self._visual_lock = threading.Lock()
         self.device = device
+        self.model_manager = model_manager
         self.model: Optional[Qwen2_5_VLForConditionalGeneration] = None
         self.processor: Optional[AutoProcessor] = None
         self.logger = setup_logger(__name__, log_file)
@@ -18,6 +69,8 @@ class QwenWrapper:
     def load(self):
         """Load model and tokenizer to the specified device."""
         self.processor = AutoProcessor.from_pretrained(self.model_name)
+        # decoder-only batches must be padded on the left, generation appends on the right
+        self.processor.tokenizer.padding_side = "left"
         self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
             self.model_name,
             torch_dtype=torch.bfloat16,
@@ -34,38 +87,335 @@ class QwenWrapper:
             self.model.to("cpu")
             del self.model
             self.model = None
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            self._prefix_caches.clear()
+            self._prefix_verified = None
+            release_device_memory()
             self.logger.info("Model unloaded from GPU.")
 
+    def memory_footprint(self) -> int:
+        return module_nbytes(self.model)
+
+    def cache_stats(self) -> Optional[dict]:
+        """Hit / miss statistics of the visual-embedding cache, None if disabled."""
+        return self.vision_cache.stats() if self.vision_cache is not None else None
+
+    def _residency(self):
+        # with model manager, model is loaded lazily (and may be evicted by vision models)
+        return (
+            self.model_manager.use("qwen", self)
+            if self.model_manager is not None
+            else nullcontext()
+        )
+
     def generate(self, messages: list, **gen_kwargs):
         """Generate text from a prompt."""
+        with self._residency():
+            return self._generate_batch([messages], **gen_kwargs)
+
+    def generate_batch(
+        self, conversations: List[list], prefix: Optional[str] = None, **gen_kwargs
+    ) -> List[str]:
+        """
+        Generate answers of many conversations (text-only and image+text can be mixed).
+        Conversations are sorted by prompt length and run in left-padded micro-batches
+        of at most `max_batch_size`, so similar lengths share a batch.
+        Args:
+            conversations (List[list]): list of messages of every conversation
+            prefix (str, optional): static beginning of the user text shared by the
+                conversations (e.g. instruction block of a template). With
+                `prefix_cache` enabled, text-only conversations starting with it
+                continue from its cached KV instead of prefilling it again.
+            gen_kwargs: `model.generate` arguments, `max_new_tokens=128` by default
+        Returns:
+            List[str]: one answer per conversation, in input order
+        """
+        with self._residency():
+            return self._generate_batch(conversations, prefix=prefix, **gen_kwargs)
+
+    def _generate_batch(
+        self, conversations: List[list], prefix: Optional[str] = None, **gen_kwargs
+    ) -> List[str]:
         if self.model is None or self.processor is None:
             self.logger.error("Model not loaded. Call load() first.")
 
-        text = self.processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
+        prompts = []
+        for messages in conversations:
+            text = self.processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            image_inputs, video_inputs = process_vision_info(messages)
+            prompts.append((text, image_inputs or [], video_inputs or []))
+
+        chat_prefix = self._chat_prefix(prompts, prefix) if self.prefix_cache else None
+        reused = [
+            i
+            for i, (text, images, videos) in enumerate(prompts)
+            if chat_prefix and text.startswith(chat_prefix) and not images and not videos
+        ]
+        if reused and not self._prefix_cache_usable(
+            [prompts[i] for i in reused], chat_prefix
+        ):
+            reused = []
+        rest = sorted(set(range(len(prompts))) - set(reused))
+
+        outputs = [None] * len(prompts)
+        for group, generate_fn in (
+            (reused, lambda p: self._generate_with_prefix(p, chat_prefix, gen_kwargs)),
+            (rest, lambda p: self._generate_micro_batch(p, gen_kwargs)),
+        ):
+            order = sorted(group, key=lambda i: self._prompt_length(*prompts[i]))
+            for start in range(0, len(order), self.max_batch_size):
+                batch = order[start : start + self.max_batch_size]
+                answers = generate_fn([prompts[i] for i in batch])
+                for i, answer in zip(batch, answers):
+                    outputs[i] = answer
+        return outputs
+
+    def _prompt_length(self, text: str, images: list, videos: list) -> int:
+        """Approximate token count of a prompt: text tokens plus image tokens."""
+        n_text = len(self.processor.tokenizer(text).input_ids)
+        return n_text + sum(img.width * img.height // IMAGE_TOKEN_PIXELS for img in images)
+
+    @staticmethod
+    def _chat_prefix(prompts: list, prefix: Optional[str]) -> Optional[str]:
+        """Chat-formatted text up to the end of `prefix` in the first prompt."""
+        if not prefix or not prompts:
+            return None
+        text = prompts[0][0]
+        end = text.find(prefix)
+        return text[: end + len(prefix)] if end >= 0 else None
+
+    def _set_rope_deltas(self, rope_deltas: Optional[torch.Tensor]) -> bool:
+        """
+        Qwen2.5-VL keeps M-RoPE offsets of the last prefill in the private
+        `rope_deltas` attribute of the model (or of its inner model in newer
+        transformers) and uses them whenever a cache is present.
+        Returns:
+            bool: whether any module exposes `rope_deltas`
+        """
+        found = False
+        for module in (self.model, getattr(self.model, "model", None)):
+            if module is not None and hasattr(module, "rope_deltas"):
+                module.rope_deltas = rope_deltas
+                found = True
+        return found
+
+    def _prefix_cache_usable(self, prompts: list, chat_prefix: str) -> bool:
+        """
+        Check once per loaded model that continuing from the cached prefix gives the
+        same greedy answers as plain generation. The prefix path depends on private
+        transformers internals (validated with the version pinned in requirements.txt),
+        on a mismatch the prefix cache is disabled until the model is reloaded.
+        """
+        if self._prefix_verified is None:
+            if not self._set_rope_deltas(None):
+                self.logger.warning(
+                    "Model exposes no rope_deltas, prefix cache disabled."
+                )
+                self._prefix_verified = False
+            else:
+                check_kwargs = {"max_new_tokens": PREFIX_CHECK_TOKENS, "do_sample": False}
+                batch = prompts[: self.max_batch_size]
+                self._prefix_verified = self._generate_with_prefix(
+                    batch, chat_prefix, check_kwargs
+                ) == self._generate_micro_batch(batch, check_kwargs)
+                if not self._prefix_verified:
+                    self.logger.warning(
+                        "Prefix-cached generation differs from plain generation, "
+                        "prefix cache disabled."
+                    )
+        return self._prefix_verified
+
+    def _cached_prefix(self, chat_prefix: str):
+        """Token ids and KV cache of `chat_prefix`, computed once per loaded model."""
+        if chat_prefix not in self._prefix_caches:
+            ids = self.processor.tokenizer(chat_prefix, return_tensors="pt").input_ids
+            ids = ids.to(self.model.device)
+            self._set_rope_deltas(None)
+            with torch.no_grad():
+                out = self.model(input_ids=ids, use_cache=True)
+            self._prefix_caches[chat_prefix] = (ids[0], out.past_key_values)
+        return self._prefix_caches[chat_prefix]
+
+    def _generate_with_prefix(
+        self, prompts: list, chat_prefix: str, gen_kwargs: dict
+    ) -> List[str]:
+        """
+        Text-only micro-batch continuing from the cached prefix. Suffixes are padded
+        on the left between the shared prefix and the question-specific tokens.
+        """
+        prefix_ids, prefix_kv = self._cached_prefix(chat_prefix)
+        encoded = [self.processor.tokenizer(text).input_ids for text, _, _ in prompts]
+        # tokens at the prefix boundary may merge differently in full prompts, reuse
+        # only the common part; at least one token is left for the prefill
+        n_prefix = len(prefix_ids)
+        prefix_list = prefix_ids.tolist()
+        for ids in encoded:
+            common = 0
+            while common < min(n_prefix, len(ids) - 1) and ids[common] == prefix_list[common]:
+                common += 1
+            n_prefix = common
+        suffixes = [ids[n_prefix:] for ids in encoded]
+        width = max(len(s) for s in suffixes)
+        pad_id = self.processor.tokenizer.pad_token_id
+        pads = [width - len(s) for s in suffixes]
+        input_ids = torch.tensor([[pad_id] * p + s for p, s in zip(pads, suffixes)])
+        attention_mask = torch.tensor([[0] * p + [1] * len(s) for p, s in zip(pads, suffixes)])
+
+        n = len(prompts)
+        device = self.model.device
+        input_ids = torch.cat(
+            [prefix_ids[:n_prefix].expand(n, -1), input_ids.to(device)], dim=1
         )
-        image_inputs, video_inputs = process_vision_info(messages)
-
-        inputs = self.processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
+        attention_mask = torch.cat(
+            [
+                torch.ones((n, n_prefix), dtype=attention_mask.dtype),
+                attention_mask,
+            ],
+            dim=1,
+        ).to(device)
+        kv = copy.deepcopy(prefix_kv)
+        if n_prefix < kv.get_seq_length():
+            kv.crop(n_prefix)
+        kv.batch_repeat_interleave(n)
+
+        # positions after the cache are cache_position + rope_deltas: text-only
+        # prompts have zero offset, padding shifts the suffix back to start at n_prefix
+        if not self._set_rope_deltas(-torch.tensor(pads, device=device).view(n, 1)):
+            raise RuntimeError("prefix cache needs rope_deltas of Qwen2.5-VL")
+        try:
+            with torch.no_grad():
+                generated_ids = self.model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    past_key_values=kv,
+                    **{**DEFAULT_GEN_KWARGS, **gen_kwargs},
+                )
+        finally:
+            self._set_rope_deltas(None)
+        return self.processor.batch_decode(
+            generated_ids[:, input_ids.shape[1] :],
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
         )
+
+    def _generate_micro_batch(self, prompts: list, gen_kwargs: dict) -> List[str]:
+        images = [img for _, prompt_images, _ in prompts for img in prompt_images]
+        videos = [video for _, _, prompt_videos in prompts for video in prompt_videos]
+        if self.vision_cache is not None and images and not videos:
+            inputs, image_embeds = self._inputs_with_cached_images(prompts)
+            visual_context = self._cached_visual(image_embeds.to(self.model.device))
+        else:
+            inputs = self.processor(
+                text=[text for text, _, _ in prompts],
+                images=images or None,
+                videos=videos or None,
+                padding=True,
+                return_tensors="pt",
+            )
+            visual_context = nullcontext()
         if self.device != "cpu":
             inputs = inputs.to(self.device)
-        generated_ids = self.model.generate(**inputs, max_new_tokens=128)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :]
-            for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
-        output_text = self.processor.batch_decode(
+        visual_lock = self._visual_lock if images or videos else nullcontext()
+        with visual_lock, visual_context:
+            generated_ids = self.model.generate(
+                **inputs, **{**DEFAULT_GEN_KWARGS, **gen_kwargs}
+            )
+        # left padding: every prompt ends at the same position
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1] :]
+        return self.processor.batch_decode(
             generated_ids_trimmed,
             skip_special_tokens=True,
             clean_up_tokenization_spaces=False,
         )
-        return output_text
+
+    def _visual(self):
+        # vision tower lives on the inner model in newer transformers
+        visual = getattr(self.model, "visual", None)
+        return visual if visual is not None else self.model.model.visual
+
+    def _vision_key(self, img) -> tuple:
+        image_processor = self.processor.image_processor
+        settings = tuple(
+            getattr(image_processor, name, None)
+            for name in (
+                "min_pixels",
+                "max_pixels",
+                "patch_size",
+                "temporal_patch_size",
+                "merge_size",
+            )
+        )
+        return image_hash(img), settings
+
+    def _image_embeddings(self, img):
+        """Visual-token embeddings (on CPU) and grid_thw of `img`, encoded once."""
+        key = self._vision_key(img)
+        cached = self.vision_cache.get(key)
+        if cached is not None:
+            return cached
+
+        image_inputs = self.processor.image_processor(images=[img], return_tensors="pt")
+        visual = self._visual()
+        with torch.no_grad():
+            image_embeds = visual(
+                image_inputs.pixel_values.to(visual.device, visual.dtype),
+                grid_thw=image_inputs.image_grid_thw.to(visual.device),
+            )
+        entry = (image_embeds.cpu(), image_inputs.image_grid_thw)
+        self.vision_cache.put(
+            key, entry, nbytes=image_embeds.numel() * image_embeds.element_size()
+        )
+        return entry
+
+    def _inputs_with_cached_images(self, prompts: list):
+        """
+        Model inputs of a micro-batch without running the image processor: image
+        placeholders are expanded to the visual-token count of the cached grids, like
+        the Qwen processor does, and text is tokenized alone.
+        Returns:
+            inputs (BatchEncoding): input_ids, attention_mask, image_grid_thw and
+                placeholder pixel_values
+            image_embeds (torch.Tensor): embeddings of all images in batch order
+        """
+        image_token = self.processor.image_token
+        merge_area = self.processor.image_processor.merge_size**2
+        texts, embeds, grids = [], [], []
+        for text, images, _ in prompts:
+            for img in images:
+                image_embeds, grid_thw = self._image_embeddings(img)
+                n_tokens = int(grid_thw.prod()) // merge_area
+                text = text.replace(image_token, "<|placeholder|>" * n_tokens, 1)
+                embeds.append(image_embeds)
+                grids.append(grid_thw)
+            texts.append(text.replace("<|placeholder|>", image_token))
+
+        inputs = self.processor.tokenizer(texts, padding=True, return_tensors="pt")
+        image_grid_thw = torch.cat(grids)
+        inputs["image_grid_thw"] = image_grid_thw
+        # the vision tower is bypassed; pixel_values only has to be present and have
+        # one row per patch, as generate splits it per image when expanding inputs
+        inputs["pixel_values"] = torch.empty((int(image_grid_thw.prod(-1).sum()), 1))
+        return inputs, torch.cat(embeds)
+
+    @contextmanager
+    def _cached_visual(self, image_embeds: torch.Tensor):
+        """
+        Vision tower returns the given embeddings instead of encoding pixels. Only the
+        instance of the loaded model is patched; an instance-level forward set before
+        (e.g. by accelerate hooks) is restored afterwards. Callers hold `_visual_lock`.
+
+        Passing `inputs_embeds` to `generate` instead would drop `input_ids` from the
+        prefill, and Qwen2.5-VL would then place image tokens at text M-RoPE positions.
+        """
+        visual = self._visual()
+        missing = object()
+        previous = visual.__dict__.get("forward", missing)
+        visual.forward = lambda *args, **kwargs: image_embeds
+        try:
+            yield
+        finally:
+            if previous is missing:
+                del visual.forward
+            else:
+                visual.forward = previous
@@ -0,0 +1,167 @@
+"""
+Caching helpers shared by model wrappers: content hash of images, in-memory LRU
+cache bounded by total size in bytes and on-disk cache directory shared by processes.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import IO, Any, Callable, Hashable, Iterable, Optional
+
+from PIL import Image
+
+
+def image_hash(img: Image.Image) -> str:
+    """
+    Content hash of a PIL image (pixels, mode and size), independent of file name.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+class LRUByteCache:
+    """
+    In-memory LRU cache bounded by total size of stored values in bytes.
+    Sizes are given by the caller on `put`. Thread safe.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                # would evict everything and still not fit
+                return
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+class DiskCache:
+    """
+    Directory of cache entries shared by several processes.
+    An entry is a group of files `<key>.<suffix>`; files are written atomically
+    (temporary file + `os.replace`) and the least recently used entries are removed
+    when total size of the directory exceeds `max_bytes`.
+    """
+
+    TMP_PREFIX = ".tmp-"
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.{suffix}")
+
+    def touch(self, key: str, suffix: str):
+        """Mark entry as recently used (mtime is used as LRU clock)."""
+        try:
+            os.utime(self.path(key, suffix))
+        except FileNotFoundError:
+            pass
+
+    def atomic_write(self, key: str, suffix: str, write_fn: Callable[[IO[bytes]], None]):
+        """
+        Write `<key>.<suffix>` through `write_fn(file)`. Readers never see partial files.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=self.TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_fn(f)
+            os.replace(tmp_path, self.path(key, suffix))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def remove(self, key: str, suffixes: Iterable[str]):
+        for suffix in suffixes:
+            try:
+                os.remove(self.path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, commit_suffix: str):
+        """
+        Remove least recently used entries until the directory fits in `max_bytes`.
+        `commit_suffix` is the file written last for every entry, it is removed first
+        so that concurrent readers treat the entry as missing.
+        """
+        if self.max_bytes is None:
+            return
+        entries = {}
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(self.TMP_PREFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            key, _, suffix = name.partition(".")
+            size, mtime, suffixes = entries.get(key, (0, 0.0, []))
+            entries[key] = (size + st.st_size, max(mtime, st.st_mtime), suffixes + [suffix])
+            total += st.st_size
+
+        for key, (size, _, suffixes) in sorted(entries.items(), key=lambda kv: kv[1][1]):
+            if total <= self.max_bytes:
+                break
+            suffixes = sorted(suffixes, key=lambda s: s != commit_suffix)
+            self.remove(key, suffixes)
+            total -= size
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,236 @@
+"""
+ModelManager keeps track of which model wrappers are resident on the device and
+evicts least-recently-used ones when a memory budget is exceeded.
+"""
+import gc
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import torch
+import torch.ao.nn.quantized.dynamic as nnqd
+
+GB = 1024**3
+
+
+def module_nbytes(module: Optional[torch.nn.Module]) -> int:
+    """
+    Number of bytes taken by parameters and buffers of a torch module, including
+    packed weights of dynamically quantized Linear layers.
+    """
+    if module is None:
+        return 0
+    if not isinstance(module, torch.nn.Module):
+        # e.g. ONNX Runtime adapters, which report size of their graphs
+        return getattr(module, "nbytes", 0)
+    params = sum(p.numel() * p.element_size() for p in module.parameters())
+    buffers = sum(b.numel() * b.element_size() for b in module.buffers())
+    packed = 0
+    for m in module.modules():
+        if isinstance(m, nnqd.Linear):
+            weight = m.weight()
+            packed += weight.numel() * weight.element_size()
+    return params + buffers + packed
+
+
+def release_device_memory():
+    """Run garbage collection and return cached CUDA blocks to the driver."""
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ModelManager:
+    """
+    Residency manager shared by model wrappers (GroundingDINO, SAM, DepthPro,
+    Orient-Anything, Qwen). A wrapper has to expose `load()`, `unload()` and
+    `memory_footprint()`.
+
+    Models stay loaded as long as the sum of their footprints fits into
+    `memory_budget_gb`. When it does not, least-recently-used models are unloaded.
+    `memory_budget_gb=0` reproduces the old behaviour (unload right after use),
+    `memory_budget_gb=None` never evicts anything. Models currently in use (between
+    `acquire` and `release`) are never evicted, even if the budget is exceeded.
+    """
+
+    def __init__(self, memory_budget_gb: Optional[float] = 0):
+        self.memory_budget = None if memory_budget_gb is None else int(memory_budget_gb * GB)
+        self._resident: "OrderedDict[str, object]" = OrderedDict()
+        self._footprints: Dict[str, int] = {}
+        self._in_use: Counter = Counter()
+        self._lock = threading.RLock()
+        self.load_seconds: Dict[str, float] = defaultdict(float)
+        self.load_counts: Dict[str, int] = defaultdict(int)
+        self.evictions: Dict[str, int] = defaultdict(int)
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(self._footprints.get(name, 0) for name in self._resident)
+
+    def is_resident(self, name: str) -> bool:
+        return name in self._resident
+
+    def acquire(self, name: str, wrapper):
+        """
+        Make sure `wrapper` is loaded and mark it as most recently used.
+        Args:
+            name (str): stage name used for bookkeeping (e.g. "dino", "sam")
+            wrapper: model wrapper with load/unload/memory_footprint
+        Returns:
+            the loaded wrapper
+        """
+        with self._lock:
+            self._in_use[name] += 1
+            if name in self._resident:
+                self._resident.move_to_end(name)
+                return wrapper
+
+            # make room using footprint from previous load (if we have seen this model)
+            self._evict_until_fits(self._footprints.get(name, 0), keep=name)
+
+            start = time.perf_counter()
+            try:
+                wrapper.load()
+            except BaseException:
+                self._in_use[name] -= 1
+                raise
+            self.load_seconds[name] += time.perf_counter() - start
+            self.load_counts[name] += 1
+
+            self._resident[name] = wrapper
+            self._footprints[name] = wrapper.memory_footprint()
+            self._evict_until_fits(0, keep=name)
+            return wrapper
+
+    def release(self, name: str):
+        """
+        Called when stage finished using its model. Model stays resident only if
+        it still fits in the budget.
+        """
+        with self._lock:
+            self._in_use[name] -= 1
+            if self._in_use[name] <= 0:
+                del self._in_use[name]
+            self._evict_until_fits(0, keep=None)
+
+    @contextmanager
+    def use(self, name: str, wrapper):
+        """Context manager: `with manager.use("sam", self.sam): ...`"""
+        self.acquire(name, wrapper)
+        try:
+            yield wrapper
+        finally:
+            self.release(name)
+
+    def evict(self, name: str):
+        """Unload single model if it is resident."""
+        with self._lock:
+            wrapper = self._resident.pop(name, None)
+            if wrapper is not None:
+                wrapper.unload()
+                self.evictions[name] += 1
+
+    def unload_all(self):
+        with self._lock:
+            for name in list(self._resident):
+                self.evict(name)
+            release_device_memory()
+
+    def _evict_until_fits(self, incoming: int, keep: Optional[str]):
+        if self.memory_budget is None:
+            return
+        for name in list(self._resident):
+            if self.resident_bytes + incoming <= self.memory_budget:
+                break
+            if name == keep or name in self._in_use:
+                continue
+            self.evict(name)
+
+    def summary(self) -> str:
+        """Per-stage load time counters, e.g. for stats.txt."""
+        lines = []
+        for name in sorted(self.load_counts):
+            lines.append(
+                f"{name}: loads={self.load_counts[name]}, "
+                f"load_time={self.load_seconds[name]:.2f}s, "
+                f"evictions={self.evictions[name]}"
+            )
+        lines.append(f"total_load_time={sum(self.load_seconds.values()):.2f}s")
+        return "\n".join(lines)
+
+
+def _named_tensors(module: torch.nn.Module):
+    yield from module.named_parameters()
+    yield from module.named_buffers()
+
+
+class HostWeightCache:
+    """
+    Warm host-side cache of model weights. `park` (called from `unload`) leaves weights
+    of a model in CPU memory, pinned when CUDA is available, and `restore` (called from
+    `load`) moves them back to the device instead of reading them from disk again.
+
+    Host copies are kept also while the model is on the device, so next `park` only
+    drops device tensors. Total size of host copies is capped by `max_gb`, least
+    recently used models are dropped first.
+    """
+
+    def __init__(self, max_gb: float, pin_memory: Optional[bool] = None):
+        self.max_bytes = int(max_gb * GB)
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        # key -> {"module", "extra", "host": {name: tensor}, "nbytes", "parked"}
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def park(self, key: str, module: torch.nn.Module, extra=None):
+        """
+        Move module weights to host memory and remember module (and `extra`, e.g. its
+        processor) under `key`.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                host = {}
+                for name, t in _named_tensors(module):
+                    if t.device.type == "cpu" and not self.pin_memory:
+                        host[name] = t.data
+                        continue
+                    host[name] = torch.empty(
+                        t.shape, dtype=t.dtype, device="cpu", pin_memory=self.pin_memory
+                    ).copy_(t.data)
+                entry = {"host": host, "nbytes": module_nbytes(module)}
+                self._entries[key] = entry
+            for name, t in _named_tensors(module):
+                t.data = entry["host"][name]
+            entry.update(module=module, extra=extra, parked=True)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def restore(self, key: str, device) -> Optional[tuple]:
+        """
+        Returns:
+            (module on `device`, extra) if model was parked, otherwise None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry["parked"]:
+                return None
+            module, extra = entry["module"], entry["extra"]
+            if torch.device(device).type != "cpu":
+                for name, t in _named_tensors(module):
+                    t.data = entry["host"][name].to(device, non_blocking=True)
+            entry.update(module=None, extra=None, parked=False)
+            self._entries.move_to_end(key)
+            return module, extra
+
+    @property
+    def nbytes(self) -> int:
+        return sum(entry["nbytes"] for entry in self._entries.values())
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self.nbytes <= self.max_bytes:
+                break
+            del self._entries[key]
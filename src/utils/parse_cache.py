@@ -0,0 +1,170 @@
+"""
+Persistent memoization of text-only Qwen calls (object extraction, perspective,
+egocentric rephrasing, fused planning). Parsed outputs are stored in a SQLite
+database keyed by model id, hash of the prompt template and the template arguments
+(question text, options), so re-evaluations skip these generations. The database is
+safe to share by several processes.
+
+Invalidation:
+
+    python -m src.utils.parse_cache --db parse_cache.sqlite --stats
+    python -m src.utils.parse_cache --db parse_cache.sqlite --template EXTRACT_OBJECTS_TEMPLATE
+    python -m src.utils.parse_cache --db parse_cache.sqlite --model_id Qwen/Qwen2.5-VL-7B-Instruct
+    python -m src.utils.parse_cache --db parse_cache.sqlite --all
+"""
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+
+def template_hash(template: str) -> str:
+    return hashlib.blake2b(template.encode(), digest_size=8).hexdigest()
+
+
+class ParseCache:
+    """
+    SQLite table of parsed outputs. Writes go through WAL journal, so concurrent
+    readers are not blocked and several processes can write (serialized by SQLite).
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0):
+        """
+        Args:
+            path (str): database file, created if missing
+            timeout (float): seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS parses (
+                    key TEXT PRIMARY KEY,
+                    model_id TEXT NOT NULL,
+                    template_hash TEXT NOT NULL,
+                    arguments TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+                """
+            )
+
+    @staticmethod
+    def _arguments(arguments: dict) -> str:
+        return json.dumps(arguments, sort_keys=True, ensure_ascii=False)
+
+    @staticmethod
+    def key(model_id: str, template: str, arguments: dict) -> str:
+        raw = f"{model_id}\0{template_hash(template)}\0{ParseCache._arguments(arguments)}"
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+    def get(self, model_id: str, template: str, arguments: dict) -> Optional[Any]:
+        """Parsed output stored for the call, None if missing."""
+        key = self.key(model_id, template, arguments)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM parses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, model_id: str, template: str, arguments: dict, value: Any):
+        """Store JSON-serializable parsed output of the call."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parses VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.key(model_id, template, arguments),
+                    model_id,
+                    template_hash(template),
+                    self._arguments(arguments),
+                    json.dumps(value, ensure_ascii=False),
+                    time.time(),
+                ),
+            )
+
+    def invalidate(
+        self, model_id: Optional[str] = None, template: Optional[str] = None
+    ) -> int:
+        """
+        Remove entries of `model_id` and / or `template` (all entries if both are
+        None). Returns the number of removed entries.
+        """
+        conditions, params = [], []
+        if model_id is not None:
+            conditions.append("model_id = ?")
+            params.append(model_id)
+        if template is not None:
+            conditions.append("template_hash = ?")
+            params.append(template_hash(template))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock, self._conn:
+            return self._conn.execute(f"DELETE FROM parses{where}", params).rowcount
+
+    def summary(self) -> list:
+        """(model_id, template_hash, entries) of stored parses."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT model_id, template_hash, COUNT(*) FROM parses "
+                "GROUP BY model_id, template_hash"
+            ).fetchall()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the parse cache.")
+    parser.add_argument("--db", type=str, required=True)
+    parser.add_argument("--model_id", type=str, default=None)
+    parser.add_argument(
+        "--template",
+        type=str,
+        default=None,
+        help="Name of a template in src.utils.prompts, e.g. EXTRACT_OBJECTS_TEMPLATE.",
+    )
+    parser.add_argument("--all", action="store_true", help="Remove every entry.")
+    parser.add_argument("--stats", action="store_true", help="Print entries per template.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from src.utils import prompts
+
+    args = parse_arguments()
+    cache = ParseCache(args.db)
+    names = {
+        template_hash(value): name
+        for name, value in vars(prompts).items()
+        if name.endswith("_TEMPLATE")
+    }
+    if args.stats:
+        for model_id, t_hash, count in cache.summary():
+            print(f"{model_id:<40} {names.get(t_hash, t_hash):<36} {count}")
+    if args.all or args.model_id or args.template:
+        template = getattr(prompts, args.template) if args.template else None
+        removed = cache.invalidate(model_id=args.model_id, template=template)
+        print(f"removed {removed} entries")
+    elif not args.stats:
+        print("nothing to do: pass --stats, --model_id, --template or --all")
+    cache.close()
@@ -1,3 +1,4 @@
+from string import Formatter
 from textwrap import dedent
 
 EXTRACT_OBJECTS_TEMPLATE = dedent("""
@@ -49,6 +50,26 @@ Return only the rephrased question, with no extra text or labels.
 [Question] {question}
 """)
 
+QUERY_PLAN_TEMPLATE = dedent("""
+Given a spatial-reasoning question about an image, do three things at once:
+1. list all entities mentioned in the question,
+2. identify the perspective from which the question is asked: "camera", or the name
+of one of the listed entities,
+3. rephrase the question with the perspective description removed.
+
+Instructions:
+- Return ONLY a JSON object with keys "objects" (list of strings), "perspective"
+(string) and "egocentric_question" (string).
+- Do not include any explanation, extra text or code fences.
+
+Example:
+[Question] From the woman’s perspective, is the tree on the left or right?
+{{"objects": ["woman", "tree"], "perspective": "woman", "egocentric_question": "Is the tree on the left or right?"}}
+
+Now, for the question below, return the JSON object:
+[Question] {question}
+""")
+
 PERSPECTIVE_PROMPT_TEMPLATE = dedent("""
 Imagine that you are at the {source}'s 
 position and facing where it is facing.
@@ -71,6 +92,21 @@ answer the following question:
 Answer in one word: yes / no
 """)
 
+
+
+def static_prefix(template: str) -> str:
+    """
+    Formatted text of `template` before its first placeholder, identical for every
+    question (used for prefix KV-cache reuse).
+    """
+    prefix = ""
+    for literal, field_name, _, _ in Formatter().parse(template):
+        prefix += literal
+        if field_name is not None:
+            break
+    return prefix
+
+
 if __name__ == "__main__":
     x = EXTRACT_OBJECTS_TEMPLATE.format(question="what is the meaning of life?")
     print(x)
@@ -0,0 +1,148 @@
+"""
+CPU INT8 inference profile: dynamic quantization of Linear layers (int8 weights,
+activations quantized on the fly) and a disk cache of quantized state dicts, so that
+only the first load pays for the conversion.
+"""
+import itertools
+import os
+import re
+from typing import Callable, Iterable, Optional
+
+import torch
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch import nn
+
+from src.utils.cache import DiskCache
+
+PROFILES = ("fp32", "int8")
+_SUFFIX = "int8.pt"
+
+
+def check_profile(profile: str, device) -> str:
+    """Validate inference profile for a model running on `device`."""
+    if profile not in PROFILES:
+        raise ValueError(f"unknown inference profile {profile!r}, expected one of {PROFILES}")
+    if profile == "int8" and torch.device(device).type != "cpu":
+        raise ValueError("int8 profile uses dynamic quantization, which runs on CPU only")
+    return profile
+
+
+def _targets(module: nn.Module, submodules: Optional[Iterable[str]]):
+    if not submodules:
+        return [module]
+    return [module.get_submodule(name) for name in submodules]
+
+
+def quantize_linear_layers(
+    module: nn.Module, submodules: Optional[Iterable[str]] = None
+) -> nn.Module:
+    """
+    Dynamic INT8 quantization (in place) of Linear layers of `module`, or only of
+    its `submodules` (names as in `named_modules`).
+    """
+    for target in _targets(module, submodules):
+        torch.ao.quantization.quantize_dynamic(
+            target, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return module
+
+
+def _swap_linear_layers(module: nn.Module):
+    """Replace Linear layers by empty dynamic quantized ones (to load state dict into)."""
+    for name, child in module.named_children():
+        if type(child) is nn.Linear:
+            setattr(
+                module,
+                name,
+                nnqd.Linear(
+                    child.in_features,
+                    child.out_features,
+                    bias_=child.bias is not None,
+                    dtype=torch.qint8,
+                ),
+            )
+        else:
+            _swap_linear_layers(child)
+
+
+def _non_persistent_buffers(module: nn.Module) -> dict:
+    state_keys = set(module.state_dict().keys())
+    return {name: b for name, b in module.named_buffers() if name not in state_keys}
+
+
+def _set_buffer(module: nn.Module, name: str, tensor: torch.Tensor):
+    owner, _, leaf = name.rpartition(".")
+    module.get_submodule(owner)._buffers[leaf] = tensor
+
+
+class QuantizedModelCache:
+    """
+    Directory of quantized state dicts (plus non-persistent buffers) keyed by model id
+    and torch version. On a hit the model is built on the meta device from its config,
+    Linear layers are swapped for empty quantized ones and the cached tensors are
+    assigned, so neither fp32 weights nor the conversion are needed.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.disk = DiskCache(cache_dir)
+
+    @staticmethod
+    def key(model_id: str) -> str:
+        return re.sub(r"[^A-Za-z0-9_-]", "_", f"{model_id}-torch{torch.__version__}")
+
+    def load(
+        self,
+        model_id: str,
+        build_skeleton: Callable[[], nn.Module],
+        build_fp32: Callable[[], nn.Module],
+        submodules: Optional[Iterable[str]] = None,
+    ) -> nn.Module:
+        """
+        Args:
+            model_id (str): cache key of the model
+            build_skeleton: builds the fp32 architecture from config, called on meta device
+            build_fp32: builds the model with fp32 weights, called only on a cache miss
+            submodules (optional): quantize only these submodules
+        Returns:
+            quantized model on cpu in eval mode
+        """
+        key = self.key(model_id)
+        path = self.disk.path(key, _SUFFIX)
+        if os.path.exists(path):
+            self.disk.hits += 1
+            entry = torch.load(path, map_location="cpu", weights_only=True)
+            with torch.device("meta"):
+                module = build_skeleton()
+            for target in _targets(module, submodules):
+                _swap_linear_layers(target)
+            module.load_state_dict(entry["state_dict"], assign=True)
+            for name, tensor in entry["buffers"].items():
+                _set_buffer(module, name, tensor)
+            if any(t.is_meta for t in itertools.chain(module.parameters(), module.buffers())):
+                raise RuntimeError(f"cached int8 weights of {model_id} do not match the model")
+            return module.eval()
+
+        self.disk.misses += 1
+        module = quantize_linear_layers(build_fp32().to("cpu").eval(), submodules)
+        entry = {
+            "state_dict": module.state_dict(),
+            "buffers": _non_persistent_buffers(module),
+        }
+        self.disk.atomic_write(key, _SUFFIX, lambda f: torch.save(entry, f))
+        return module
+
+    def stats(self) -> dict:
+        return self.disk.stats()
+
+
+def load_quantized(
+    model_id: str,
+    build_skeleton: Callable[[], nn.Module],
+    build_fp32: Callable[[], nn.Module],
+    cache: Optional[QuantizedModelCache] = None,
+    submodules: Optional[Iterable[str]] = None,
+) -> nn.Module:
+    """INT8 model through `cache`, or quantized right away if there is no cache."""
+    if cache is not None:
+        return cache.load(model_id, build_skeleton, build_fp32, submodules)
+    return quantize_linear_layers(build_fp32().to("cpu").eval(), submodules)
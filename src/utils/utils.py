@@ -1,11 +1,13 @@
 import ast
+import json
 import math
+from typing import Optional
 from PIL import Image
 
-import matplotlib.pyplot as plt
 import matplotlib.patheffects as pe
 import numpy as np
-from matplotlib.patches import FancyArrowPatch
+from matplotlib.figure import Figure
+from matplotlib.patches import FancyArrowPatch, Rectangle
 from scipy.spatial.transform import Rotation
 
 
@@ -19,6 +21,38 @@ def llm_output_to_list(output: str):
     return None
 
 
+def parse_query_plan(output: str) -> Optional[dict]:
+    """
+    Strictly parse the JSON object of `QUERY_PLAN_TEMPLATE`. Returns None unless the
+    output is exactly an object with a non-empty list of non-empty "objects" strings,
+    "perspective" equal to "camera" or one of the objects and a non-empty
+    "egocentric_question".
+    """
+    try:
+        plan = json.loads(output.strip())
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(plan, dict) or set(plan) != {
+        "objects",
+        "perspective",
+        "egocentric_question",
+    }:
+        return None
+    objects, perspective = plan["objects"], plan["perspective"]
+    question = plan["egocentric_question"]
+    if not (
+        isinstance(objects, list)
+        and objects
+        and all(isinstance(o, str) and o.strip() for o in objects)
+    ):
+        return None
+    if not isinstance(perspective, str) or perspective not in objects + ["camera"]:
+        return None
+    if not isinstance(question, str) or not question.strip():
+        return None
+    return plan
+
+
 def change_points_basis(
     euler_angles: np.ndarray, translation: np.ndarray, points: np.ndarray
 ):
@@ -32,6 +66,8 @@ def change_points_basis(
     Returns:
         np.ndarray: points in new coordinate system
     """
+    # copy, callers pass views of scene orientations
+    euler_angles = np.array(euler_angles, dtype=np.float64)
     euler_angles[0] = euler_angles[0] - 180
     euler_angles[1] = -euler_angles[1]
     r = Rotation.from_euler("zxy", angles=[euler_angles[2], euler_angles[1], euler_angles[0]], degrees=True)
@@ -42,29 +78,21 @@ def change_points_basis(
     return new_positions
 
 
-def get_labels_positions_without_central(results: dict, central_perspective: str):
+def get_labels_positions_without_central(results, central_perspective: str):
     """
     Having results from external vision module, returns labels and positions of objects without
     central perspective object,
     Args:
-        results (dict): results from vision pipeline
+        results (SceneAbstraction): results from vision pipeline
         central_perspective (str): object, we want to create scene from
 
     Returns:
         [tuple]: labels, positions
     """
-    idx_central = results["labels"].index(central_perspective)
-    labels = results["labels"].copy()
-    positions = results["positions"]
-
-    if central_perspective != "camera":
-        # if camera is not our desired perspective, we get rid of object of interest
-        labels.remove(central_perspective)
-        positions = np.concatenate(
-            [positions[:idx_central], positions[(idx_central + 1) :]]
-        )
-
-    return labels, positions
+    if central_perspective == "camera":
+        return list(results.labels), results.positions
+    # if camera is not our desired perspective, we get rid of object of interest
+    return results.without(central_perspective)
 
 
 def save_img_with_annotation(img: Image, res: dict, save_path: str):
@@ -77,14 +105,16 @@ def save_img_with_annotation(img: Image, res: dict, save_path: str):
 
     # print(orientations)
 
-    fig, ax = plt.subplots(figsize=(8, 8))
+    # object-oriented API: pyplot keeps global state and is not thread safe
+    fig = Figure(figsize=(8, 8))
+    ax = fig.subplots()
     ax.imshow(img)
 
     for (x0, y0, x1, y1), z, x, y, (az, el, rot, conf) in zip(
         boxes, depths, xs, ys, orientations
     ):
         # draw bbox
-        rect = plt.Rectangle(
+        rect = Rectangle(
             (x0, y0),
             x1 - x0,
             y1 - y0,
@@ -149,5 +179,6 @@ def save_img_with_annotation(img: Image, res: dict, save_path: str):
         )
 
     ax.axis("off")
-    plt.tight_layout()
+    fig.tight_layout()
     fig.savefig(save_path)
+    fig.clear()
@@ -1,34 +1,216 @@
+import hashlib
+import json
 import math
-import gc
+from typing import Optional
+
+import numpy as np
 import torch
+import torch.nn.functional as F
 
 from PIL import Image
-from transformers import DepthProForDepthEstimation, DepthProImageProcessorFast
+from transformers import (
+    DepthProConfig,
+    DepthProForDepthEstimation,
+    DepthProImageProcessorFast,
+)
+
+from src.utils.cache import DiskCache, image_hash
+from src.utils.model_manager import (
+    HostWeightCache,
+    module_nbytes,
+    release_device_memory,
+)
+from src.utils.quantization import QuantizedModelCache, check_profile, load_quantized
+from .onnx_backend import DepthProOnnx, check_backend
+from .inference_config import InferenceConfig
+from .positions import SparseDepth
+
+DEPTH_CACHE_BYTES = 10 * 1024**3
 
 
 class DepthProModelWrapper:
-    def __init__(self, model_id: str = "apple/DepthPro-hf", device: str = "cuda"):
+    def __init__(
+        self,
+        model_id: str = "apple/DepthPro-hf",
+        device: str = "cuda",
+        cache_dir: Optional[str] = None,
+        cache_max_bytes: Optional[int] = DEPTH_CACHE_BYTES,
+        host_cache: Optional[HostWeightCache] = None,
+        profile: str = "fp32",
+        quantized_cache: Optional[QuantizedModelCache] = None,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        onnx_threads: Optional[int] = None,
+        inference_config: Optional[InferenceConfig] = None,
+        sparse: bool = False,
+        sparse_resolution: Optional[int] = None,
+    ):
+        """
+        Args:
+            model_id (str): DepthPro checkpoint
+            device (str): device to run DepthPro on
+            cache_dir (str, optional): directory of the persistent depth cache, shared
+                safely by several processes. None disables the cache.
+            cache_max_bytes (int, optional): size of cache directory above which least
+                recently used entries are removed. None means no limit.
+            host_cache (HostWeightCache, optional): keeps weights in host memory on unload
+            profile (str): "fp32", or "int8" for dynamic INT8 quantization of Linear
+                layers (CPU only)
+            quantized_cache (QuantizedModelCache, optional): disk cache of int8 weights
+            backend (str): "torch", or "onnx" to run graphs exported by
+                `src.vision_module.onnx_export` with ONNX Runtime
+            onnx_dir (str, optional): directory with exported graphs (onnx backend)
+            onnx_threads (int, optional): ONNX Runtime intra-op threads, None keeps
+                the runtime default
+            inference_config (InferenceConfig, optional): eager (default) or
+                optimized execution of the torch backend
+            sparse (bool): keep depth at model resolution and return `SparseDepth`,
+                sampled only where positions are computed, instead of (H, W) maps
+            sparse_resolution (int, optional): longer side the kept map is reduced
+                to in sparse mode, None keeps the model output resolution
+        """
         self.model_id = model_id
         self.device = device
+        self.host_cache = host_cache
+        self.profile = check_profile(profile, device)
+        self.quantized_cache = quantized_cache
+        self.backend = check_backend(backend, onnx_dir, profile)
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.inference_config = inference_config or InferenceConfig()
+        self.sparse = sparse
+        self.sparse_resolution = sparse_resolution
+        self._forward = None
         self.processor = None
         self.model = None
+        self.cache = DiskCache(cache_dir, cache_max_bytes) if cache_dir else None
 
     def load(self):
+        self._load()
+        if self.inference_config.optimized and self.backend == "torch":
+            self.inference_config.prepare_module(self.model)
+            self._forward = self.inference_config.compiled(self.model)
+
+    def _load(self):
+        restored = (
+            self.host_cache.restore(self.model_id, self.device)
+            if self.host_cache and self.backend == "torch"
+            else None
+        )
+        if restored is not None:
+            self.model, self.processor = restored
+            return
         self.processor = DepthProImageProcessorFast.from_pretrained(self.model_id)
+        if self.backend == "onnx":
+            self.model = DepthProOnnx(
+                self.onnx_dir,
+                DepthProConfig.from_pretrained(self.model_id),
+                self.device,
+                self.onnx_threads,
+            )
+            return
+        if self.profile == "int8":
+            self.model = load_quantized(
+                self.model_id,
+                lambda: DepthProForDepthEstimation(
+                    DepthProConfig.from_pretrained(self.model_id)
+                ),
+                lambda: DepthProForDepthEstimation.from_pretrained(self.model_id),
+                self.quantized_cache,
+            )
+            return
         self.model = DepthProForDepthEstimation.from_pretrained(self.model_id).to(
             self.device
         )
 
     def unload(self):
         if self.model is not None:
-            self.model.to("cpu")
+            if self.backend == "onnx":
+                pass
+            elif self.host_cache is not None:
+                self.host_cache.park(self.model_id, self.model, self.processor)
+            else:
+                self.model.to("cpu")
             del self.model
+            self._forward = None
             self.model = None
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            release_device_memory()
+
+    def memory_footprint(self) -> int:
+        return module_nbytes(self.model)
 
     def estimate_depth(self, img: Image.Image):
+        """
+        Returns:
+            tuple: depth map (H, W) and focal length in pixels. With cache enabled
+                   depth map is a read-only float16 memory-mapped array. In sparse
+                   mode depth map is a `SparseDepth`.
+        """
+        cached = self.cached_depth(img)
+        if cached is not None:
+            return cached
+        return self.compute_depth(img)
+
+    def cached_depth(self, img: Image.Image):
+        """Depth and focal length from the cache, None if missing or cache disabled."""
+        if self.cache is None:
+            return None
+        key = self._cache_key(img)
+        try:
+            with open(self.cache.path(key, "json")) as f:
+                meta = json.load(f)
+            depth_map = np.load(self.cache.path(key, "npy"), mmap_mode="r")
+        except FileNotFoundError:
+            self.cache.misses += 1
+            return None
+        self.cache.hits += 1
+        self.cache.touch(key, "json")
+        return self._as_depth(depth_map, img), meta["focal_length"]
+
+    def cache_stats(self) -> Optional[dict]:
+        return self.cache.stats() if self.cache is not None else None
+
+    def compute_depth(self, img: Image.Image, inputs=None):
+        """
+        Run DepthPro (model has to be loaded) and store result in the cache.
+        `inputs` is optional output of `preprocess` computed beforehand.
+        """
+        depth_map, focal_length = self._run_model(img, inputs)
+        if self.cache is None:
+            return self._as_depth(depth_map, img), focal_length
+
+        key = self._cache_key(img)
+        # depth first, metadata last: entry is visible only when both files exist
+        self.cache.atomic_write(
+            key, "npy", lambda f: np.save(f, depth_map.astype(np.float16))
+        )
+        meta = {"focal_length": focal_length, "model_id": self.model_id}
+        self.cache.atomic_write(key, "json", lambda f: f.write(json.dumps(meta).encode()))
+        self.cache.evict(commit_suffix="json")
+        # return what later cache hits will return, so runs are reproducible
+        try:
+            depth_map = np.load(self.cache.path(key, "npy"), mmap_mode="r")
+        except FileNotFoundError:
+            # evicted in the meantime by another process
+            depth_map = depth_map.astype(np.float16)
+        return self._as_depth(depth_map, img), focal_length
+
+    def warmup(self):
+        """Run the model once on a blank input, so that compilation happens here."""
+        self._run_model(Image.new("RGB", (640, 480)))
+
+    def _cache_key(self, img: Image.Image) -> str:
+        # int8 depth must not be served to fp32 runs (and vice versa)
+        model_tag = self.model_id if self.profile == "fp32" else f"{self.model_id}:{self.profile}"
+        if self.sparse:
+            # sparse entries hold inverse depth at model resolution, not (H, W) depth
+            model_tag += f":sparse{self.sparse_resolution or ''}"
+        return hashlib.blake2b(
+            f"{model_tag}:{image_hash(img)}".encode(), digest_size=16
+        ).hexdigest()
+
+    def preprocess(self, img: Image.Image):
+        """CPU part of depth estimation: upscaling of small images and normalization."""
         psize = self.model.config.patch_size
         min_ratio = min(self.model.config.scaled_images_ratios)
         min_size = math.ceil(psize / min_ratio)
@@ -42,11 +224,46 @@ class DepthProModelWrapper:
         else:
             img_proc = img
 
-        inputs = self.processor(images=img_proc, return_tensors="pt").to(self.device)
-        with torch.no_grad():
-            out = self.model(**inputs)
+        return self.processor(images=img_proc, return_tensors="pt")
+
+    def _run_model(self, img: Image.Image, inputs=None):
+        H, W = img.height, img.width
+        if inputs is None:
+            inputs = self.preprocess(img)
+        inputs = inputs.to(self.device)
+        with self.inference_config.inference_context():
+            if self._forward is None:
+                out = self.model(**inputs)
+            else:
+                # processor resizes every image to the same size, one static graph
+                out = self._forward(
+                    pixel_values=self.inference_config.images(inputs["pixel_values"])
+                )
+        if self.sparse:
+            return self._sparse_output(out, W)
         results = self.processor.post_process_depth_estimation(
             out, target_sizes=[(H, W)]
         )
         depth_map = results[0]["predicted_depth"].squeeze().cpu().numpy()
-        return depth_map, results[0]["focal_length"]
+        return depth_map, float(results[0]["focal_length"])
+
+    def _sparse_output(self, out, W: int):
+        """
+        Inverse depth at model resolution and focal length of the original image.
+        Post-processing at the output size is an identity resize, the inverse depth it
+        scales by width / focal length does not depend on the width.
+        """
+        h, w = out.predicted_depth.shape[-2:]
+        results = self.processor.post_process_depth_estimation(
+            out, target_sizes=[(h, w)]
+        )
+        focal_length = float(results[0]["focal_length"])
+        inverse = out.predicted_depth.reshape(1, 1, h, w).float() * w / focal_length
+        if self.sparse_resolution is not None and max(h, w) > self.sparse_resolution:
+            scale = self.sparse_resolution / max(h, w)
+            size = (max(round(h * scale), 1), max(round(w * scale), 1))
+            inverse = F.interpolate(inverse, size=size, mode="area")
+        return inverse[0, 0].cpu().numpy(), focal_length * W / w
+
+    def _as_depth(self, depth_map: np.ndarray, img: Image.Image):
+        return SparseDepth(depth_map, img.size) if self.sparse else depth_map
@@ -2,7 +2,8 @@
 """
 ExternalVisionModule is responsible for all scene abstraction flow. From raw image, to list of objects' poses (position + orientation)
 """
-import numpy as np
+import warnings
+from contextlib import ExitStack
 from PIL import Image
 from typing import List, Optional
 
@@ -10,22 +11,193 @@ from .grounding_dino_model import GroundingDINOModelWrapper
 from .sam_model import SAMModelWrapper
 from .depthpro_model import DepthProModelWrapper
 from .orient_anything_model import OrientAnythingModelWrapper
+from .positions import estimate_positions
+from .scene_abstraction import (
+    ImageRecord,
+    SceneAbstraction,
+    SceneCache,
+    normalize_objects,
+)
+from .pipeline import PipelinedExecutor, Stage
+from .inference_config import InferenceConfig
+from src.utils.cache import LRUByteCache, image_hash
 from src.utils.utils import save_img_with_annotation
+from src.utils.model_manager import HostWeightCache, ModelManager
+from src.utils.quantization import QuantizedModelCache
+
+SCENE_CACHE_BYTES = 1024**3
+IMAGE_RECORD_BYTES = 2 * 1024**3
+
 class ExternalVisionModule:
     """
     Refactored external vision model using modular model classes.
     """
 
-    def __init__(self, model_name: str = "GenericVisionModel", device: str = "cuda"):
+    def __init__(
+        self,
+        model_name: str = "GenericVisionModel",
+        device: str = "cuda",
+        model_manager: Optional[ModelManager] = None,
+        depth_cache_dir: Optional[str] = None,
+        scene_cache_dir: Optional[str] = None,
+        scene_cache_max_bytes: Optional[int] = SCENE_CACHE_BYTES,
+        incremental_detection: bool = False,
+        image_record_bytes: int = IMAGE_RECORD_BYTES,
+        host_cache_gb: float = 0,
+        pipelined: bool = False,
+        pipeline_workers: int = 2,
+        pipeline_queue_size: int = 4,
+        orient_tta_crops: int = 0,
+        orient_remove_background: bool = False,
+        profile: str = "fp32",
+        quantized_cache_dir: Optional[str] = None,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        onnx_threads: Optional[int] = None,
+        inference_config: Optional[InferenceConfig] = None,
+        depth_sparse: bool = False,
+        depth_sparse_resolution: Optional[int] = None,
+    ):
+        """
+        Args:
+            device (str): device for all vision models
+            model_manager (ModelManager, optional): decides which models stay loaded
+                between calls. Default manager has zero budget, so every model is
+                unloaded right after its stage (previous behaviour).
+            depth_cache_dir (str, optional): persistent DepthPro cache directory,
+                None disables it.
+            scene_cache_dir (str, optional): persistent cache of whole scene
+                abstractions keyed by image, object set and model versions, so that
+                repeated questions skip all vision models. None disables it.
+            scene_cache_max_bytes (int, optional): size of the scene cache directory
+                above which least recently used scenes are removed
+            incremental_detection (bool): keep every object found so far per image
+                (in memory, LRU); a question runs the vision models only for objects
+                not asked about before and gets the subset of objects it mentions
+            image_record_bytes (int): memory for per-image records (and depth maps
+                kept for them when the DepthPro cache is disabled)
+            host_cache_gb (float): host RAM for weights of unloaded models, so that
+                reloading is a memory copy instead of `from_pretrained`. 0 disables it.
+            pipelined (bool): `abstract_scenes` overlaps CPU pre/post-processing of
+                some images with inference of others. All four models are resident
+                during the whole batch.
+            pipeline_workers (int): threads of every CPU stage in pipelined mode
+            pipeline_queue_size (int): capacity of queues between pipeline stages
+            orient_tta_crops (int): augmented crops per object for Orient-Anything
+                test-time augmentation, 0 disables it
+            orient_remove_background (bool): remove background of object crops before
+                orientation estimation
+            profile (str): inference profile of all vision models, "fp32" or "int8"
+                (dynamic INT8 quantization of Linear layers, CPU only)
+            quantized_cache_dir (str, optional): where int8 state dicts are cached,
+                None quantizes on every load
+            backend (str): "torch" or "onnx" (ONNX Runtime sessions over graphs in
+                `onnx_dir`, see `src.vision_module.onnx_export`)
+            onnx_dir (str, optional): directory with exported graphs
+            onnx_threads (int, optional): ONNX Runtime intra-op threads per session
+            inference_config (InferenceConfig, optional): execution settings shared by
+                all vision models (optimized mode: inference_mode, channels_last,
+                torch.compile with shape buckets)
+            depth_sparse (bool): keep DepthPro output at model resolution and sample
+                depth only at object mask pixels, no full-size depth maps
+            depth_sparse_resolution (int, optional): longer side of the kept depth
+                map in sparse mode, None keeps the model output resolution
+        """
         self.device = device  # Let model classes handle device selection
-        self.dino = GroundingDINOModelWrapper(device=self.device)
-        self.sam = SAMModelWrapper(device=self.device)
-        self.depthpro = DepthProModelWrapper(device=self.device)
-        self.orient = OrientAnythingModelWrapper(device=device)
+        self.model_manager = model_manager or ModelManager(memory_budget_gb=0)
+        self.host_cache = HostWeightCache(max_gb=host_cache_gb) if host_cache_gb > 0 else None
+        inference_config = inference_config or InferenceConfig()
+        if (
+            inference_config.optimized
+            and backend == "torch"
+            and self.host_cache is None
+            and self.model_manager.memory_budget == 0
+        ):
+            warnings.warn(
+                "optimized inference with a zero memory budget and no host cache: "
+                "models are reloaded after every stage and compiled again on every "
+                "load; set a model manager budget or host_cache_gb"
+            )
+        self.quantized_cache = (
+            QuantizedModelCache(quantized_cache_dir) if quantized_cache_dir else None
+        )
+        model_kwargs = dict(
+            host_cache=self.host_cache,
+            profile=profile,
+            quantized_cache=self.quantized_cache,
+            backend=backend,
+            onnx_dir=onnx_dir,
+            onnx_threads=onnx_threads,
+            inference_config=inference_config,
+        )
+        self.dino = GroundingDINOModelWrapper(device=self.device, **model_kwargs)
+        self.sam = SAMModelWrapper(device=self.device, **model_kwargs)
+        self.depthpro = DepthProModelWrapper(
+            device=self.device,
+            cache_dir=depth_cache_dir,
+            sparse=depth_sparse,
+            sparse_resolution=depth_sparse_resolution,
+            **model_kwargs,
+        )
+        self.orient = OrientAnythingModelWrapper(
+            device=device,
+            **model_kwargs,
+            tta_crops=orient_tta_crops,
+            remove_background=orient_remove_background,
+        )
+        self.scene_cache = (
+            SceneCache(scene_cache_dir, scene_cache_max_bytes, self._scene_model_tag())
+            if scene_cache_dir
+            else None
+        )
+        self.image_records = (
+            LRUByteCache(image_record_bytes) if incremental_detection else None
+        )
+        self._record_depths = (
+            LRUByteCache(image_record_bytes)
+            if incremental_detection and depth_cache_dir is None
+            else None
+        )
+        self.pipeline = (
+            PipelinedExecutor(
+                self._pipeline_stages(pipeline_workers), queue_size=pipeline_queue_size
+            )
+            if pipelined
+            else None
+        )
+
+    def warmup(self):
+        """
+        Load every vision model and run it on blank inputs, so that compilation
+        (optimized mode) happens before real data arrives. Compiled functions are
+        kept while the model is loaded or parked in the host cache, so this pays off
+        with a budget that keeps the models resident or with `host_cache_gb`.
+        """
+        for name, wrapper in (
+            ("dino", self.dino),
+            ("sam", self.sam),
+            ("depthpro", self.depthpro),
+            ("orient", self.orient),
+        ):
+            with self.model_manager.use(name, wrapper):
+                wrapper.warmup()
+
+    def cache_stats(self) -> dict:
+        """Hit / miss statistics of caches used by the vision models."""
+        stats = {"sam_embeddings": self.sam.cache_stats()}
+        if self.scene_cache is not None:
+            stats["scenes"] = self.scene_cache.stats()
+        if self.image_records is not None:
+            stats["image_records"] = self.image_records.stats()
+        if self.depthpro.cache is not None:
+            stats["depth"] = self.depthpro.cache_stats()
+        if self.quantized_cache is not None:
+            stats["int8_weights"] = self.quantized_cache.stats()
+        return stats
 
     def abstract_scene(self, img: Image.Image, 
                        objects: List[str], 
-                       save_img_path: Optional[str] = None) -> list:
+                       save_img_path: Optional[str] = None) -> SceneAbstraction:
         """
         ExternalVisionModule exposes single method for VLMExtended
         `abstract_scene` gets image and list of objects (e.g [woman, dog, chair])
@@ -35,65 +207,323 @@ class ExternalVisionModule:
             img ([type]): [description]
             objects ([type]): [description]
         Returns:
-            list: list with coordinates and orientations of each object, so vlm can
+            SceneAbstraction: coordinates and orientations of each object, so vlm can
                   later transform it into numerical or visual prompt (look paper)
         """
+        return self.abstract_scenes(
+            [img], [objects], save_img_paths=[save_img_path]
+        )[0]
+
+    def abstract_scenes(
+        self,
+        images: List[Image.Image],
+        objects_per_image: List[List[str]],
+        save_img_paths: Optional[List[Optional[str]]] = None,
+    ) -> List[SceneAbstraction]:
+        """
+        Stage-major version of `abstract_scene`. Every stage (detection, segmentation,
+        depth, orientation) runs for the whole batch before the next one starts,
+        so each model is loaded at most once per batch. With the scene cache enabled
+        only scenes missing from the cache are computed.
+        Args:
+            images (List[Image.Image]): input images
+            objects_per_image (List[List[str]]): objects to look for, one list per image
+            save_img_paths (List[Optional[str]], optional): where to save annotated images
+        Returns:
+            List[SceneAbstraction]: scene abstraction for every image, in input order
+        """
+        if len(images) != len(objects_per_image):
+            raise ValueError("images and objects_per_image must have the same length")
+        save_img_paths = save_img_paths or [None] * len(images)
+        if self.scene_cache is None:
+            return self._abstract_scenes(images, objects_per_image, save_img_paths)
+
+        keys = [
+            self.scene_cache.key(img, objects)
+            for img, objects in zip(images, objects_per_image)
+        ]
+        scenes = [self.scene_cache.get(key) for key in keys]
+        for scene, img, path in zip(scenes, images, save_img_paths):
+            if scene is not None and path:
+                save_img_with_annotation(img=img, res=scene, save_path=path)
+        # questions about the same image and objects in one batch are computed once
+        missing = {}
+        for i, scene in enumerate(scenes):
+            if scene is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            first = [indices[0] for indices in missing.values()]
+            computed = self._abstract_scenes(
+                [images[i] for i in first],
+                [objects_per_image[i] for i in first],
+                [save_img_paths[i] for i in first],
+            )
+            for (key, indices), scene in zip(missing.items(), computed):
+                self.scene_cache.put(key, scene)
+                for i in indices:
+                    scenes[i] = scene
+                for i in indices[1:]:
+                    if save_img_paths[i]:
+                        save_img_with_annotation(
+                            img=images[i], res=scene, save_path=save_img_paths[i]
+                        )
+        return scenes
+
+    def _abstract_scenes(
+        self,
+        images: List[Image.Image],
+        objects_per_image: List[List[str]],
+        save_img_paths: List[Optional[str]],
+    ) -> List[SceneAbstraction]:
+        if self.image_records is None:
+            return self._run_models(images, objects_per_image, save_img_paths)
+
+        hashes = [image_hash(img) for img in images]
+        records = {}
+        new_objects = {}
+        for h, objects in zip(hashes, objects_per_image):
+            if h not in records:
+                records[h] = self.image_records.get(h)
+                new_objects[h] = []
+            record = records[h]
+            names = record.missing(objects) if record else normalize_objects(objects)
+            for name in names:
+                if name not in new_objects[h]:
+                    new_objects[h].append(name)
+
+        # vision models run only for objects never asked about in the image
+        todo = [h for h, names in new_objects.items() if names]
+        first = {h: hashes.index(h) for h in todo}
+        scenes = self._run_models(
+            [images[first[h]] for h in todo],
+            [new_objects[h] for h in todo],
+            [None] * len(todo),
+        )
+        for h, scene in zip(todo, scenes):
+            record = records[h]
+            names = new_objects[h]
+            records[h] = record.merge(scene, names) if record else ImageRecord(scene, names)
+            self.image_records.put(h, records[h], records[h].nbytes)
+
+        results = []
+        for h, img, objects, path in zip(hashes, images, objects_per_image, save_img_paths):
+            scene = records[h].subset(objects)
+            if path:
+                save_img_with_annotation(img=img, res=scene, save_path=path)
+            results.append(scene)
+        return results
 
+    def _run_models(
+        self,
+        images: List[Image.Image],
+        objects_per_image: List[List[str]],
+        save_img_paths: List[Optional[str]],
+    ) -> List[SceneAbstraction]:
+        if not images:
+            return []
+        if self.pipeline is not None:
+            return self._abstract_scenes_pipelined(
+                images, objects_per_image, save_img_paths
+            )
 
         # 1. Object detection with GroundingDINO
-        self.dino.load()
-        boxes, labels = self.dino.detect(img, objects)
-        self.dino.unload()
+        with self.model_manager.use("dino", self.dino):
+            detections = self.dino.detect_batch(images, objects_per_image)
         # 2. SAM masks
-        self.sam.load()
-        masks = self.sam.get_masks(img, boxes)
-        self.sam.unload()
-        # 3. Depth estimation
-        self.depthpro.load()
-        depth_map, focal_length = self.depthpro.estimate_depth(img)
-        self.depthpro.unload()
+        with self.model_manager.use("sam", self.sam):
+            masks = [
+                self.sam.get_masks(img, boxes)
+                for img, (boxes, _) in zip(images, detections)
+            ]
+        # 3. Depth estimation (DepthPro is loaded only if some depth is not cached)
+        depths = [self._cached_depth(img) for img in images]
+        missing = [i for i, depth in enumerate(depths) if depth is None]
+        if missing:
+            with self.model_manager.use("depthpro", self.depthpro):
+                for i in missing:
+                    depths[i] = self.depthpro.compute_depth(images[i])
+                    self._remember_depth(images[i], depths[i])
         #4. Orient anything
-        self.orient.load()
-        orientations = self.orient.estimate_orientation(
-            img, boxes
+        with self.model_manager.use("orient", self.orient):
+            orientations = self.orient.estimate_orientation_batch(
+                images, [boxes for boxes, _ in detections]
+            )
+
+        results = []
+        for i, img in enumerate(images):
+            boxes, labels = detections[i]
+            depth_map, focal_length = depths[i]
+            results.append(
+                self._build_scene(
+                    img,
+                    boxes=boxes,
+                    labels=labels,
+                    masks=masks[i],
+                    depth_map=depth_map,
+                    focal_length=focal_length,
+                    orientations=orientations[i],
+                    save_img_path=save_img_paths[i],
+                )
+            )
+        return results
+
+    def _abstract_scenes_pipelined(
+        self,
+        images: List[Image.Image],
+        objects_per_image: List[List[str]],
+        save_img_paths: List[Optional[str]],
+    ) -> List[SceneAbstraction]:
+        items = [
+            {
+                "img": img,
+                "objects": objects,
+                "save_img_path": path,
+                "depth": self._cached_depth(img),
+            }
+            for img, objects, path in zip(images, objects_per_image, save_img_paths)
+        ]
+        with ExitStack() as stack:
+            # every model stage needs its model for the whole run
+            stack.enter_context(self.model_manager.use("dino", self.dino))
+            stack.enter_context(self.model_manager.use("sam", self.sam))
+            if any(item["depth"] is None for item in items):
+                stack.enter_context(self.model_manager.use("depthpro", self.depthpro))
+            stack.enter_context(self.model_manager.use("orient", self.orient))
+            results = self.pipeline.run(items)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        # annotations are drawn here, matplotlib must not run in the worker threads
+        for img, path, scene in zip(images, save_img_paths, results):
+            if path:
+                save_img_with_annotation(img=img, res=scene, save_path=path)
+        return results
+
+    def _pipeline_stages(self, workers: int) -> List[Stage]:
+        return [
+            Stage("preprocess", self._stage_preprocess, workers=workers),
+            Stage("detect", self._stage_detect),
+            Stage("crop", self._stage_crop, workers=workers),
+            Stage("segment", self._stage_segment),
+            Stage("depth", self._stage_depth),
+            Stage("orient", self._stage_orient),
+            Stage("postprocess", self._stage_postprocess, workers=workers),
+        ]
+
+    def _stage_preprocess(self, item: dict) -> dict:
+        img = item["img"]
+        item["dino_inputs"] = self.dino.preprocess(img, item["objects"])
+        item["sam_inputs"] = self.sam.preprocess(img)
+        if item["depth"] is None:
+            item["depth_inputs"] = self.depthpro.preprocess(img)
+        return item
+
+    def _stage_detect(self, item: dict) -> dict:
+        item["boxes"], item["labels"] = self.dino.detect_preprocessed(
+            item.pop("dino_inputs"), item["img"].size
         )
-        self.orient.unload()
+        return item
 
-        
-        # 5) Compute median positions
+    def _stage_crop(self, item: dict) -> dict:
+        item["orient_inputs"] = self.orient.preprocess([item["img"]], [item["boxes"]])
+        return item
+
+    def _stage_segment(self, item: dict) -> dict:
+        item["masks"] = self.sam.get_masks(
+            item["img"], item["boxes"], sam_inputs=item.pop("sam_inputs")
+        )
+        return item
+
+    def _stage_depth(self, item: dict) -> dict:
+        if item["depth"] is None:
+            item["depth"] = self.depthpro.compute_depth(
+                item["img"], inputs=item.pop("depth_inputs")
+            )
+            self._remember_depth(item["img"], item["depth"])
+        return item
+
+    def _stage_orient(self, item: dict) -> dict:
+        item["orientations"] = self.orient.estimate_orientation_preprocessed(
+            item.pop("orient_inputs"), [item["boxes"]]
+        )[0]
+        return item
+
+    def _stage_postprocess(self, item: dict) -> dict:
+        depth_map, focal_length = item["depth"]
+        return self._build_scene(
+            item["img"],
+            boxes=item["boxes"],
+            labels=item["labels"],
+            masks=item["masks"],
+            depth_map=depth_map,
+            focal_length=focal_length,
+            orientations=item["orientations"],
+        )
+
+    def _cached_depth(self, img: Image.Image):
+        """Depth of an image with a record from memory, otherwise from DepthPro cache."""
+        if self._record_depths is not None:
+            depth = self._record_depths.get(image_hash(img))
+            if depth is not None:
+                return depth
+        return self.depthpro.cached_depth(img)
+
+    def _remember_depth(self, img: Image.Image, depth):
+        """Keep computed depth for later objects of the same image (incremental mode)."""
+        if self._record_depths is not None:
+            self._record_depths.put(image_hash(img), depth, depth[0].nbytes)
 
-        positions = []
-        masks_np = masks.cpu().numpy()
-        for m in masks_np:
-            ys, xs = np.nonzero(m)
-
-            def image_to_camera_coords(x, y, z, f, w, h):
-                x_centered = x - (w / 2)
-                y_centered = -y + (h / 2)
-  
-                X = (x_centered * z) / f
-                Y = (y_centered * z) / f
-
-                return X, Y
-
-            w, h = img.size
-            f = focal_length
-            x_pixel, y_pixel = np.median(xs), np.median(ys)
-            z_depth = np.median(depth_map[m.astype(bool)])
-
-            X_cam, Y_cam = image_to_camera_coords(x_pixel, y_pixel, z_depth, f, w, h)
-            positions.append((
-                float(Y_cam),
-                float(X_cam),
-                float(-z_depth)
-            ))
-        results = {
-            "positions": np.asarray(positions), # [N x (y, x, z)]
-            "boxes": boxes,
-            "labels": labels,
-            "masks": masks,
-            "orientations": orientations,
-        } 
+    def pipeline_stats(self) -> Optional[dict]:
+        """Per-stage queue depth and idle time of pipelined mode (None if disabled)."""
+        return self.pipeline.stats() if self.pipeline is not None else None
+
+    def _scene_model_tag(self) -> str:
+        """Models and settings a cached scene depends on."""
+        orient = self.orient
+        depthpro = self.depthpro
+        return ":".join(
+            [
+                self.dino.model_id,
+                self.sam.model_id,
+                depthpro.model_id,
+                f"{orient.repo_id}/{orient._WEIGHT_FILE}",
+                f"profile={self.dino.profile}",
+                f"backend={self.dino.backend}",
+                f"tta={orient.tta_crops}",
+                f"rembg={int(orient.remove_background)}",
+                f"sparse={int(depthpro.sparse)}/{depthpro.sparse_resolution}",
+                f"incremental={int(self.image_records is not None)}",
+            ]
+        )
+
+    def _build_scene(
+        self,
+        img: Image.Image,
+        boxes,
+        labels,
+        masks,
+        depth_map,
+        focal_length,
+        orientations,
+        save_img_path: Optional[str] = None,
+    ) -> SceneAbstraction:
+        # 5) Compute median positions
+        positions = estimate_positions(
+            masks=masks,
+            boxes=boxes,
+            depth_map=depth_map,
+            focal_length=focal_length,
+            img_size=img.size,
+        )
+        results = SceneAbstraction.from_results(
+            labels=labels,
+            boxes=boxes,
+            positions=positions,  # [N x (y, x, z)]
+            orientations=orientations,
+            masks=masks,
+            image_size=img.size,
+        )
         if save_img_path:
             save_img_with_annotation(img=img, res=results, save_path=save_img_path)
         return results
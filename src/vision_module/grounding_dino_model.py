@@ -1,51 +1,271 @@
-import gc
+import threading
+from typing import Optional
+
 import torch
-from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
+from PIL import Image
+from transformers import AutoConfig, AutoModelForZeroShotObjectDetection, AutoProcessor
+from transformers.models.grounding_dino.modeling_grounding_dino import (
+    GroundingDinoObjectDetectionOutput,
+)
+
+from src.utils.model_manager import (
+    HostWeightCache,
+    module_nbytes,
+    release_device_memory,
+)
+from src.utils.quantization import QuantizedModelCache, check_profile, load_quantized
+from .onnx_backend import GroundingDinoOnnx, check_backend
+from .inference_config import (
+    InferenceConfig,
+    canvas_sizes,
+    fit_canvas,
+    pad_batch,
+    pad_dim,
+)
 
 BOX_THRESHOLD = 0.4
-TEXT_THRESHOLD = (0.3,)
+TEXT_THRESHOLD = 0.3
 
 
 class GroundingDINOModelWrapper:
     def __init__(
-        self, model_id="IDEA-Research/grounding-dino-tiny", device: str = "cuda"
+        self,
+        model_id="IDEA-Research/grounding-dino-tiny",
+        device: str = "cuda",
+        max_batch_size: int = 8,
+        host_cache: Optional[HostWeightCache] = None,
+        profile: str = "fp32",
+        quantized_cache: Optional[QuantizedModelCache] = None,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        onnx_threads: Optional[int] = None,
+        inference_config: Optional[InferenceConfig] = None,
     ):
+        """
+        Args:
+            model_id (str): Grounding DINO checkpoint
+            device (str): device to run model on
+            max_batch_size (int): maximal number of images in one `detect_batch` forward
+            host_cache (HostWeightCache, optional): keeps weights in host memory on unload
+            profile (str): "fp32", or "int8" for dynamic INT8 quantization of Linear
+                layers (CPU only)
+            quantized_cache (QuantizedModelCache, optional): disk cache of int8 weights
+            backend (str): "torch", or "onnx" to run graphs exported by
+                `src.vision_module.onnx_export` with ONNX Runtime
+            onnx_dir (str, optional): directory with exported graphs (onnx backend)
+            onnx_threads (int, optional): ONNX Runtime intra-op threads, None keeps
+                the runtime default
+            inference_config (InferenceConfig, optional): eager (default) or
+                optimized execution of the torch backend
+        """
         self.model_id = model_id
         self.device = device
+        self.max_batch_size = max_batch_size
+        self.host_cache = host_cache
+        self.profile = check_profile(profile, device)
+        self.quantized_cache = quantized_cache
+        self.backend = check_backend(backend, onnx_dir, profile)
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.inference_config = inference_config or InferenceConfig()
+        self._forward = None
+        self._processor_lock = threading.Lock()
         self.processor = None
         self.model = None
 
     def load(self):
+        self._load()
+        if self.inference_config.optimized and self.backend == "torch":
+            config = self.inference_config
+            config.prepare_module(self.model)
+            # text masks are built by a Python loop over special tokens in the top-level
+            # forward, which stays eager; the heavy parts are compiled per shape bucket
+            inner = self.model.model
+            config.compile_modules(
+                [inner.backbone, inner.text_backbone, inner.encoder, inner.decoder],
+                max_shapes=len(canvas_sizes(self.processor.image_processor.size))
+                * len(config.warmup_batch_sizes(self.max_batch_size))
+                * len(config.sequence_buckets),
+            )
+            self._forward = self.model
+
+    def _load(self):
+        restored = (
+            self.host_cache.restore(self.model_id, self.device)
+            if self.host_cache and self.backend == "torch"
+            else None
+        )
+        if restored is not None:
+            self.model, self.processor = restored
+            return
         self.processor = AutoProcessor.from_pretrained(self.model_id)
+        if self.backend == "onnx":
+            self.model = GroundingDinoOnnx(self.onnx_dir, self.device, self.onnx_threads)
+            return
+        if self.profile == "int8":
+            self.model = load_quantized(
+                self.model_id,
+                lambda: AutoModelForZeroShotObjectDetection.from_config(
+                    AutoConfig.from_pretrained(self.model_id)
+                ),
+                lambda: AutoModelForZeroShotObjectDetection.from_pretrained(self.model_id),
+                self.quantized_cache,
+            )
+            return
         self.model = AutoModelForZeroShotObjectDetection.from_pretrained(
             self.model_id
         ).to(self.device)
 
     def unload(self):
         if self.model is not None:
-            self.model.to("cpu")
+            if self.backend == "onnx":
+                pass
+            elif self.host_cache is not None:
+                self.host_cache.park(self.model_id, self.model, self.processor)
+            else:
+                self.model.to("cpu")
             del self.model
+            self._forward = None
             self.model = None
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            release_device_memory()
+
+    def memory_footprint(self) -> int:
+        return module_nbytes(self.model)
 
     def detect(self, img, objects: list):
-        
+        inputs = self.preprocess(img, objects)
+        return self.detect_preprocessed(inputs, img.size)
+
+    def preprocess(self, img, objects: list):
+        """CPU part of `detect`: image resize / normalization and prompt tokenization."""
         # dino expects input in str in format: obj1. obj2 obj3.
-        text_dino = ". ".join(objects) + "."
-        
-        inputs = self.processor(images=img, text=text_dino, return_tensors="pt").to(
-            self.device
-        )
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-
-        detection_results = self.processor.post_process_grounded_object_detection(
-            outputs,
-            inputs.input_ids,
-            box_threshold=0.4,
-            text_threshold=0.3,
-            target_sizes=[img.size[::-1]],
-        )[0]
+        text_dino = self._to_prompt(objects)
+        # fast tokenizers must not be used from several threads at once
+        with self._processor_lock:
+            return self.processor(images=img, text=text_dino, return_tensors="pt")
+
+    def detect_preprocessed(self, inputs, img_size):
+        """
+        Forward pass and post-processing for output of `preprocess`.
+        Args:
+            inputs: processor output for a single image
+            img_size (tuple): (width, height) of the original image
+        """
+        inputs = inputs.to(self.device)
+        outputs = self._model_outputs(inputs)
+
+        # label phrases are decoded with the tokenizer shared with `preprocess`
+        with self._processor_lock:
+            detection_results = self.processor.post_process_grounded_object_detection(
+                outputs,
+                inputs.input_ids,
+                box_threshold=BOX_THRESHOLD,
+                text_threshold=TEXT_THRESHOLD,
+                target_sizes=[img_size[::-1]],
+            )[0]
         return detection_results["boxes"].cpu().numpy().tolist(), detection_results["labels"]
+
+    def detect_batch(self, imgs: list, objects_per_image: list) -> list:
+        """
+        Batched `detect`. Images (padded, with pixel mask) and tokenized prompts
+        (padded, with attention mask) of up to `max_batch_size` images go through
+        a single forward pass, results are split back per image.
+        Args:
+            imgs (list): PIL images
+            objects_per_image (list): list of object names for every image
+        Returns:
+            list: (boxes, labels) for every image, same format as `detect`
+        """
+        if len(imgs) != len(objects_per_image):
+            raise ValueError("imgs and objects_per_image must have the same length")
+
+        # landscape and portrait images are not mixed in one micro-batch, their
+        # padded batch would not fit the fixed canvases of onnx graphs
+        landscape = [i for i, img in enumerate(imgs) if img.width >= img.height]
+        portrait = [i for i, img in enumerate(imgs) if img.width < img.height]
+        results = [None] * len(imgs)
+        for group in (landscape, portrait):
+            for start in range(0, len(group), self.max_batch_size):
+                batch = group[start : start + self.max_batch_size]
+                detections = self._detect_micro_batch(
+                    [imgs[i] for i in batch], [objects_per_image[i] for i in batch]
+                )
+                for i, detection in zip(batch, detections):
+                    results[i] = detection
+        return results
+
+    def _detect_micro_batch(self, batch_imgs: list, objects_per_image: list) -> list:
+        batch_texts = [self._to_prompt(objects) for objects in objects_per_image]
+        with self._processor_lock:
+            inputs = self.processor(
+                images=batch_imgs, text=batch_texts, padding=True, return_tensors="pt"
+            )
+        inputs = inputs.to(self.device)
+        outputs = self._model_outputs(inputs)
+
+        with self._processor_lock:
+            detection_results = self.processor.post_process_grounded_object_detection(
+                outputs,
+                inputs.input_ids,
+                box_threshold=BOX_THRESHOLD,
+                text_threshold=TEXT_THRESHOLD,
+                target_sizes=[img.size[::-1] for img in batch_imgs],
+            )
+        return [
+            (res["boxes"].cpu().numpy().tolist(), res["labels"]) for res in detection_results
+        ]
+
+    def _model_outputs(self, inputs):
+        with self.inference_config.inference_context():
+            if self._forward is None:
+                return self.model(**inputs)
+            n = inputs["pixel_values"].shape[0]
+            outputs = self._forward(**self._bucketed(inputs))
+        return GroundingDinoObjectDetectionOutput(
+            logits=outputs.logits[:n], pred_boxes=outputs.pred_boxes[:n]
+        )
+
+    def _bucketed(self, inputs) -> dict:
+        """
+        Pad images (extending pixel_mask) to the fixed landscape or portrait canvas,
+        text length (extending attention_mask) and batch to buckets, the same kind of
+        padding the processor does for batches.
+        """
+        config = self.inference_config
+        pixel_values = inputs["pixel_values"]
+        n, _, h, w = pixel_values.shape
+        height, width = fit_canvas(
+            h, w, canvas_sizes(self.processor.image_processor.size)
+        )
+        length = config.sequence_bucket(inputs["input_ids"].shape[1])
+
+        pixel_mask = inputs.get("pixel_mask")
+        if pixel_mask is None:
+            pixel_mask = torch.ones((n, h, w), dtype=torch.long, device=pixel_values.device)
+        padded = {
+            "pixel_values": pad_dim(pad_dim(pixel_values, 2, height), 3, width),
+            "pixel_mask": pad_dim(pad_dim(pixel_mask, 1, height), 2, width),
+        }
+        for key in ("input_ids", "attention_mask", "token_type_ids"):
+            if key in inputs:
+                padded[key] = pad_dim(inputs[key], 1, length)
+
+        size = config.batch_bucket(n)
+        padded = {key: pad_batch(value, size) for key, value in padded.items()}
+        padded["pixel_values"] = config.images(padded["pixel_values"])
+        return padded
+
+    def warmup(self, image_sizes=((640, 480), (480, 640)), objects=("object",)):
+        """
+        Run detection on blank images of `image_sizes` (one per canvas) for every batch
+        bucket, so that compilation for typical shapes happens here and not on real
+        data. Longer prompts compile their text bucket on first use.
+        """
+        for size in image_sizes:
+            for n in self.inference_config.warmup_batch_sizes(self.max_batch_size):
+                imgs = [Image.new("RGB", size)] * n
+                self.detect_batch(imgs, [list(objects)] * n)
+
+    @staticmethod
+    def _to_prompt(objects: list) -> str:
+        return ". ".join(objects) + "."
@@ -0,0 +1,141 @@
+"""
+Execution settings shared by the vision model wrappers. The default configuration is
+plain eager inference under `torch.no_grad()`. With `optimized=True` wrappers run under
+`torch.inference_mode`, keep image tensors in channels_last format and call forward
+functions compiled with `torch.compile`. Inputs are padded to a small set of shape
+buckets (batch, text length, fixed image canvases), so the number of compiled graphs
+is bounded; wrappers raise dynamo's recompile limit to that bound.
+"""
+import bisect
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+import torch
+
+
+@dataclass
+class InferenceConfig:
+    """
+    Args:
+        optimized (bool): enable the optimized execution mode
+        channels_last (bool): channels_last memory format of models and image inputs
+        compile (bool): compile forward functions with `torch.compile`
+        compile_mode (str, optional): `torch.compile` mode, None is the default mode
+        batch_buckets (tuple): batch sizes inputs are padded to; larger batches
+            are run as they are
+        sequence_buckets (tuple): text lengths prompts are padded to (Grounding
+            DINO, which truncates text to 256 tokens)
+    """
+
+    optimized: bool = False
+    channels_last: bool = True
+    compile: bool = True
+    compile_mode: Optional[str] = None
+    batch_buckets: Tuple[int, ...] = (1, 2, 4, 8, 16, 32)
+    sequence_buckets: Tuple[int, ...] = (32, 64, 128, 256)
+
+    def inference_context(self):
+        return torch.inference_mode() if self.optimized else torch.no_grad()
+
+    def prepare_module(self, module: torch.nn.Module) -> torch.nn.Module:
+        """Eval mode and, in optimized mode, channels_last weights."""
+        module.eval()
+        if self.optimized and self.channels_last:
+            module.to(memory_format=torch.channels_last)
+        return module
+
+    def compiled(self, fn: Callable, module: Optional[torch.nn.Module] = None) -> Callable:
+        """
+        `fn` compiled with `torch.compile`. The compiled callable is stored on `module`
+        (`fn` itself if it is a module), so when a wrapper gets the same module back
+        from `HostWeightCache` after unloading, compiled graphs are reused. A module
+        loaded from disk again is a new instance and is compiled again.
+        """
+        if not (self.optimized and self.compile):
+            return fn
+        module = fn if module is None else module
+        compiled_fns = module.__dict__.setdefault("_compiled_fns", {})
+        name = getattr(fn, "__name__", "forward")
+        if name not in compiled_fns:
+            compiled_fns[name] = torch.compile(fn, mode=self.compile_mode, dynamic=False)
+        return compiled_fns[name]
+
+    def compile_modules(self, modules: List[torch.nn.Module], max_shapes: int):
+        """
+        Compile `modules` in place (`nn.Module.compile`), for models whose top-level
+        forward has data-dependent Python code that would break the graph. Compiled
+        state lives on the module instances, so it is reused after `HostWeightCache`
+        restore. Dynamo's recompile limit is raised to `max_shapes`, the number of
+        distinct input shapes the wrapper's bucketing can produce.
+        """
+        if not (self.optimized and self.compile):
+            return
+        dynamo_config = torch._dynamo.config
+        # renamed in newer torch
+        limit = (
+            "recompile_limit"
+            if hasattr(dynamo_config, "recompile_limit")
+            else "cache_size_limit"
+        )
+        setattr(dynamo_config, limit, max(getattr(dynamo_config, limit), max_shapes))
+        for module in modules:
+            if getattr(module, "_compiled_call_impl", None) is None:
+                module.compile(mode=self.compile_mode, dynamic=False)
+
+    def images(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Memory format of 4D image batches."""
+        if self.optimized and self.channels_last and pixel_values.dim() == 4:
+            return pixel_values.contiguous(memory_format=torch.channels_last)
+        return pixel_values
+
+    def batch_bucket(self, n: int) -> int:
+        return self.bucket(n, self.batch_buckets)
+
+    def sequence_bucket(self, n: int) -> int:
+        return self.bucket(n, self.sequence_buckets)
+
+    @staticmethod
+    def bucket(n: int, buckets: Tuple[int, ...]) -> int:
+        """Smallest of `buckets` not smaller than `n`, `n` itself above the largest."""
+        i = bisect.bisect_left(buckets, n)
+        return buckets[i] if i < len(buckets) else n
+
+    def warmup_batch_sizes(self, max_batch_size: int) -> list:
+        """Batch buckets a wrapper with `max_batch_size` micro-batches can hit."""
+        sizes = [b for b in self.batch_buckets if b < max_batch_size]
+        return sizes + [self.batch_bucket(max_batch_size)]
+
+
+def canvas_sizes(size: dict) -> List[Tuple[int, int]]:
+    """
+    Landscape and portrait (height, width) canvases that fit every image resized by
+    a processor with `size` ({"shortest_edge", "longest_edge"}).
+    """
+    short, long = size["shortest_edge"], size["longest_edge"]
+    return [(short, long), (long, short)]
+
+
+def fit_canvas(height: int, width: int, canvases) -> Tuple[int, int]:
+    """First of `canvases` that an image of (height, width) fits in."""
+    for canvas_h, canvas_w in canvases:
+        if height <= canvas_h and width <= canvas_w:
+            return canvas_h, canvas_w
+    raise ValueError(f"image of size {height}x{width} does not fit any of {list(canvases)}")
+
+
+def pad_dim(tensor: torch.Tensor, dim: int, size: int, value=0) -> torch.Tensor:
+    """Pad `tensor` at the end of `dim` to `size` with `value`."""
+    missing = size - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor, tensor.new_full(shape, value)], dim=dim)
+
+
+def pad_batch(tensor: torch.Tensor, size: int) -> torch.Tensor:
+    """Pad batch (dim 0) to `size` by repeating the last element."""
+    missing = size - tensor.shape[0]
+    if missing <= 0:
+        return tensor
+    return torch.cat([tensor, tensor[-1:].expand(missing, *tensor.shape[1:])], dim=0)
@@ -0,0 +1,228 @@
+"""
+ONNX Runtime backend of the scene-abstraction models. Graphs are written by
+`python -m src.vision_module.onnx_export`; adapters below wrap ONNX Runtime sessions
+with the call interface of the corresponding torch models, so wrappers keep their
+pre- and post-processing unchanged.
+"""
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+from .inference_config import fit_canvas, pad_dim
+
+BACKENDS = ("torch", "onnx")
+# text length the torch Grounding DINO model truncates prompts to (config.max_text_len)
+MAX_TEXT_LEN = 256
+
+# graph file names inside the export directory
+ONNX_FILES = {
+    # Grounding DINO is traced at fixed landscape and portrait canvases, see
+    # `onnx_export.export_grounding_dino`
+    "grounding_dino_landscape": "grounding_dino_landscape.onnx",
+    "grounding_dino_portrait": "grounding_dino_portrait.onnx",
+    "sam_encoder": "sam_encoder.onnx",
+    "sam_decoder": "sam_decoder.onnx",
+    "depthpro": "depthpro.onnx",
+    "orient_anything": "orient_anything.onnx",
+}
+
+
+def check_backend(backend: str, onnx_dir: Optional[str], profile: str = "fp32") -> str:
+    """Validate runtime backend options of a wrapper."""
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+    if backend == "onnx":
+        if onnx_dir is None:
+            raise ValueError("onnx backend needs onnx_dir with exported graphs")
+        if profile != "fp32":
+            raise ValueError("onnx backend runs exported fp32 graphs only")
+    return backend
+
+
+class OnnxSession:
+    """
+    ONNX Runtime session with explicit thread settings. `intra_op_threads=None` keeps
+    the runtime default (one thread per physical core). Sessions run sequentially,
+    which is faster than the parallel executor for our small batches.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        device="cpu",
+        intra_op_threads: Optional[int] = None,
+        inter_op_threads: int = 1,
+    ):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+
+        providers = ["CPUExecutionProvider"]
+        if (
+            torch.device(device).type == "cuda"
+            and "CUDAExecutionProvider" in ort.get_available_providers()
+        ):
+            providers.insert(0, "CUDAExecutionProvider")
+
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=options, providers=providers)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        # static dimensions are ints, dynamic ones are names
+        self.input_shapes = {i.name: i.shape for i in self.session.get_inputs()}
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    @property
+    def nbytes(self) -> int:
+        return os.path.getsize(self.path)
+
+    def run(self, **inputs) -> Dict[str, torch.Tensor]:
+        """Torch tensors (any device) in, cpu torch tensors out. Extra inputs are ignored."""
+        feeds = {
+            name: np.ascontiguousarray(inputs[name].detach().cpu().numpy())
+            for name in self.input_names
+        }
+        outputs = self.session.run(self.output_names, feeds)
+        return {name: torch.from_numpy(out) for name, out in zip(self.output_names, outputs)}
+
+
+def _session(onnx_dir: str, name: str, device, threads: Optional[int]) -> OnnxSession:
+    path = os.path.join(onnx_dir, ONNX_FILES[name])
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{path} not found, export it with `python -m src.vision_module.onnx_export`"
+        )
+    return OnnxSession(path, device=device, intra_op_threads=threads)
+
+
+class GroundingDinoOnnx:
+    """
+    `model(**processor_outputs)` -> output with `logits` and `pred_boxes`.
+    Images are padded (with pixel_mask) to the fixed canvas of the landscape or
+    portrait graph. Text self-attention masks and position ids depend on positions
+    of special tokens in the prompt, so they are computed here in Python and fed to
+    the graph instead of being traced for the sample prompt.
+    """
+
+    def __init__(self, onnx_dir: str, device="cpu", threads: Optional[int] = None):
+        self.sessions = {
+            tuple(session.input_shapes["pixel_values"][2:]): session
+            for session in (
+                _session(onnx_dir, "grounding_dino_landscape", device, threads),
+                _session(onnx_dir, "grounding_dino_portrait", device, threads),
+            )
+        }
+
+    @property
+    def nbytes(self) -> int:
+        return sum(session.nbytes for session in self.sessions.values())
+
+    def __call__(self, **inputs):
+        from transformers.models.grounding_dino.modeling_grounding_dino import (
+            GroundingDinoObjectDetectionOutput,
+        )
+
+        session = self.sessions[self.canvas(inputs["pixel_values"].shape)]
+        return GroundingDinoObjectDetectionOutput(**session.run(**self.graph_inputs(inputs)))
+
+    def canvas(self, shape) -> tuple:
+        return fit_canvas(shape[-2], shape[-1], list(self.sessions))
+
+    def graph_inputs(self, inputs) -> dict:
+        """Processor outputs padded to the canvas, with text masks and position ids."""
+        return grounding_dino_graph_inputs(inputs, self.canvas(inputs["pixel_values"].shape))
+
+
+def grounding_dino_graph_inputs(inputs, canvas: tuple) -> dict:
+    """
+    Inputs of an exported Grounding DINO graph: processor outputs with images padded
+    to `canvas` (height, width), text truncated like in the torch model, text
+    self-attention masks and position ids.
+    """
+    from transformers.models.grounding_dino.modeling_grounding_dino import (
+        generate_masks_with_special_tokens_and_transfer_map,
+    )
+
+    pixel_values = inputs["pixel_values"]
+    n, _, h, w = pixel_values.shape
+    pixel_mask = inputs.get("pixel_mask")
+    if pixel_mask is None:
+        pixel_mask = torch.ones((n, h, w), dtype=torch.long, device=pixel_values.device)
+    height, width = canvas
+    graph_inputs = {
+        "pixel_values": pad_dim(pad_dim(pixel_values, 2, height), 3, width),
+        "pixel_mask": pad_dim(pad_dim(pixel_mask, 1, height), 2, width),
+    }
+    masks, position_ids = generate_masks_with_special_tokens_and_transfer_map(
+        inputs["input_ids"]
+    )
+    for key in ("input_ids", "attention_mask", "token_type_ids"):
+        graph_inputs[key] = inputs[key][:, :MAX_TEXT_LEN]
+    graph_inputs["text_self_attention_masks"] = masks[:, :MAX_TEXT_LEN, :MAX_TEXT_LEN]
+    graph_inputs["position_ids"] = position_ids[:, :MAX_TEXT_LEN]
+    return graph_inputs
+
+
+class SamOnnx:
+    """Image encoder and prompt encoder / mask decoder as two sessions."""
+
+    def __init__(self, onnx_dir: str, device="cpu", threads: Optional[int] = None):
+        self.encoder = _session(onnx_dir, "sam_encoder", device, threads)
+        self.decoder = _session(onnx_dir, "sam_decoder", device, threads)
+
+    @property
+    def nbytes(self) -> int:
+        return self.encoder.nbytes + self.decoder.nbytes
+
+    def get_image_embeddings(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.encoder.run(pixel_values=pixel_values)["image_embeddings"]
+
+    def __call__(self, image_embeddings: torch.Tensor, input_boxes: torch.Tensor):
+        from transformers.models.sam.modeling_sam import SamImageSegmentationOutput
+
+        out = self.decoder.run(image_embeddings=image_embeddings, input_boxes=input_boxes)
+        return SamImageSegmentationOutput(
+            iou_scores=out["iou_scores"], pred_masks=out["pred_masks"]
+        )
+
+
+class DepthProOnnx:
+    """`model(pixel_values=...)` -> output with `predicted_depth` and `field_of_view`."""
+
+    def __init__(self, onnx_dir: str, config, device="cpu", threads: Optional[int] = None):
+        self.session = _session(onnx_dir, "depthpro", device, threads)
+        self.config = config
+
+    @property
+    def nbytes(self) -> int:
+        return self.session.nbytes
+
+    def __call__(self, pixel_values: torch.Tensor, **_):
+        from transformers.models.depth_pro.modeling_depth_pro import (
+            DepthProDepthEstimatorOutput,
+        )
+
+        out = self.session.run(pixel_values=pixel_values)
+        return DepthProDepthEstimatorOutput(
+            predicted_depth=out["predicted_depth"], field_of_view=out["field_of_view"]
+        )
+
+
+class OrientAnythingOnnx:
+    """`model({"pixel_values": ...})` -> (N, 722) logits, like `DINOv2_MLP`."""
+
+    def __init__(self, onnx_dir: str, device="cpu", threads: Optional[int] = None):
+        self.session = _session(onnx_dir, "orient_anything", device, threads)
+
+    @property
+    def nbytes(self) -> int:
+        return self.session.nbytes
+
+    def __call__(self, img_inputs: dict) -> torch.Tensor:
+        return self.session.run(pixel_values=img_inputs["pixel_values"])["logits"]
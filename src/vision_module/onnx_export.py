@@ -0,0 +1,401 @@
+"""
+Export of scene-abstraction models to ONNX graphs used by the `onnx` backend of the
+wrappers (see `onnx_backend.py`).
+
+    python -m src.vision_module.onnx_export --output_dir onnx/ \
+        --models grounding_dino sam depthpro orient_anything
+"""
+import argparse
+import os
+
+import torch
+from PIL import Image
+from torch import nn
+from transformers.models.grounding_dino import modeling_grounding_dino
+
+from .depthpro_model import DepthProModelWrapper
+from .grounding_dino_model import GroundingDINOModelWrapper
+from .inference_config import canvas_sizes
+from .onnx_backend import ONNX_FILES, grounding_dino_graph_inputs
+from .orient_anything_model import OrientAnythingModelWrapper
+from .sam_model import SAMModelWrapper
+
+OPSET = 17
+
+# exported Grounding DINO graphs are compared with torch on every prompt and image
+# aspect ratio below; graphs that do not match are removed
+PARITY_PROMPTS = (
+    ["person"],
+    ["object", "person"],
+    ["red car", "dog", "traffic light"],
+    ["the chair next to the table", "a cup", "window", "lamp", "book"],
+)
+PARITY_SIZES = ((640, 480), (480, 640), (800, 800), (1600, 600), (600, 1600))
+PARITY_ATOL = 1e-3
+PARITY_RTOL = 1e-3
+# detected boxes, in pixels of the original image
+PARITY_BOX_ATOL = 1.0
+
+
+class _GroundingDinoGraph(nn.Module):
+    """
+    Grounding DINO with text self-attention masks and position ids as inputs. The
+    torch model derives them from special-token positions with Python loops, which
+    tracing would freeze to the sample prompt.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(
+        self,
+        pixel_values,
+        pixel_mask,
+        input_ids,
+        attention_mask,
+        token_type_ids,
+        text_self_attention_masks,
+        position_ids,
+    ):
+        original = modeling_grounding_dino.generate_masks_with_special_tokens_and_transfer_map
+        modeling_grounding_dino.generate_masks_with_special_tokens_and_transfer_map = (
+            lambda _: (text_self_attention_masks, position_ids)
+        )
+        try:
+            out = self.model(
+                pixel_values=pixel_values,
+                pixel_mask=pixel_mask,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+            )
+        finally:
+            modeling_grounding_dino.generate_masks_with_special_tokens_and_transfer_map = (
+                original
+            )
+        return out.logits, out.pred_boxes
+
+
+class _SamEncoderGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_embeddings(pixel_values)
+
+
+class _SamDecoderGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image_embeddings, input_boxes):
+        out = self.model(image_embeddings=image_embeddings, input_boxes=input_boxes)
+        return out.iou_scores, out.pred_masks
+
+
+class _DepthProGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        out = self.model(pixel_values=pixel_values)
+        return out.predicted_depth, out.field_of_view
+
+
+class _OrientAnythingGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model({"pixel_values": pixel_values})
+
+
+def _export(module: nn.Module, args: tuple, path: str, input_names, output_names, dynamic_axes):
+    with torch.no_grad():
+        torch.onnx.export(
+            module.eval(),
+            args,
+            path,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=OPSET,
+            do_constant_folding=True,
+            dynamo=False,
+        )
+    print(f"exported {path}")
+
+
+def export_grounding_dino(output_dir: str, sample: Image.Image):
+    """
+    Export the Grounding DINO graphs and check them against the torch model, graphs
+    that do not match are removed.
+    """
+    wrapper = GroundingDINOModelWrapper(device="cpu")
+    wrapper.load()
+    paths = export_grounding_dino_graphs(output_dir, wrapper, sample)
+    failures = check_grounding_dino(output_dir, sample, wrapper)
+    wrapper.unload()
+    if failures:
+        for path in paths:
+            os.remove(path)
+        raise RuntimeError(
+            "exported Grounding DINO graphs differ from torch, removed them:\n"
+            + "\n".join(failures)
+        )
+
+
+def export_grounding_dino_graphs(output_dir: str, wrapper, sample: Image.Image) -> list:
+    """
+    One graph per fixed canvas (landscape and portrait at the processor's maximal
+    size). Canvas size fixes the padding branches of the Swin backbone and the feature
+    map shapes of deformable attention, which are resolved in Python when tracing.
+    Text length and batch stay dynamic.
+    Args:
+        output_dir (str): directory of the graphs
+        wrapper: loaded torch `GroundingDINOModelWrapper`
+        sample (PIL.Image): image used to trace the graphs
+    Returns:
+        list: paths of the exported graphs
+    """
+    graph = _GroundingDinoGraph(wrapper.model).eval()
+    canvases = canvas_sizes(wrapper.processor.image_processor.size)
+    paths = [
+        os.path.join(output_dir, ONNX_FILES[name])
+        for name in ("grounding_dino_landscape", "grounding_dino_portrait")
+    ]
+    names = [
+        "pixel_values",
+        "pixel_mask",
+        "input_ids",
+        "attention_mask",
+        "token_type_ids",
+        "text_self_attention_masks",
+        "position_ids",
+    ]
+    inputs = wrapper.preprocess(sample, ["object", "person"])
+    for canvas, path in zip(canvases, paths):
+        graph_inputs = grounding_dino_graph_inputs(inputs, canvas)
+        _export(
+            graph,
+            tuple(graph_inputs[name] for name in names),
+            path,
+            input_names=names,
+            output_names=["logits", "pred_boxes"],
+            dynamic_axes={
+                "pixel_values": {0: "batch"},
+                "pixel_mask": {0: "batch"},
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_type_ids": {0: "batch", 1: "sequence"},
+                "text_self_attention_masks": {0: "batch", 1: "sequence", 2: "sequence"},
+                "position_ids": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+                "pred_boxes": {0: "batch"},
+            },
+        )
+    return paths
+
+
+def check_grounding_dino(output_dir: str, sample: Image.Image, wrapper=None) -> list:
+    """
+    Exported graphs vs the torch model, for every prompt of `PARITY_PROMPTS` and image
+    size of `PARITY_SIZES`, single images and batches:
+    - raw outputs of the graphs and of the torch model on the same canvas-padded inputs
+    - boxes and labels of `detect` / `detect_batch` with the onnx backend vs the torch
+      backend on the unpadded images, which also covers the effect of canvas padding
+    Args:
+        output_dir (str): directory of the exported graphs
+        sample (PIL.Image): image resized to every size of `PARITY_SIZES`
+        wrapper: loaded torch `GroundingDINOModelWrapper`, loaded here if None
+    Returns:
+        list: descriptions of mismatches
+    """
+    loaded_here = wrapper is None
+    if loaded_here:
+        wrapper = GroundingDINOModelWrapper(device="cpu")
+        wrapper.load()
+    graph = _GroundingDinoGraph(wrapper.model).eval()
+    onnx_wrapper = GroundingDINOModelWrapper(
+        model_id=wrapper.model_id, device="cpu", backend="onnx", onnx_dir=output_dir
+    )
+    onnx_wrapper.load()
+
+    cases = [
+        ([sample.resize(size)], [objects])
+        for objects in PARITY_PROMPTS
+        for size in PARITY_SIZES
+    ]
+    # batches, `detect_batch` never mixes landscape and portrait images
+    for portrait in (False, True):
+        sizes = [size for size in PARITY_SIZES if (size[0] < size[1]) == portrait]
+        cases.append(
+            (
+                [sample.resize(size) for size in sizes],
+                [PARITY_PROMPTS[i % len(PARITY_PROMPTS)] for i in range(len(sizes))],
+            )
+        )
+    failures = []
+    for imgs, prompts in cases:
+        inputs = wrapper.processor(
+            images=imgs,
+            text=[wrapper._to_prompt(objects) for objects in prompts],
+            padding=True,
+            return_tensors="pt",
+        )
+        graph_inputs = onnx_wrapper.model.graph_inputs(inputs)
+        with torch.no_grad():
+            expected = graph(**graph_inputs)
+        actual = onnx_wrapper.model(**inputs)
+        for name, e, a in zip(
+            ("logits", "pred_boxes"), expected, (actual.logits, actual.pred_boxes)
+        ):
+            if e.shape != a.shape or not torch.allclose(
+                e, a, atol=PARITY_ATOL, rtol=PARITY_RTOL
+            ):
+                diff = (e - a).abs().max().item() if e.shape == a.shape else float("nan")
+                failures.append(
+                    f"{name} differs (max abs diff {diff:.2e}) for sizes "
+                    f"{[img.size for img in imgs]}, prompts {prompts}"
+                )
+
+        if len(imgs) == 1:
+            expected_detections = [wrapper.detect(imgs[0], prompts[0])]
+            actual_detections = [onnx_wrapper.detect(imgs[0], prompts[0])]
+        else:
+            expected_detections = wrapper.detect_batch(imgs, prompts)
+            actual_detections = onnx_wrapper.detect_batch(imgs, prompts)
+        for img, objects, e, a in zip(imgs, prompts, expected_detections, actual_detections):
+            failures.extend(
+                f"{mismatch} for size {img.size}, prompt {objects}"
+                for mismatch in compare_detections(e, a)
+            )
+
+    onnx_wrapper.unload()
+    if loaded_here:
+        wrapper.unload()
+    print(f"grounding dino parity: {len(cases)} cases, {len(failures)} mismatches")
+    return failures
+
+
+def compare_detections(expected, actual, atol: float = PARITY_BOX_ATOL) -> list:
+    """
+    Args:
+        expected (tuple): (boxes, labels) of the reference backend
+        actual (tuple): (boxes, labels) of the checked backend
+        atol (float): tolerance of box coordinates, in pixels
+    Returns:
+        list: descriptions of mismatches, empty if detections match
+    """
+    (expected_boxes, expected_labels), (actual_boxes, actual_labels) = expected, actual
+    if list(expected_labels) != list(actual_labels):
+        return [f"labels differ ({expected_labels} vs {actual_labels})"]
+    if not expected_boxes:
+        return []
+    diff = (torch.tensor(expected_boxes) - torch.tensor(actual_boxes)).abs().max().item()
+    if diff > atol:
+        return [f"boxes differ (max abs diff {diff:.2f} px)"]
+    return []
+
+
+def export_sam(output_dir: str, sample: Image.Image):
+    wrapper = SAMModelWrapper(device="cpu", embedding_cache_bytes=0)
+    wrapper.load()
+    pixel_values = wrapper.preprocess(sample).pixel_values
+    _export(
+        _SamEncoderGraph(wrapper.model),
+        (pixel_values,),
+        os.path.join(output_dir, ONNX_FILES["sam_encoder"]),
+        input_names=["pixel_values"],
+        output_names=["image_embeddings"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeddings": {0: "batch"}},
+    )
+    with torch.no_grad():
+        image_embeddings = wrapper.model.get_image_embeddings(pixel_values)
+    input_boxes = torch.tensor([[[10.0, 10.0, 200.0, 200.0], [50.0, 60.0, 300.0, 400.0]]])
+    _export(
+        _SamDecoderGraph(wrapper.model),
+        (image_embeddings, input_boxes),
+        os.path.join(output_dir, ONNX_FILES["sam_decoder"]),
+        input_names=["image_embeddings", "input_boxes"],
+        output_names=["iou_scores", "pred_masks"],
+        dynamic_axes={
+            "image_embeddings": {0: "batch"},
+            "input_boxes": {0: "batch", 1: "boxes"},
+            "iou_scores": {0: "batch", 1: "boxes"},
+            "pred_masks": {0: "batch", 1: "boxes"},
+        },
+    )
+    wrapper.unload()
+
+
+def export_depthpro(output_dir: str, sample: Image.Image):
+    wrapper = DepthProModelWrapper(device="cpu")
+    wrapper.load()
+    pixel_values = wrapper.preprocess(sample).pixel_values
+    _export(
+        _DepthProGraph(wrapper.model),
+        (pixel_values,),
+        os.path.join(output_dir, ONNX_FILES["depthpro"]),
+        input_names=["pixel_values"],
+        output_names=["predicted_depth", "field_of_view"],
+        dynamic_axes={
+            "pixel_values": {0: "batch"},
+            "predicted_depth": {0: "batch"},
+            "field_of_view": {0: "batch"},
+        },
+    )
+    wrapper.unload()
+
+
+def export_orient_anything(output_dir: str, sample: Image.Image):
+    wrapper = OrientAnythingModelWrapper(device="cpu")
+    wrapper.load()
+    pixel_values = wrapper.preprocess([sample], [[(0, 0, *sample.size)]])
+    _export(
+        _OrientAnythingGraph(wrapper.dino_mlp),
+        (pixel_values,),
+        os.path.join(output_dir, ONNX_FILES["orient_anything"]),
+        input_names=["pixel_values"],
+        output_names=["logits"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+    )
+    wrapper.unload()
+
+
+EXPORTERS = {
+    "grounding_dino": export_grounding_dino,
+    "sam": export_sam,
+    "depthpro": export_depthpro,
+    "orient_anything": export_orient_anything,
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Export vision models to ONNX.")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--models", nargs="+", choices=list(EXPORTERS), default=list(EXPORTERS))
+    parser.add_argument(
+        "--sample_image",
+        type=str,
+        default=None,
+        help="Image used to trace and check the graphs, 640x480 noise by default.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    os.makedirs(args.output_dir, exist_ok=True)
+    sample = (
+        Image.open(args.sample_image).convert("RGB")
+        if args.sample_image
+        else Image.effect_noise((640, 480), 64).convert("RGB")
+    )
+    for name in args.models:
+        EXPORTERS[name](args.output_dir, sample)
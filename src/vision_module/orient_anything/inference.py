@@ -3,6 +3,7 @@ from PIL import Image
 from .utils import *
 import torch.nn.functional as F
 import numpy as np
+from torchvision.ops import roi_align
 
 def get_3angle(image, dino, val_preprocess, device):
  
@@ -23,6 +24,114 @@ def get_3angle(image, dino, val_preprocess, device):
     angles[3]  = confidence
     return angles
 
+def get_3angle_batch(images, dino, val_preprocess, device, max_batch_size=32):
+    """
+    Batched `get_3angle`: all images go through the model in micro-batches of
+    at most `max_batch_size`. Returns (N, 4) tensor of (azimuth, polar, rotation, confidence).
+    """
+    pixel_values = preprocess_images(images, val_preprocess)
+    return get_3angle_from_pixels(pixel_values, dino, device, max_batch_size)
+
+def preprocess_images(images, val_preprocess):
+    """PIL images -> (N, 3, 224, 224) pixel_values tensor on cpu."""
+    if len(images) == 0:
+        return torch.zeros((0, 3, 224, 224))
+    image_inputs = val_preprocess(images = images)
+    return torch.from_numpy(np.array(image_inputs['pixel_values']))
+
+def get_3angle_from_pixels(pixel_values, dino, device, max_batch_size=32):
+    """Model forward over preprocessed pixel_values in micro-batches, (N, 4) angles."""
+    if len(pixel_values) == 0:
+        return torch.zeros((0, 4))
+    return angles_from_prediction(predict_from_pixels(pixel_values, dino, device, max_batch_size))
+
+def predict_from_pixels(pixel_values, dino, device, max_batch_size=32):
+    """Raw model output for preprocessed pixel_values, forward in micro-batches."""
+    preds = []
+    for start in range(0, len(pixel_values), max_batch_size):
+        image_inputs = {'pixel_values': pixel_values[start:start + max_batch_size].to(device)}
+        with torch.no_grad():
+            preds.append(dino(image_inputs))
+    return torch.cat(preds, dim=0)
+
+def angles_from_prediction(dino_pred):
+    """Argmax over angle bins and confidence for every row of model output."""
+    angles = torch.zeros((dino_pred.shape[0], 4))
+    angles[:, 0] = torch.argmax(dino_pred[:, 0:360], dim=-1).cpu()
+    angles[:, 1] = torch.argmax(dino_pred[:, 360:360+180], dim=-1).cpu() - 90
+    angles[:, 2] = torch.argmax(dino_pred[:, 360+180:360+180+180], dim=-1).cpu() - 90
+    angles[:, 3] = F.softmax(dino_pred[:, -2:], dim=-1)[:, 0].cpu()
+    return angles
+
+def random_crop_boxes(boxes, num, crop_scale=(0.8, 0.95), generator=None):
+    """
+    Vectorized `random_crop` of every box region: (N, 4) boxes -> (N * num, 4) crop
+    boxes (x0, y0, x1, y1) in image pixels, `num` consecutive rows for every box.
+    """
+    boxes = torch.as_tensor(boxes, dtype=torch.float32).reshape(-1, 4).floor()
+    boxes = boxes.repeat_interleave(num, dim=0)
+    size = boxes[:, 2:] - boxes[:, :2]
+    low = (size * crop_scale[0]).floor()
+    high = (size * crop_scale[1]).floor()
+    crop = low + (torch.rand(size.shape, generator=generator) * (high - low + 1)).floor()
+    crop = torch.minimum(crop.clamp(min=1), size.clamp(min=1))
+    offset = (torch.rand(size.shape, generator=generator) * (size - crop + 1).clamp(min=0)).floor()
+    top_left = boxes[:, :2] + offset
+    return torch.cat([top_left, top_left + crop], dim=1)
+
+def processor_view_boxes(crop_boxes, shortest_edge=256, crop_size=224):
+    """
+    Part of every crop kept by the DINOv2 processor (resize of the shortest edge to
+    `shortest_edge`, then center crop `crop_size`), as square boxes in image pixels.
+    """
+    wh = crop_boxes[:, 2:] - crop_boxes[:, :2]
+    side = wh.min(dim=1, keepdim=True).values * crop_size / shortest_edge
+    center = (crop_boxes[:, :2] + crop_boxes[:, 2:]) / 2
+    return torch.cat([center - side / 2, center + side / 2], dim=1)
+
+def preprocess_tta(image, boxes, val_preprocess, num=6, generator=None):
+    """
+    Test-time augmentation crops of all boxes of one image as tensor ops: random crops,
+    processor resize / center crop (one `roi_align` over the whole image, bilinear
+    instead of processor's bicubic) and normalization.
+    Returns:
+        (N * num, 3, crop_size, crop_size) pixel_values, `num` consecutive rows per box
+    """
+    crop_size = val_preprocess.crop_size["height"]
+    if len(boxes) == 0:
+        return torch.zeros((0, 3, crop_size, crop_size))
+    pixels = torch.from_numpy(np.array(image.convert('RGB'))).permute(2, 0, 1).float() / 255
+    views = processor_view_boxes(
+        random_crop_boxes(boxes, num, generator=generator),
+        shortest_edge=val_preprocess.size["shortest_edge"],
+        crop_size=crop_size,
+    )
+    rois = torch.cat([torch.zeros((len(views), 1)), views], dim=1)
+    crops = roi_align(pixels[None], rois, output_size=crop_size, spatial_scale=1.0, aligned=True)
+    mean = torch.tensor(val_preprocess.image_mean).view(1, 3, 1, 1)
+    std = torch.tensor(val_preprocess.image_std).view(1, 3, 1, 1)
+    return (crops - mean) / std
+
+def angles_from_tta_prediction(dino_pred, num):
+    """
+    Model output for `num` augmented crops per object -> (N, 4) angles. Outliers are
+    rejected and remaining predictions averaged for all objects at once (circular mean
+    for azimuth), confidence is averaged over crops.
+    """
+    n = dino_pred.shape[0] // num
+    angles = torch.zeros((n, 4))
+    if n == 0:
+        return angles
+    dino_pred = dino_pred.float().cpu()
+    gaus_ax_pred = torch.argmax(dino_pred[:, 0:360], dim=-1).float().view(n, num)
+    gaus_pl_pred = torch.argmax(dino_pred[:, 360:360+180], dim=-1).float().view(n, num)
+    gaus_ro_pred = torch.argmax(dino_pred[:, 360+180:360+180+180], dim=-1).float().view(n, num)
+    angles[:, 0] = remove_outliers_and_average_circular_batch(gaus_ax_pred)
+    angles[:, 1] = remove_outliers_and_average_batch(gaus_pl_pred) - 90
+    angles[:, 2] = remove_outliers_and_average_batch(gaus_ro_pred) - 90
+    angles[:, 3] = F.softmax(dino_pred[:, -2:], dim=-1)[:, 0].view(n, num).mean(dim=1)
+    return angles
+
 def get_3angle_infer_aug(origin_img, rm_bkg_img, dino, val_preprocess, device):
     
     # image = Image.open(image_path).convert('RGB')
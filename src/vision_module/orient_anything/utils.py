@@ -1,5 +1,8 @@
 import rembg
 import random
+import queue
+import threading
+from contextlib import contextmanager
 import torch
 import numpy as np
 from PIL import Image, ImageOps
@@ -91,16 +94,88 @@ def get_crop_images(img, num=3):
         cropped_images.append(random_crop(img))
     return cropped_images
 
-def background_preprocess(input_image, do_remove_background):
+class RembgSessionPool:
+    """
+    Pool of rembg sessions shared by threads. Sessions (ONNX models) are created
+    lazily, at most `size` of them; a thread asking for a session when all are busy
+    waits for one to be returned.
+    """
 
-    rembg_session = rembg.new_session() if do_remove_background else None
+    def __init__(self, size=1, model_name="u2net"):
+        assert size >= 1, "pool needs at least one session"
+        self.size = size
+        self.model_name = model_name
+        self._available = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self):
+        try:
+            rembg_session = self._available.get_nowait()
+        except queue.Empty:
+            rembg_session = self._new_session_or_wait()
+        try:
+            yield rembg_session
+        finally:
+            self._available.put(rembg_session)
+
+    def _new_session_or_wait(self):
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._available.get()
+        try:
+            return rembg.new_session(self.model_name)
+        except BaseException:
+            with self._lock:
+                self._created -= 1
+            raise
+
+_SESSION_POOL = None
+_SESSION_POOL_LOCK = threading.Lock()
+
+def configure_rembg_pool(size=1, model_name="u2net"):
+    """Replace the process-wide rembg session pool (e.g. one session per worker thread)."""
+    global _SESSION_POOL
+    with _SESSION_POOL_LOCK:
+        _SESSION_POOL = RembgSessionPool(size=size, model_name=model_name)
+    return _SESSION_POOL
+
+def get_rembg_pool():
+    """Process-wide rembg session pool, created with a single session on first use."""
+    global _SESSION_POOL
+    with _SESSION_POOL_LOCK:
+        if _SESSION_POOL is None:
+            _SESSION_POOL = RembgSessionPool()
+        return _SESSION_POOL
+
+def remove_background_many(images, force=False, pool=None, **rembg_kwargs):
+    """`remove_background` of several images, all run through one pooled session."""
+    pool = pool or get_rembg_pool()
+    with pool.session() as rembg_session:
+        return [remove_background(image, rembg_session, force, **rembg_kwargs) for image in images]
+
+def foreground_or_image(image, ratio=0.85):
+    """`resize_foreground` of background-free image, image itself if nothing is left in it."""
+    if image.mode != "RGBA" or image.getextrema()[3][1] == 0:
+        return image
+    return resize_foreground(image, ratio)
+
+def background_preprocess(input_image, do_remove_background):
 
     if do_remove_background:
-        input_image = remove_background(input_image, rembg_session)
+        input_image = remove_background_many([input_image])[0]
         input_image = resize_foreground(input_image, 0.85)
 
     return input_image
 
+def background_preprocess_many(images):
+    """`background_preprocess` with background removal for several images."""
+    return [foreground_or_image(image) for image in remove_background_many(images)]
+
 def remove_outliers_and_average(tensor, threshold=1.5):
     assert tensor.dim() == 1, "dimension of input Tensor must equal to 1"
 
@@ -163,6 +238,48 @@ def remove_outliers_and_average_circular(tensor, threshold=1.5):
 
     return mean_angle
 
+def _masked_row_mean(tensor, keep):
+    """Mean of `tensor[i][keep[i]]` for every row, mean of the whole row if nothing is kept."""
+    count = keep.sum(dim=1)
+    mean = (tensor * keep).sum(dim=1) / count.clamp(min=1)
+    return torch.where(count > 0, mean, tensor.mean(dim=1))
+
+def _iqr_inliers(tensor, threshold):
+    """(N, K) bool mask of values within [q1 - threshold * iqr, q3 + threshold * iqr] of their row."""
+    q = torch.tensor([0.25, 0.75], dtype=tensor.dtype, device=tensor.device)
+    q1, q3 = torch.quantile(tensor, q, dim=1, keepdim=True)
+    iqr = q3 - q1
+    return (tensor >= q1 - threshold * iqr) & (tensor <= q3 + threshold * iqr)
+
+def remove_outliers_and_average_batch(tensor, threshold=1.5):
+    """
+    `remove_outliers_and_average` for every row of (N, K) tensor at once.
+    Returns (N,) tensor.
+    """
+    assert tensor.dim() == 2, "dimension of input Tensor must equal to 2"
+    return _masked_row_mean(tensor, _iqr_inliers(tensor, threshold))
+
+def remove_outliers_and_average_circular_batch(tensor, threshold=1.5):
+    """
+    `remove_outliers_and_average_circular` for every row of (N, K) tensor of angles
+    in degrees at once. Returns (N,) tensor of angles in [0, 360).
+    """
+    assert tensor.dim() == 2, "dimension of input Tensor must equal to 2"
+    radians = tensor * torch.pi / 180.0
+    x_coords = torch.cos(radians)
+    y_coords = torch.sin(radians)
+
+    mean_x = torch.mean(x_coords, dim=1, keepdim=True)
+    mean_y = torch.mean(y_coords, dim=1, keepdim=True)
+    differences = torch.sqrt((x_coords - mean_x) ** 2 + (y_coords - mean_y) ** 2)
+    keep = _iqr_inliers(differences, threshold)
+
+    # rows without inliers fall back to the mean vector of all angles
+    mean_x = _masked_row_mean(x_coords, keep)
+    mean_y = _masked_row_mean(y_coords, keep)
+    mean_angle = torch.atan2(mean_y, mean_x) * 180.0 / torch.pi
+    return (mean_angle + 360) % 360
+
 def scale(x):
     # print(x)
     # if abs(x[0])<0.1 and abs(x[1])<0.1:
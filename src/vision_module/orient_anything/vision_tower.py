@@ -97,18 +97,30 @@ class DINOv2_MLP(nn.Module):
                  out_dim,
                  evaluate,
                  mask_dino,
-                 frozen_back
+                 frozen_back,
+                 pretrained_backbone=True,
+                 backbone_path=None,
+                 local_files_only=False
                 ) -> None:
+        """
+        pretrained_backbone=False builds DINOv2 from its config only (random weights),
+        for the case when the whole state dict is loaded right after construction.
+        backbone_path overrides huggingface id of the backbone (e.g. a local directory).
+        """
         super().__init__()
         # self.dinov2 = AutoModel.from_pretrained(DINO_BASE)
-        if dino_mode == 'base':
-            self.dinov2 = FLIP_DINOv2.from_pretrained(DINO_BASE, cache_dir='./')
-        elif dino_mode == 'large':
-            self.dinov2 = FLIP_DINOv2.from_pretrained(DINO_LARGE, cache_dir='./')
-        elif dino_mode == 'small':
-            self.dinov2 = FLIP_DINOv2.from_pretrained(DINO_SMALL, cache_dir='./')
-        elif dino_mode == 'giant':
-            self.dinov2 = FLIP_DINOv2.from_pretrained(DINO_GIANT, cache_dir='./')
+        if backbone_path is None:
+            backbone_path = {
+                'base': DINO_BASE,
+                'large': DINO_LARGE,
+                'small': DINO_SMALL,
+                'giant': DINO_GIANT,
+            }[dino_mode]
+        if pretrained_backbone:
+            self.dinov2 = FLIP_DINOv2.from_pretrained(backbone_path, cache_dir='./', local_files_only=local_files_only)
+        else:
+            config = Dinov2Config.from_pretrained(backbone_path, cache_dir='./', local_files_only=local_files_only)
+            self.dinov2 = FLIP_DINOv2(config)
         
         self.down_sampler = MLP_dim(in_dim=in_dim, out_dim=out_dim)
         self.random_mask  = False
@@ -149,7 +161,15 @@ class DINOv2_MLP(nn.Module):
         # down_sample_out = down_sample_out[:,0,:]
         
         return down_sample_out
-    
+
+    def forward_inference(self, pixel_values):
+        """
+        `forward` for evaluation only: tensor in, no masking and no grad-mode
+        switching, so that it can be compiled into a single graph.
+        """
+        dino_seq = self.dinov2(pixel_values=pixel_values).last_hidden_state[:, 0, :]
+        return self.down_sampler(dino_seq)
+
     def get_device(self):
         return next(self.parameters()).device
     
@@ -1,70 +1,298 @@
 
 import os
-import gc
+from typing import Optional
+
 import torch
 from PIL import Image
 from transformers import AutoImageProcessor
 from huggingface_hub import hf_hub_download
+from safetensors.torch import load_file
 from .orient_anything.vision_tower import DINOv2_MLP
-from .orient_anything.inference import get_3angle
+from .orient_anything.paths import DINO_LARGE
+from .orient_anything.utils import background_preprocess_many
+from .orient_anything.inference import (
+    angles_from_prediction,
+    angles_from_tta_prediction,
+    get_3angle,
+    predict_from_pixels,
+    preprocess_images,
+    preprocess_tta,
+)
 import numpy as np
 from scipy.spatial.transform import Rotation
 
+from src.utils.model_manager import (
+    HostWeightCache,
+    module_nbytes,
+    release_device_memory,
+)
+from src.utils.quantization import QuantizedModelCache, check_profile, load_quantized
+from .onnx_backend import OrientAnythingOnnx, check_backend
+from .inference_config import InferenceConfig, pad_batch
+
 
 class OrientAnythingModelWrapper:
     _OUT_DIM = 360 + 180 + 180 + 2
+    _WEIGHT_FILE = "croplargeEX2/dino_weight.pt"
 
-    def __init__(self, device="cuda", cache_dir=None):
+    def __init__(
+        self,
+        device="cuda",
+        cache_dir=None,
+        max_batch_size: int = 32,
+        host_cache: Optional[HostWeightCache] = None,
+        model_dir: Optional[str] = None,
+        local_files_only: bool = False,
+        tta_crops: int = 0,
+        tta_seed: Optional[int] = None,
+        remove_background: bool = False,
+        profile: str = "fp32",
+        quantized_cache: Optional[QuantizedModelCache] = None,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        onnx_threads: Optional[int] = None,
+        inference_config: Optional[InferenceConfig] = None,
+    ):
+        """
+        Args:
+            device (str): device to run model on
+            cache_dir (str, optional): huggingface download directory
+            max_batch_size (int): maximal number of crops in one forward pass
+            host_cache (HostWeightCache, optional): keeps weights in host memory on unload
+            model_dir (str, optional): local model directory, nothing is downloaded.
+                Expected layout: `croplargeEX2/dino_weight.pt` (or `.safetensors`) and
+                `dinov2-large/` with backbone config and preprocessor config.
+            local_files_only (bool): offline mode for huggingface hub downloads
+            tta_crops (int): number of random crops per object for test-time
+                augmentation, predictions are averaged with outlier rejection.
+                0 disables augmentation (single crop of the box).
+            tta_seed (int, optional): seed of the augmentation crops
+            remove_background (bool): remove background of every crop with rembg
+                (pooled sessions, see `configure_rembg_pool`) before estimation
+            profile (str): "fp32", or "int8" for dynamic INT8 quantization of the
+                DINOv2 backbone (CPU only)
+            quantized_cache (QuantizedModelCache, optional): disk cache of int8 weights
+            backend (str): "torch", or "onnx" to run graph exported by
+                `src.vision_module.onnx_export` with ONNX Runtime
+            onnx_dir (str, optional): directory with exported graphs (onnx backend)
+            onnx_threads (int, optional): ONNX Runtime intra-op threads, None keeps
+                the runtime default
+            inference_config (InferenceConfig, optional): eager (default) or
+                optimized execution of the torch backend
+        """
         self.device = device
+        self.model_dir = model_dir
+        self.local_files_only = local_files_only
+        self.host_cache = host_cache
+        self.profile = check_profile(profile, device)
+        self.quantized_cache = quantized_cache
+        self.backend = check_backend(backend, onnx_dir, profile)
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.inference_config = inference_config or InferenceConfig()
+        self._forward = None
+        self.max_batch_size = max_batch_size
+        self.tta_crops = tta_crops
+        self.remove_background = remove_background
+        self.tta_generator = torch.Generator()
+        if tta_seed is not None:
+            self.tta_generator.manual_seed(tta_seed)
         self.cache_dir = cache_dir or os.getcwd()
         self.repo_id = "Viglong/Orient-Anything"
         self.dino_mlp = None
         self.processor = None
 
     def load(self):
-        weight_path = hf_hub_download(
-            repo_id=self.repo_id,
-            filename="croplargeEX2/dino_weight.pt",
+        self._load()
+        if self.inference_config.optimized and self.backend == "torch":
+            self.inference_config.prepare_module(self.dino_mlp)
+            self._forward = self.inference_config.compiled(
+                self.dino_mlp.forward_inference, self.dino_mlp
+            )
+
+    def _load(self):
+        restored = (
+            self.host_cache.restore(self.repo_id, self.device)
+            if self.host_cache and self.backend == "torch"
+            else None
+        )
+        if restored is not None:
+            self.dino_mlp, self.processor = restored
+            return
+        backbone_path = (
+            os.path.join(self.model_dir, "dinov2-large") if self.model_dir else DINO_LARGE
+        )
+        if self.backend == "onnx":
+            self.dino_mlp = OrientAnythingOnnx(self.onnx_dir, self.device, self.onnx_threads)
+        elif self.profile == "int8":
+            # only the DINOv2 backbone is quantized, the small MLP head stays in fp32
+            self.dino_mlp = load_quantized(
+                self.repo_id,
+                lambda: self._build(backbone_path),
+                lambda: self._build_pretrained(backbone_path),
+                self.quantized_cache,
+                submodules=["dinov2"],
+            )
+        else:
+            self.dino_mlp = self._build_pretrained(backbone_path).to(self.device).eval()
+
+        self.processor = AutoImageProcessor.from_pretrained(
+            backbone_path,
             cache_dir=self.cache_dir,
-            repo_type="model",
+            local_files_only=self.local_files_only,
         )
-        self.dino_mlp = DINOv2_MLP(
+
+    def _build(self, backbone_path: str) -> DINOv2_MLP:
+        return DINOv2_MLP(
             dino_mode="large",
             in_dim=1024,
             out_dim=self._OUT_DIM,
             evaluate=True,
             mask_dino=False,
             frozen_back=False,
+            pretrained_backbone=False,
+            backbone_path=backbone_path,
+            local_files_only=self.local_files_only,
         )
-        state = torch.load(weight_path, map_location="cpu")
-        self.dino_mlp.load_state_dict(state)
-        self.dino_mlp = self.dino_mlp.to(self.device).eval()
 
-        backbone_id = "facebook/dinov2-large"
-        self.processor = AutoImageProcessor.from_pretrained(
-            backbone_id, cache_dir=self.cache_dir
-        )
+    def _build_pretrained(self, backbone_path: str) -> DINOv2_MLP:
+        # Backbone is built from config only on meta device (no memory, no init),
+        # all weights come from fine-tuned checkpoint, which is memory-mapped.
+        with torch.device("meta"):
+            dino_mlp = self._build(backbone_path)
+        dino_mlp.load_state_dict(self._load_checkpoint(), assign=True)
+        return dino_mlp
+
+    def _load_checkpoint(self) -> dict:
+        if self.model_dir:
+            weight_path = os.path.join(self.model_dir, self._WEIGHT_FILE)
+            safetensors_path = os.path.splitext(weight_path)[0] + ".safetensors"
+            if os.path.exists(safetensors_path):
+                return load_file(safetensors_path, device="cpu")
+        else:
+            weight_path = hf_hub_download(
+                repo_id=self.repo_id,
+                filename=self._WEIGHT_FILE,
+                cache_dir=self.cache_dir,
+                repo_type="model",
+                local_files_only=self.local_files_only,
+            )
+        return torch.load(weight_path, map_location="cpu", mmap=True, weights_only=True)
 
     def unload(self):
         if self.dino_mlp is not None:
-            self.dino_mlp.to("cpu")
+            if self.backend == "onnx":
+                pass
+            elif self.host_cache is not None:
+                self.host_cache.park(self.repo_id, self.dino_mlp, self.processor)
+            else:
+                self.dino_mlp.to("cpu")
             del self.dino_mlp, self.processor
+            self._forward = None
             self.dino_mlp = None
             self.processor = None
-            torch.cuda.empty_cache()
-            gc.collect()
+            release_device_memory()
+
+    def memory_footprint(self) -> int:
+        return module_nbytes(self.dino_mlp)
 
     def estimate_orientation(self, img: Image.Image, boxes):
+        """
+        Orientation of every box in the image.
+        Returns:
+            np.ndarray: (N, 4) array of (azimuth, polar, rotation, confidence)
+        """
+        return self.estimate_orientation_batch([img], [boxes])[0]
+
+    def estimate_orientation_batch(self, imgs: list, boxes_per_image: list) -> list:
+        """
+        Crops of all boxes of all images are preprocessed together and run
+        through the model in micro-batches of `max_batch_size`.
+        Returns:
+            list: (N_i, 4) array for every image
+        """
+        pixel_values = self.preprocess(imgs, boxes_per_image)
+        return self.estimate_orientation_preprocessed(pixel_values, boxes_per_image)
+
+    def preprocess(self, imgs: list, boxes_per_image: list) -> torch.Tensor:
+        """
+        CPU part of orientation estimation: crops of all boxes -> pixel_values
+        (`tta_crops` augmented crops per box in TTA mode).
+        """
+        if self.remove_background:
+            # every background-free crop becomes an image with a single full-size box
+            imgs = background_preprocess_many(self._crops(imgs, boxes_per_image))
+            boxes_per_image = [[(0, 0, *img.size)] for img in imgs]
+
+        if self.tta_crops:
+            crop_size = self.processor.crop_size["height"]
+            return torch.cat(
+                [torch.zeros((0, 3, crop_size, crop_size))]
+                + [
+                    preprocess_tta(
+                        img, boxes, self.processor, self.tta_crops, self.tta_generator
+                    )
+                    for img, boxes in zip(imgs, boxes_per_image)
+                ]
+            )
+        crops = [
+            crop.convert("RGB") for crop in self._crops(imgs, boxes_per_image)
+        ]
+        return preprocess_images(crops, self.processor)
+
+    @staticmethod
+    def _crops(imgs: list, boxes_per_image: list) -> list:
+        crops = []
+        for img, boxes in zip(imgs, boxes_per_image):
+            for box in boxes:
+                x0, y0, x1, y1 = map(int, box)
+                crops.append(img.crop((x0, y0, x1, y1)))
+        return crops
+
+    def estimate_orientation_preprocessed(
+        self, pixel_values: torch.Tensor, boxes_per_image: list
+    ) -> list:
+        """Model forward for output of `preprocess`, split back per image."""
+        if len(pixel_values) == 0:
+            angles = torch.zeros((0, 4))
+        elif not self.tta_crops:
+            angles = angles_from_prediction(self._predict(pixel_values))
+        else:
+            angles = angles_from_tta_prediction(self._predict(pixel_values), self.tta_crops)
+        angles = angles.numpy().astype(np.float64)
+
         results = []
-        for box in boxes:
-            x0, y0, x1, y1 = map(int, box)
-            crop = img.crop((x0, y0, x1, y1)).convert("RGB")
-            angles = get_3angle(crop, self.dino_mlp, self.processor, self.device)
-            # angles[0] = angles[0] + 180 if angles[0] < 180 else angles[0] - 180
-
-            results.append(tuple(angles.cpu().tolist()))
-        return np.array(results)
+        start = 0
+        for boxes in boxes_per_image:
+            results.append(angles[start : start + len(boxes)])
+            start += len(boxes)
+        return results
     
+    def _predict(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Raw model output in micro-batches, padded to batch buckets when compiled."""
+        if self._forward is None:
+            return predict_from_pixels(
+                pixel_values, self.dino_mlp, self.device, self.max_batch_size
+            )
+        config = self.inference_config
+        preds = []
+        with config.inference_context():
+            for start in range(0, len(pixel_values), self.max_batch_size):
+                chunk = pixel_values[start : start + self.max_batch_size]
+                batch = pad_batch(chunk, config.batch_bucket(len(chunk))).to(self.device)
+                preds.append(self._forward(config.images(batch))[: len(chunk)])
+        return torch.cat(preds, dim=0)
+
+    def warmup(self, batch_sizes: Optional[list] = None):
+        """
+        Run the model once for every batch bucket, so that compilation happens here
+        and not in the first calls with real data.
+        """
+        crop_size = self.processor.crop_size["height"]
+        sizes = batch_sizes or self.inference_config.warmup_batch_sizes(self.max_batch_size)
+        for n in sizes:
+            self._predict(torch.zeros((n, 3, crop_size, crop_size)))
+
     def estimate_orientation_just_image(self, img: Image.Image):
         print(img)
         angles = get_3angle(img, self.dino_mlp, self.processor, self.device)
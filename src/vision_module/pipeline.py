@@ -0,0 +1,168 @@
+"""
+Pipelined execution of per-item stages connected with bounded queues.
+CPU stages (pre/post-processing) run in several worker threads, model stages in a
+single worker each, so the device stays busy while next items are being prepared.
+"""
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+
+
+@dataclass
+class Stage:
+    """
+    Single pipeline stage. `fn` takes item payload and returns updated payload.
+    Model stages should use `workers=1`.
+    """
+
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+
+
+class StageStats:
+    def __init__(self):
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.queue_depth_sum = 0
+        self.queue_depth_max = 0
+        self._lock = threading.Lock()
+
+    def record(self, busy: float, idle: float, queue_depth: int):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += busy
+            self.idle_seconds += idle
+            self.queue_depth_sum += queue_depth
+            self.queue_depth_max = max(self.queue_depth_max, queue_depth)
+
+    def as_dict(self) -> dict:
+        return {
+            "items": self.items,
+            "busy_s": round(self.busy_seconds, 3),
+            "idle_s": round(self.idle_seconds, 3),
+            "mean_queue_depth": round(self.queue_depth_sum / self.items, 2) if self.items else 0.0,
+            "max_queue_depth": self.queue_depth_max,
+        }
+
+
+class _Failed:
+    """Payload of an item that raised in one of the stages, later stages skip it."""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_STOP = object()
+
+
+class PipelinedExecutor:
+    """
+    Runs items through `stages` concurrently. Between every two stages there is a
+    queue of at most `queue_size` items. Statistics (items, busy / idle time per stage,
+    queue depth seen when taking an item) accumulate over `run` calls.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stage_stats: Dict[str, StageStats] = {s.name: StageStats() for s in stages}
+
+    def run(self, items: List[Any]) -> List[Any]:
+        """
+        Args:
+            items (list): initial payloads
+        Returns:
+            list: final payloads in input order; an item that failed is replaced by
+                  the exception it raised
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        output: queue.Queue = queue.Queue()
+        queues.append(output)
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                t = threading.Thread(
+                    target=self._worker,
+                    args=(stage, queues[i], queues[i + 1], remaining, lock, i),
+                    name=f"pipeline-{stage.name}",
+                    daemon=True,
+                )
+                t.start()
+                threads.append(t)
+
+        def feed():
+            for idx, item in enumerate(items):
+                queues[0].put((idx, item))
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_STOP)
+
+        feeder = threading.Thread(target=feed, name="pipeline-feeder", daemon=True)
+        feeder.start()
+
+        results: List[Any] = [None] * len(items)
+        while True:
+            got = output.get()
+            if got is _STOP:
+                break
+            idx, payload = got
+            results[idx] = payload.error if isinstance(payload, _Failed) else payload
+
+        feeder.join()
+        for t in threads:
+            t.join()
+        return results
+
+    def _worker(self, stage: Stage, in_q, out_q, remaining, lock, stage_idx: int):
+        stats = self.stage_stats[stage.name]
+        current = None
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                got = in_q.get()
+                idle = time.perf_counter() - wait_start
+                if got is _STOP:
+                    return
+
+                idx, payload = got
+                current = idx
+                depth = in_q.qsize()
+                busy_start = time.perf_counter()
+                if not isinstance(payload, _Failed):
+                    try:
+                        payload = stage.fn(payload)
+                    except BaseException as e:
+                        # not only Exception: a dead worker would never stop the next stage
+                        payload = _Failed(e)
+                stats.record(time.perf_counter() - busy_start, idle, depth)
+                out_q.put((idx, payload))
+                current = None
+        except BaseException as e:
+            if current is not None:
+                out_q.put((current, _Failed(e)))
+            raise
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                # last worker of this stage stops the next one
+                next_workers = (
+                    self.stages[stage_idx + 1].workers
+                    if stage_idx + 1 < len(self.stages)
+                    else 1
+                )
+                for _ in range(next_workers):
+                    out_q.put(_STOP)
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: s.as_dict() for name, s in self.stage_stats.items()}
+
+    def summary(self) -> str:
+        return "\n".join(f"{name}: {stats}" for name, stats in self.stats().items())
@@ -0,0 +1,163 @@
+"""
+3D position of detected objects from SAM masks and depth map.
+Every object is processed only inside its own detection box: medians are selected
+(`torch.kthvalue`, no sort) among its mask pixels, without padding to other boxes.
+"""
+import math
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def image_to_camera_coords(x, y, z, f, w, h):
+    """
+    Pixel (x, y) with depth z -> camera coordinates (X, Y), principal point in the
+    image center, y axis pointing up.
+    """
+    x_centered = x - (w / 2)
+    y_centered = -y + (h / 2)
+
+    X = (x_centered * z) / f
+    Y = (y_centered * z) / f
+
+    return X, Y
+
+
+def box_bounds(box, width: int, height: int) -> Tuple[int, int, int, int]:
+    """Float box -> integer (x0, y0, x1, y1) slice bounds clipped to the image."""
+    x0, y0, x1, y1 = box
+    x0 = min(max(int(math.floor(x0)), 0), width)
+    y0 = min(max(int(math.floor(y0)), 0), height)
+    x1 = min(max(int(math.ceil(x1)), x0), width)
+    y1 = min(max(int(math.ceil(y1)), y0), height)
+    return x0, y0, x1, y1
+
+
+class SparseDepth:
+    """
+    Depth map kept at model resolution and looked up only at requested image pixels.
+    Lookup is bilinear interpolation of inverse depth followed by inversion, the same
+    as DepthPro post-processing to full image size, but no (H, W) map is created.
+    """
+
+    def __init__(self, inverse_depth, image_size: Tuple[int, int]):
+        """
+        Args:
+            inverse_depth: (h, w) inverse depth at model resolution (array or tensor)
+            image_size (tuple): (width, height) of the original image
+        """
+        self.inverse_depth = inverse_depth
+        self.image_size = image_size
+
+    @property
+    def nbytes(self) -> int:
+        return self.inverse_depth.nbytes
+
+    def sample(self, xs: torch.Tensor, ys: torch.Tensor) -> torch.Tensor:
+        """Depth at integer image pixels (xs, ys), result has the shape of `xs`."""
+        w, h = self.image_size
+        inverse = torch.as_tensor(np.asarray(self.inverse_depth, dtype=np.float32))
+        inverse = inverse.to(xs.device)[None, None]
+        # pixel centers -> normalized coordinates (align_corners=False convention)
+        grid = torch.stack([(xs + 0.5) / w * 2 - 1, (ys + 0.5) / h * 2 - 1], dim=-1)
+        values = F.grid_sample(
+            inverse,
+            grid.reshape(1, 1, -1, 2).float(),
+            mode="bilinear",
+            padding_mode="border",
+            align_corners=False,
+        )
+        return 1.0 / values.reshape(xs.shape).clamp(min=1e-4, max=1e4)
+
+    def to_dense(self) -> np.ndarray:
+        """Full (H, W) depth map, for callers that need it."""
+        w, h = self.image_size
+        ys, xs = torch.meshgrid(
+            torch.arange(h, dtype=torch.float32),
+            torch.arange(w, dtype=torch.float32),
+            indexing="ij",
+        )
+        return self.sample(xs, ys).numpy()
+
+
+def median(values: torch.Tensor) -> torch.Tensor:
+    """
+    Median of a 1D tensor, same as `np.median` (mean of two middle elements for even
+    counts). NaN for an empty tensor.
+    """
+    k = values.numel()
+    if k == 0:
+        return torch.tensor(float("nan"), dtype=values.dtype, device=values.device)
+    lo = torch.kthvalue(values, (k + 1) // 2).values
+    hi = lo if k % 2 else torch.kthvalue(values, k // 2 + 1).values
+    return (lo + hi) / 2
+
+
+def masked_median(values: torch.Tensor, valid: torch.Tensor) -> torch.Tensor:
+    """
+    Median of `values[i][valid[i]]` for every row i, same as `np.median`
+    (mean of two middle elements for even counts). NaN for rows without valid elements.
+    Args:
+        values (torch.Tensor): (N, K) values
+        valid (torch.Tensor): (N, K) bool mask
+    Returns:
+        torch.Tensor: (N,) medians
+    """
+    if len(values) == 0:
+        return torch.zeros((0,), dtype=values.dtype, device=values.device)
+    return torch.stack([median(row[mask]) for row, mask in zip(values, valid)])
+
+
+def estimate_positions(
+    masks: torch.Tensor,
+    boxes: Sequence[Sequence[float]],
+    depth_map: Union[np.ndarray, SparseDepth],
+    focal_length: float,
+    img_size: Tuple[int, int],
+    device: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Median pixel and median depth of every object mask, converted to camera coordinates.
+    Only pixels inside the object's detection box are considered and no full-frame
+    copy of masks or depth is made.
+    Args:
+        masks (torch.Tensor): (N, H, W) SAM masks
+        boxes: N boxes (x0, y0, x1, y1) in pixels
+        depth_map: (H, W) depth map (may be memory-mapped), or `SparseDepth`
+            sampled only at mask pixels
+        focal_length (float): focal length in pixels
+        img_size (tuple): (width, height) of the image
+        device (str, optional): where to compute, defaults to device of `masks`
+    Returns:
+        np.ndarray: [N x (y, x, z)] positions
+    """
+    n = len(boxes)
+    if n == 0:
+        return np.zeros((0, 3))
+    device = device or masks.device
+    w, h = img_size
+
+    pixels = np.full((n, 3), np.nan)
+    for i, box in enumerate(boxes):
+        x0, y0, x1, y1 = box_bounds(box, w, h)
+        ys, xs = torch.nonzero(masks[i, y0:y1, x0:x1].to(device).bool(), as_tuple=True)
+        if len(xs) == 0:
+            continue
+        if isinstance(depth_map, SparseDepth):
+            depth = depth_map.sample((xs + x0).float(), (ys + y0).float())
+        else:
+            depth_crop = np.asarray(depth_map[y0:y1, x0:x1], dtype=np.float32)
+            depth = torch.from_numpy(depth_crop).to(device)[ys, xs]
+        pixels[i] = (
+            median(xs.double()).item() + x0,
+            median(ys.double()).item() + y0,
+            median(depth).item(),
+        )
+
+    x_pixel, y_pixel, z_depth = pixels.T
+    X_cam, Y_cam = image_to_camera_coords(
+        x_pixel, y_pixel, z_depth, float(focal_length), w, h
+    )
+    return np.stack([Y_cam, X_cam, -z_depth], axis=1)
@@ -1,40 +1,216 @@
-import gc
 from typing import Optional
 
 import torch
-from transformers import SamModel, SamProcessor
+from transformers import SamConfig, SamModel, SamProcessor
+
+from src.utils.cache import LRUByteCache, image_hash
+from src.utils.model_manager import (
+    HostWeightCache,
+    module_nbytes,
+    release_device_memory,
+)
+from src.utils.quantization import QuantizedModelCache, check_profile, load_quantized
+from .onnx_backend import SamOnnx, check_backend
+from .inference_config import InferenceConfig, pad_batch
+
+EMBEDDING_CACHE_BYTES = 256 * 1024**2
 
 
 class SAMModelWrapper:
-    def __init__(self, model_id="facebook/sam-vit-base", device: str = "cuda"):
+    def __init__(
+        self,
+        model_id="facebook/sam-vit-base",
+        device: str = "cuda",
+        embedding_cache_bytes: int = EMBEDDING_CACHE_BYTES,
+        host_cache: Optional[HostWeightCache] = None,
+        profile: str = "fp32",
+        quantized_cache: Optional[QuantizedModelCache] = None,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        onnx_threads: Optional[int] = None,
+        inference_config: Optional[InferenceConfig] = None,
+    ):
+        """
+        Args:
+            model_id (str): SAM checkpoint
+            device (str): device to run SAM on
+            embedding_cache_bytes (int): size cap of the image-embedding LRU cache,
+                0 disables caching
+            host_cache (HostWeightCache, optional): keeps weights in host memory on unload
+            profile (str): "fp32", or "int8" for dynamic INT8 quantization of Linear
+                layers (CPU only)
+            quantized_cache (QuantizedModelCache, optional): disk cache of int8 weights
+            backend (str): "torch", or "onnx" to run graphs exported by
+                `src.vision_module.onnx_export` with ONNX Runtime
+            onnx_dir (str, optional): directory with exported graphs (onnx backend)
+            onnx_threads (int, optional): ONNX Runtime intra-op threads, None keeps
+                the runtime default
+            inference_config (InferenceConfig, optional): eager (default) or
+                optimized execution of the torch backend
+        """
         self.model_id = model_id
         self.device = device
+        self.host_cache = host_cache
+        self.profile = check_profile(profile, device)
+        self.quantized_cache = quantized_cache
+        self.backend = check_backend(backend, onnx_dir, profile)
+        self.onnx_dir = onnx_dir
+        self.onnx_threads = onnx_threads
+        self.inference_config = inference_config or InferenceConfig()
+        self._encode = None
+        self._decode = None
         self.processor = None
         self.model = None
+        # image hash -> (image embeddings on cpu, original size, reshaped input size)
+        self.embedding_cache = LRUByteCache(max_bytes=embedding_cache_bytes)
 
     def load(self):
+        self._load()
+        config = self.inference_config
+        if config.optimized and self.backend == "torch":
+            config.prepare_module(self.model)
+            self._encode = config.compiled(self.model.get_image_embeddings, self.model)
+            self._decode = config.compiled(self._pred_masks, self.model)
+
+    def _load(self):
+        restored = (
+            self.host_cache.restore(self.model_id, self.device)
+            if self.host_cache and self.backend == "torch"
+            else None
+        )
+        if restored is not None:
+            self.model, self.processor = restored
+            return
         self.processor = SamProcessor.from_pretrained(self.model_id)
+        if self.backend == "onnx":
+            self.model = SamOnnx(self.onnx_dir, self.device, self.onnx_threads)
+            return
+        if self.profile == "int8":
+            self.model = load_quantized(
+                self.model_id,
+                lambda: SamModel(SamConfig.from_pretrained(self.model_id)),
+                lambda: SamModel.from_pretrained(self.model_id),
+                self.quantized_cache,
+            )
+            return
         self.model = SamModel.from_pretrained(self.model_id).to(self.device)
 
     def unload(self):
         if self.model is not None:
-            self.model.to("cpu")
+            if self.backend == "onnx":
+                pass
+            elif self.host_cache is not None:
+                self.host_cache.park(self.model_id, self.model, self.processor)
+            else:
+                self.model.to("cpu")
             del self.model
+            self._encode = self._decode = None
             self.model = None
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-
-    def get_masks(self, img, boxes):
-        sam_inputs = self.processor(
-            images=img, input_boxes=[boxes], return_tensors="pt"
-        ).to(self.device)
-        with torch.no_grad():
-            sam_outputs = self.model(**sam_inputs)
+            release_device_memory()
+
+    def memory_footprint(self) -> int:
+        return module_nbytes(self.model)
+
+    def cache_stats(self) -> dict:
+        """Hit / miss statistics of the image-embedding cache."""
+        return self.embedding_cache.stats()
+
+    def preprocess(self, img):
+        """
+        CPU part of `get_masks` (resize / normalization for the image encoder).
+        Returns None if embeddings of this image are already cached.
+        """
+        if image_hash(img) in self.embedding_cache:
+            return None
+        return self.processor(images=img, return_tensors="pt")
+
+    def get_masks(self, img, boxes, sam_inputs=None):
+        """
+        Image encoder runs only for images not seen before (embeddings are cached by
+        image content), prompt encoder and mask decoder run for every set of boxes.
+        Args:
+            img: PIL image
+            boxes: boxes in image pixels
+            sam_inputs (optional): output of `preprocess` computed beforehand
+        """
+        image_embeddings, original_size, reshaped_size = self._image_embeddings(
+            img, sam_inputs
+        )
+        if len(boxes) == 0:
+            return torch.zeros((0, *original_size), dtype=torch.bool)
+
+        input_boxes = self._rescale_boxes(boxes, original_size, reshaped_size)
+        with self.inference_config.inference_context():
+            pred_masks = self._decode_masks(
+                image_embeddings.to(self.device), input_boxes.to(self.device)
+            )
         masks = self.processor.post_process_masks(
-            sam_outputs.pred_masks,
-            original_sizes=sam_inputs.original_sizes,
-            reshaped_input_sizes=sam_inputs.reshaped_input_sizes,
+            pred_masks,
+            original_sizes=[original_size],
+            reshaped_input_sizes=[reshaped_size],
         )[0]
         # SAM returns many masks for each object, we return mask with higest IoU
-        return masks[:, 0, :, :] 
+        return masks[:, 0, :, :]
+
+    def _image_embeddings(self, img, sam_inputs=None):
+        key = image_hash(img)
+        cached = self.embedding_cache.get(key)
+        if cached is not None:
+            return cached
+
+        if sam_inputs is None:
+            sam_inputs = self.processor(images=img, return_tensors="pt")
+        with self.inference_config.inference_context():
+            pixel_values = sam_inputs.pixel_values.to(self.device)
+            if self._encode is None:
+                image_embeddings = self.model.get_image_embeddings(pixel_values)
+            else:
+                image_embeddings = self._encode(self.inference_config.images(pixel_values))
+        entry = (
+            image_embeddings.cpu(),
+            tuple(sam_inputs.original_sizes[0].tolist()),
+            tuple(sam_inputs.reshaped_input_sizes[0].tolist()),
+        )
+        self.embedding_cache.put(
+            key, entry, nbytes=image_embeddings.numel() * image_embeddings.element_size()
+        )
+        return entry
+
+    def _pred_masks(self, image_embeddings, input_boxes):
+        return self.model(image_embeddings=image_embeddings, input_boxes=input_boxes).pred_masks
+
+    def _decode_masks(self, image_embeddings, input_boxes):
+        """Prompt encoder + mask decoder; box count is padded to a bucket when compiled."""
+        if self._decode is None:
+            return self._pred_masks(image_embeddings, input_boxes)
+        n = input_boxes.shape[1]
+        padded = pad_batch(input_boxes[0], self.inference_config.batch_bucket(n))[None]
+        return self._decode(image_embeddings, padded)[:, :n]
+
+    def warmup(self, max_boxes: int = 16):
+        """
+        Run image encoder once and mask decoder for every box-count bucket up to
+        `max_boxes`, so that compilation happens here and not on real data.
+        """
+        pad_size = self.processor.image_processor.pad_size
+        pixel_values = torch.zeros((1, 3, pad_size["height"], pad_size["width"]))
+        with self.inference_config.inference_context():
+            encode = self._encode or self.model.get_image_embeddings
+            image_embeddings = encode(self.inference_config.images(pixel_values.to(self.device)))
+            for n in self.inference_config.warmup_batch_sizes(max_boxes):
+                boxes = torch.tensor([0.0, 0.0, 512.0, 512.0]).expand(1, n, 4)
+                self._decode_masks(image_embeddings, boxes.to(self.device))
+
+    @staticmethod
+    def _rescale_boxes(boxes, original_size, reshaped_size) -> torch.Tensor:
+        """
+        Boxes in original image pixels -> boxes in SAM input frame (longest side 1024),
+        same as SamProcessor does for `input_boxes`.
+        """
+        old_h, old_w = original_size
+        new_h, new_w = reshaped_size
+        scale = torch.tensor(
+            [new_w / old_w, new_h / old_h, new_w / old_w, new_h / old_h],
+            dtype=torch.float32,
+        )
+        return (torch.as_tensor(boxes, dtype=torch.float32) * scale).unsqueeze(0)
@@ -0,0 +1,354 @@
+"""
+Compact result of `ExternalVisionModule.abstract_scene`. Numeric fields are small
+float32 arrays and every SAM mask is stored bit-packed inside its own bounding box,
+so a scene takes kilobytes instead of N full-size mask tensors. Full masks are
+decoded only on demand. Scenes can be saved to / loaded from `.npz` files (or any
+binary file object) and pickled cheaply. `SceneCache` keeps them on disk across runs.
+"""
+import hashlib
+import json
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.utils.cache import DiskCache, image_hash
+
+
+class SceneAbstraction:
+    """
+    Objects of a single image: labels, boxes, 3D positions [y, x, z], orientations
+    (azimuth, polar, rotation, confidence) and masks. `scene["positions"]` style
+    access of the previous dict results is supported.
+    """
+
+    __slots__ = (
+        "labels",
+        "boxes",
+        "positions",
+        "orientations",
+        "image_size",
+        "mask_bounds",
+        "mask_bits",
+        "mask_offsets",
+        "_label_index",
+    )
+
+    FIELDS = ("labels", "boxes", "positions", "orientations", "masks")
+
+    def __init__(
+        self,
+        labels: Sequence[str],
+        boxes,
+        positions,
+        orientations,
+        image_size: Tuple[int, int],
+        mask_bounds: np.ndarray,
+        mask_bits: np.ndarray,
+        mask_offsets: np.ndarray,
+    ):
+        """
+        Use `from_results` to build a scene from model outputs.
+        Args:
+            labels (Sequence[str]): N object labels
+            boxes: (N, 4) boxes (x0, y0, x1, y1) in pixels
+            positions: (N, 3) positions [y, x, z]
+            orientations: (N, 4) azimuth, polar, rotation and confidence
+            image_size (tuple): (width, height) of the image
+            mask_bounds (np.ndarray): (N, 4) int32 (x0, y0, x1, y1) of every mask crop
+            mask_bits (np.ndarray): uint8 bit-packed crops of all masks, concatenated
+            mask_offsets (np.ndarray): (N + 1,) start of every crop in `mask_bits`
+        """
+        n = len(labels)
+        self.labels = list(labels)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(n, 4)
+        self.positions = np.asarray(positions, dtype=np.float32).reshape(n, 3)
+        self.orientations = np.asarray(orientations, dtype=np.float32).reshape(n, 4)
+        self.image_size = (int(image_size[0]), int(image_size[1]))
+        self.mask_bounds = np.asarray(mask_bounds, dtype=np.int32).reshape(n, 4)
+        self.mask_bits = np.asarray(mask_bits, dtype=np.uint8)
+        self.mask_offsets = np.asarray(mask_offsets, dtype=np.int64)
+        self._label_index = self._build_label_index(self.labels)
+
+    @classmethod
+    def from_results(
+        cls,
+        labels: Sequence[str],
+        boxes,
+        positions,
+        orientations,
+        masks,
+        image_size: Tuple[int, int],
+    ) -> "SceneAbstraction":
+        """
+        Args:
+            masks: (N, H, W) SAM masks (tensor or array), cropped to the bounding box
+                of their foreground before packing, so decoding is lossless
+        """
+        bounds, bits, offsets = cls._encode_masks(masks)
+        return cls(labels, boxes, positions, orientations, image_size, bounds, bits, offsets)
+
+    @staticmethod
+    def _build_label_index(labels: List[str]) -> Dict[str, int]:
+        index = {}
+        for i, label in enumerate(labels):
+            # first occurrence wins, as with list.index
+            index.setdefault(label, i)
+        return index
+
+    @staticmethod
+    def _encode_masks(masks) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if isinstance(masks, torch.Tensor):
+            masks = masks.detach().to("cpu", torch.bool).numpy()
+        masks = np.asarray(masks, dtype=bool)
+        n = len(masks)
+        bounds = np.zeros((n, 4), dtype=np.int32)
+        crops = []
+        if n:
+            rows, cols = masks.any(axis=2), masks.any(axis=1)
+        for i in range(n):
+            ys, xs = np.flatnonzero(rows[i]), np.flatnonzero(cols[i])
+            if len(ys) == 0:
+                crops.append(np.zeros(0, dtype=np.uint8))
+                continue
+            x0, y0, x1, y1 = xs[0], ys[0], xs[-1] + 1, ys[-1] + 1
+            bounds[i] = (x0, y0, x1, y1)
+            crops.append(np.packbits(masks[i, y0:y1, x0:x1], axis=None))
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(c) for c in crops])
+        bits = np.concatenate(crops) if crops else np.zeros(0, dtype=np.uint8)
+        return bounds, bits, offsets
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(self, key: str):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def index(self, label: str) -> int:
+        """Index of the first object with `label`, raises ValueError if missing."""
+        try:
+            return self._label_index[label]
+        except KeyError:
+            raise ValueError(f"{label!r} is not in scene labels") from None
+
+    def mask_crop(self, i: int) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+        """Mask of the i-th object inside its bounds and the (x0, y0, x1, y1) bounds."""
+        x0, y0, x1, y1 = (int(v) for v in self.mask_bounds[i])
+        shape = (y1 - y0, x1 - x0)
+        bits = self.mask_bits[self.mask_offsets[i] : self.mask_offsets[i + 1]]
+        crop = np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape)
+        return crop.astype(bool), (x0, y0, x1, y1)
+
+    def mask(self, i: int) -> np.ndarray:
+        """(H, W) boolean mask of the i-th object."""
+        w, h = self.image_size
+        full = np.zeros((h, w), dtype=bool)
+        crop, (x0, y0, x1, y1) = self.mask_crop(i)
+        full[y0:y1, x0:x1] = crop
+        return full
+
+    @property
+    def masks(self) -> torch.Tensor:
+        """(N, H, W) boolean masks, decoded on every access."""
+        w, h = self.image_size
+        if len(self) == 0:
+            return torch.zeros((0, h, w), dtype=torch.bool)
+        return torch.from_numpy(np.stack([self.mask(i) for i in range(len(self))]))
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (
+            self.boxes,
+            self.positions,
+            self.orientations,
+            self.mask_bounds,
+            self.mask_bits,
+            self.mask_offsets,
+        )
+        return sum(a.nbytes for a in arrays) + sum(len(l) for l in self.labels)
+
+    def without(self, label: str) -> Tuple[List[str], np.ndarray]:
+        """Labels and positions of all objects except the first one with `label`."""
+        i = self.index(label)
+        return (
+            self.labels[:i] + self.labels[i + 1 :],
+            np.concatenate([self.positions[:i], self.positions[i + 1 :]]),
+        )
+
+    def select(self, indices: Sequence[int]) -> "SceneAbstraction":
+        """Scene with objects at `indices` only, masks are not decoded."""
+        indices = list(indices)
+        crops = [self.mask_bits[self.mask_offsets[i] : self.mask_offsets[i + 1]] for i in indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(c) for c in crops])
+        return SceneAbstraction(
+            labels=[self.labels[i] for i in indices],
+            boxes=self.boxes[indices],
+            positions=self.positions[indices],
+            orientations=self.orientations[indices],
+            image_size=self.image_size,
+            mask_bounds=self.mask_bounds[indices],
+            mask_bits=np.concatenate(crops) if crops else np.zeros(0, dtype=np.uint8),
+            mask_offsets=offsets,
+        )
+
+    def concat(self, other: "SceneAbstraction") -> "SceneAbstraction":
+        """Objects of both scenes of the same image, `self` first."""
+        return SceneAbstraction(
+            labels=self.labels + other.labels,
+            boxes=np.concatenate([self.boxes, other.boxes]),
+            positions=np.concatenate([self.positions, other.positions]),
+            orientations=np.concatenate([self.orientations, other.orientations]),
+            image_size=self.image_size,
+            mask_bounds=np.concatenate([self.mask_bounds, other.mask_bounds]),
+            mask_bits=np.concatenate([self.mask_bits, other.mask_bits]),
+            mask_offsets=np.concatenate(
+                [self.mask_offsets[:-1], other.mask_offsets + self.mask_offsets[-1]]
+            ),
+        )
+
+    def save(self, file) -> None:
+        """Write the scene as `.npz` to a path or a binary file object."""
+        np.savez(
+            file,
+            labels=np.asarray(self.labels, dtype=str),
+            boxes=self.boxes,
+            positions=self.positions,
+            orientations=self.orientations,
+            image_size=np.asarray(self.image_size, dtype=np.int64),
+            mask_bounds=self.mask_bounds,
+            mask_bits=self.mask_bits,
+            mask_offsets=self.mask_offsets,
+        )
+
+    @classmethod
+    def load(cls, file) -> "SceneAbstraction":
+        """Read a scene written by `save`."""
+        with np.load(file, allow_pickle=False) as data:
+            return cls(
+                labels=[str(l) for l in data["labels"]],
+                boxes=data["boxes"],
+                positions=data["positions"],
+                orientations=data["orientations"],
+                image_size=tuple(data["image_size"]),
+                mask_bounds=data["mask_bounds"],
+                mask_bits=data["mask_bits"],
+                mask_offsets=data["mask_offsets"],
+            )
+
+    def __repr__(self) -> str:
+        return f"SceneAbstraction(labels={self.labels}, image_size={self.image_size})"
+
+
+def normalize_objects(objects: Sequence[str]) -> List[str]:
+    """Sorted, deduplicated, lower-case object names without surrounding whitespace."""
+    return sorted({" ".join(o.lower().split()) for o in objects})
+
+
+def attribute_label(label: str, queries: Sequence[str]) -> Optional[str]:
+    """
+    Object name of `queries` (normalized) a Grounding DINO label was detected for.
+    Labels are phrases of the prompt, usually the whole name but sometimes only
+    a part of it. None if it cannot be told.
+    """
+    label = " ".join(label.lower().split())
+    if label in queries:
+        return label
+    for query in queries:
+        if label and (label in query or query in label):
+            return query
+    words = set(label.split())
+    for query in queries:
+        if words & set(query.split()):
+            return query
+    return queries[0] if len(queries) == 1 else None
+
+
+class ImageRecord:
+    """
+    Every object detected so far in one image, grown incrementally: objects that were
+    not asked for before are detected alone and merged in, questions are served the
+    subset of objects they mention.
+    """
+
+    __slots__ = ("objects", "scene", "sources")
+
+    def __init__(self, scene: SceneAbstraction, objects: Sequence[str]):
+        """
+        Args:
+            scene (SceneAbstraction): objects found for `objects`
+            objects (Sequence[str]): normalized object names detection ran for
+        """
+        self.objects = set(objects)
+        self.scene = scene
+        # object name every detection belongs to
+        self.sources = [attribute_label(label, list(objects)) for label in scene.labels]
+
+    def missing(self, objects: Sequence[str]) -> List[str]:
+        """Normalized names of `objects` detection has not run for yet."""
+        return [o for o in normalize_objects(objects) if o not in self.objects]
+
+    def merge(self, scene: SceneAbstraction, objects: Sequence[str]) -> "ImageRecord":
+        """Record with objects of `scene`, found for new names `objects`, added."""
+        merged = ImageRecord(scene, objects)
+        merged.objects |= self.objects
+        merged.scene = self.scene.concat(scene)
+        merged.sources = self.sources + merged.sources
+        return merged
+
+    def subset(self, objects: Sequence[str]) -> SceneAbstraction:
+        """Scene with detections of `objects` only, in detection order."""
+        wanted = set(normalize_objects(objects))
+        return self.scene.select([i for i, s in enumerate(self.sources) if s in wanted])
+
+    @property
+    def nbytes(self) -> int:
+        return self.scene.nbytes + sum(len(o) for o in self.objects)
+
+
+class SceneCache:
+    """
+    Persistent cache of scene abstractions on top of `DiskCache` (`<key>.npz` files,
+    LRU by size). Key is the content hash of the image, the normalized object list and
+    `model_tag`, which describes the vision models and settings that produce scenes.
+    """
+
+    SUFFIX = "npz"
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None, model_tag: str = ""):
+        """
+        Args:
+            cache_dir (str): cache directory, can be shared by several processes
+            max_bytes (int, optional): size above which least recently used scenes
+                are removed, None means no limit
+            model_tag (str): versions of the models and settings, part of every key
+        """
+        self.cache = DiskCache(cache_dir, max_bytes)
+        self.model_tag = model_tag
+
+    def key(self, img: Image.Image, objects: Sequence[str]) -> str:
+        objects = json.dumps(normalize_objects(objects))
+        return hashlib.blake2b(
+            f"{self.model_tag}:{image_hash(img)}:{objects}".encode(), digest_size=16
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[SceneAbstraction]:
+        try:
+            scene = SceneAbstraction.load(self.cache.path(key, self.SUFFIX))
+        except FileNotFoundError:
+            self.cache.misses += 1
+            return None
+        self.cache.hits += 1
+        self.cache.touch(key, self.SUFFIX)
+        return scene
+
+    def put(self, key: str, scene: SceneAbstraction):
+        self.cache.atomic_write(key, self.SUFFIX, scene.save)
+        self.cache.evict(commit_suffix=self.SUFFIX)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
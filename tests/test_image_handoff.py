@@ -0,0 +1,117 @@
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import create_autospec
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.qwen_extended import QwenExtended
+from src.utils.constants import PERSPECTIVE_TYPE
+from src.utils.model_manager import ModelManager
+from src.vision_module.scene_abstraction import SceneAbstraction
+
+WORKERS = 8
+QUESTIONS_PER_WORKER = 4
+
+
+class StubVLM:
+    """Answers planning prompts with a fixed plan and records final messages."""
+
+    def __init__(self):
+        self.final_messages = {}
+        self._lock = threading.Lock()
+
+    def generate_batch(self, conversations, prefix=None, **gen_kwargs):
+        answers = []
+        for messages in conversations:
+            text = messages[0]["content"][0]["text"]
+            question = re.search(r"Is the cube left of the sphere #\d+\?", text).group(0)
+            plan = {
+                "objects": ["cube", "sphere"],
+                "perspective": "camera",
+                "egocentric_question": question,
+            }
+            answers.append(json.dumps(plan))
+        return answers
+
+    def generate(self, messages, **gen_kwargs):
+        text = messages[0]["content"][1]["text"]
+        key = int(re.search(r"#(\d+)", text).group(1))
+        with self._lock:
+            self.final_messages[key] = messages
+        return [f"answer {key}"]
+
+
+class StubVision:
+    def abstract_scenes(self, images, objects_per_image, save_img_paths=None):
+        scenes = []
+        for img, objects in zip(images, objects_per_image):
+            masks = torch.zeros((len(objects), img.height, img.width), dtype=torch.bool)
+            masks[:, :8, :8] = True
+            scenes.append(
+                SceneAbstraction.from_results(
+                    labels=objects,
+                    boxes=[[0, 0, 8, 8]] * len(objects),
+                    positions=np.arange(3 * len(objects), dtype=np.float32).reshape(-1, 3),
+                    orientations=np.zeros((len(objects), 4), dtype=np.float32),
+                    masks=masks,
+                    image_size=img.size,
+                )
+            )
+        return scenes
+
+
+class StubRenderer:
+    pass
+
+
+def synthetic_image(seed: int, size: int = 64) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+
+
+def test_concurrent_questions_hand_off_own_image_in_memory(tmp_path, monkeypatch):
+    output_folder = tmp_path / "output"
+    # relative temporary files would land in the working directory
+    monkeypatch.chdir(tmp_path)
+    model_manager = create_autospec(ModelManager, instance=True)
+    vlm = QwenExtended(
+        vlm_path="stub",
+        external_vision_module=StubVision(),
+        renderer_module=StubRenderer(),
+        device="cpu",
+        output_folder=str(output_folder),
+        # with a model manager Qwen is loaded lazily, i.e. never here
+        model_manager=model_manager,
+        fused_planning=True,
+    )
+    vlm.vlm_model = StubVLM()
+    files_before = sorted(os.listdir(output_folder)), sorted(os.listdir(tmp_path))
+
+    n = WORKERS * QUESTIONS_PER_WORKER
+    images = [synthetic_image(seed) for seed in range(n)]
+    pixels = [np.asarray(img).copy() for img in images]
+
+    def ask(i):
+        return vlm.ask_question_with_perspective(
+            question=f"Is the cube left of the sphere #{i}?",
+            img=images[i],
+            perspective_type=PERSPECTIVE_TYPE.NUMERICAL,
+        )
+
+    with ThreadPoolExecutor(WORKERS) as pool:
+        answers = list(pool.map(ask, range(n)))
+
+    assert answers == [f"answer {i}" for i in range(n)]
+    assert sorted(vlm.vlm_model.final_messages) == list(range(n))
+    for i, messages in vlm.vlm_model.final_messages.items():
+        image = messages[0]["content"][0]["image"]
+        assert isinstance(image, Image.Image)
+        assert image is images[i]
+        np.testing.assert_array_equal(np.asarray(image), pixels[i])
+    assert (sorted(os.listdir(output_folder)), sorted(os.listdir(tmp_path))) == files_before
+    assert model_manager.method_calls == []
@@ -0,0 +1,81 @@
+"""
+Grounding DINO detections with the onnx backend vs the torch backend, on unpadded
+images of several aspect ratios. Graphs are taken from $GROUNDING_DINO_ONNX_DIR or
+exported to a temporary directory. Skipped without onnxruntime or locally cached
+weights.
+"""
+import os
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+
+from huggingface_hub import try_to_load_from_cache  # noqa: E402
+
+from src.vision_module.grounding_dino_model import GroundingDINOModelWrapper  # noqa: E402
+from src.vision_module.onnx_backend import ONNX_FILES  # noqa: E402
+from src.vision_module.onnx_export import (  # noqa: E402
+    PARITY_PROMPTS,
+    PARITY_SIZES,
+    compare_detections,
+    export_grounding_dino_graphs,
+)
+
+MODEL_ID = "IDEA-Research/grounding-dino-tiny"
+GRAPHS = (ONNX_FILES["grounding_dino_landscape"], ONNX_FILES["grounding_dino_portrait"])
+
+if not isinstance(try_to_load_from_cache(MODEL_ID, "config.json"), str):
+    pytest.skip(f"{MODEL_ID} weights are not cached locally", allow_module_level=True)
+
+
+@pytest.fixture(scope="module")
+def sample():
+    return Image.effect_noise((640, 480), 64).convert("RGB")
+
+
+@pytest.fixture(scope="module")
+def torch_wrapper():
+    wrapper = GroundingDINOModelWrapper(model_id=MODEL_ID, device="cpu")
+    wrapper.load()
+    yield wrapper
+    wrapper.unload()
+
+
+@pytest.fixture(scope="module")
+def onnx_wrapper(torch_wrapper, sample, tmp_path_factory):
+    onnx_dir = os.environ.get("GROUNDING_DINO_ONNX_DIR")
+    if onnx_dir is None:
+        onnx_dir = str(tmp_path_factory.mktemp("onnx"))
+        export_grounding_dino_graphs(onnx_dir, torch_wrapper, sample)
+    elif not all(os.path.exists(os.path.join(onnx_dir, name)) for name in GRAPHS):
+        pytest.skip(f"no exported Grounding DINO graphs in {onnx_dir}")
+    wrapper = GroundingDINOModelWrapper(
+        model_id=MODEL_ID, device="cpu", backend="onnx", onnx_dir=onnx_dir
+    )
+    wrapper.load()
+    yield wrapper
+    wrapper.unload()
+
+
+@pytest.mark.parametrize("size", PARITY_SIZES)
+@pytest.mark.parametrize("objects", PARITY_PROMPTS)
+def test_detect_matches_torch(torch_wrapper, onnx_wrapper, sample, size, objects):
+    img = sample.resize(size)
+    mismatches = compare_detections(
+        torch_wrapper.detect(img, objects), onnx_wrapper.detect(img, objects)
+    )
+    assert not mismatches, mismatches
+
+
+@pytest.mark.parametrize("portrait", [False, True])
+def test_detect_batch_matches_torch(torch_wrapper, onnx_wrapper, sample, portrait):
+    sizes = [size for size in PARITY_SIZES if (size[0] < size[1]) == portrait]
+    imgs = [sample.resize(size) for size in sizes]
+    prompts = [PARITY_PROMPTS[i % len(PARITY_PROMPTS)] for i in range(len(imgs))]
+    expected = torch_wrapper.detect_batch(imgs, prompts)
+    actual = onnx_wrapper.detect_batch(imgs, prompts)
+    for img, e, a in zip(imgs, expected, actual):
+        mismatches = compare_detections(e, a)
+        assert not mismatches, (img.size, mismatches)
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+import torch
+
+from src.vision_module.positions import (
+    estimate_positions,
+    image_to_camera_coords,
+    masked_median,
+)
+
+FOCAL_LENGTH = 500.0
+
+
+def positions_full_frame(masks, depth_map, focal_length, img_size):
+    """Previous implementation from ExternalVisionModule.abstract_scene."""
+    positions = []
+    w, h = img_size
+    for m in masks.cpu().numpy():
+        ys, xs = np.nonzero(m)
+        if len(xs) == 0:
+            positions.append((np.nan, np.nan, np.nan))
+            continue
+        x_pixel, y_pixel = np.median(xs), np.median(ys)
+        z_depth = np.median(depth_map[m.astype(bool)])
+        X_cam, Y_cam = image_to_camera_coords(x_pixel, y_pixel, z_depth, focal_length, w, h)
+        positions.append((float(Y_cam), float(X_cam), float(-z_depth)))
+    return np.asarray(positions).reshape(-1, 3)
+
+
+def box_mask(h, w, box, rng):
+    """Random mask limited to the (clipped) box, at least one pixel set."""
+    x0, y0, x1, y1 = (int(round(v)) for v in box)
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, w), min(y1, h)
+    mask = torch.zeros((h, w), dtype=torch.bool)
+    mask[y0:y1, x0:x1] = torch.from_numpy(rng.random((y1 - y0, x1 - x0)) < 0.5)
+    mask[y0, x0] = True
+    return mask
+
+
+def depth(h, w, rng):
+    yy, xx = np.mgrid[0:h, 0:w]
+    return (1 + xx / w + yy / h + rng.normal(0, 0.01, (h, w))).astype(np.float32)
+
+
+@pytest.mark.parametrize("count", [1, 2, 5, 6])
+def test_masked_median_matches_numpy(count):
+    rng = np.random.default_rng(count)
+    values = rng.normal(size=(4, 9)).astype(np.float32)
+    valid = np.zeros((4, 9), dtype=bool)
+    for row in valid:
+        row[rng.choice(9, size=count, replace=False)] = True
+
+    result = masked_median(torch.from_numpy(values), torch.from_numpy(valid))
+
+    expected = [np.median(v[m]) for v, m in zip(values, valid)]
+    np.testing.assert_allclose(result.numpy(), expected, rtol=1e-6)
+
+
+def test_masked_median_empty_rows():
+    values = torch.tensor([[3.0, 1.0, 2.0], [5.0, 4.0, 6.0]])
+    valid = torch.tensor([[True, True, True], [False, False, False]])
+
+    result = masked_median(values, valid)
+
+    assert result[0].item() == 2.0
+    assert torch.isnan(result[1])
+
+
+def test_masked_median_no_columns():
+    result = masked_median(torch.zeros((3, 0)), torch.zeros((3, 0), dtype=torch.bool))
+
+    assert result.shape == (3,)
+    assert torch.isnan(result).all()
+
+
+def test_estimate_positions_matches_full_frame():
+    rng = np.random.default_rng(0)
+    h, w = 120, 160
+    boxes = [[10.2, 20.7, 60.5, 90.1], [100.0, 5.0, 150.0, 40.0], [30.0, 70.0, 31.0, 71.0]]
+    masks = torch.stack([box_mask(h, w, box, rng) for box in boxes])
+    depth_map = depth(h, w, rng)
+
+    result = estimate_positions(masks, boxes, depth_map, FOCAL_LENGTH, (w, h))
+
+    expected = positions_full_frame(masks, depth_map, FOCAL_LENGTH, (w, h))
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_estimate_positions_boxes_clipped_at_borders():
+    rng = np.random.default_rng(1)
+    h, w = 90, 110
+    boxes = [
+        [-15.5, -8.0, 30.0, 25.0],
+        [80.0, 60.0, 140.0, 120.0],
+        [-5.0, 40.0, 130.0, 50.0],
+    ]
+    masks = torch.stack([box_mask(h, w, box, rng) for box in boxes])
+    depth_map = depth(h, w, rng)
+
+    result = estimate_positions(masks, boxes, depth_map, FOCAL_LENGTH, (w, h))
+
+    expected = positions_full_frame(masks, depth_map, FOCAL_LENGTH, (w, h))
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_estimate_positions_empty_mask():
+    rng = np.random.default_rng(2)
+    h, w = 64, 64
+    boxes = [[5.0, 5.0, 30.0, 30.0], [20.0, 20.0, 50.0, 60.0]]
+    masks = torch.stack([box_mask(h, w, boxes[0], rng), torch.zeros((h, w), dtype=torch.bool)])
+    depth_map = depth(h, w, rng)
+
+    result = estimate_positions(masks, boxes, depth_map, FOCAL_LENGTH, (w, h))
+
+    expected = positions_full_frame(masks, depth_map, FOCAL_LENGTH, (w, h))
+    np.testing.assert_allclose(result[0], expected[0], rtol=1e-5, atol=1e-5)
+    assert np.isnan(result[1]).all()
+
+
+def test_estimate_positions_no_objects():
+    masks = torch.zeros((0, 32, 32), dtype=torch.bool)
+
+    result = estimate_positions(masks, [], np.ones((32, 32)), FOCAL_LENGTH, (32, 32))
+
+    assert result.shape == (0, 3)